@@ -0,0 +1,432 @@
+"""
+Reproducible latency benchmarks for the photo agent's hot paths.
+
+  python benchmark.py --json bench.json
+  python benchmark.py --json new.json --baseline bench.json --tolerance 0.25
+
+A synthetic corpus (JPEGs of several resolutions with EXIF GPS and capture
+dates, plus a matching places file for offline geocoding) is generated from
+a fixed seed, so runs on different machines or commits measure the same
+work.  Each suite reports images (or calls) per second and p50/p95 latency;
+with --baseline, metrics that got slower than --tolerance allows are listed
+and the exit status is 1.  The startup suite times fresh interpreters
+importing main.py and making a first tool call, and lists the packages
+main.py spends its import time in.
+"""
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from exif_reader import read_photo_metadata
+from geocode_cache import GeocodeCache
+from jsonrpc_client import start_mcp_client
+from reverse_geocoder import ReverseGeocoder
+
+IMAGE_DETECTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ImageDetection")
+PHOTO_MCP_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "photo_mcp_server.py")
+DEPLOY_AI_AGENT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SUITES = ("exif", "geocode", "mcp", "detection", "startup")
+# Bump when the generated corpus changes, so a stale one is rebuilt
+CORPUS_VERSION = 1
+CORPUS_SIZES = [(640, 480), (1920, 1080), (4032, 3024)]
+CORPUS_PLACES = 2000
+MANIFEST_FILENAME = "manifest.json"
+PLACES_FILENAME = "places.csv"
+MCP_CONCURRENCY = 8
+# Metrics where a larger value is better; every other metric is a latency
+THROUGHPUT_METRICS = ("per_second",)
+LATENCY_METRICS = ("p50_ms", "p95_ms")
+# Durations of one-off steps (model load, server startup, imports), in seconds
+DURATION_METRICS = ("seconds",)
+# Slowdowns smaller than this per call are timer noise, whatever the ratio
+NOISE_FLOOR_MS = 0.05
+# Fresh interpreters started per cold-start measurement
+STARTUP_RUNS = 5
+# Packages listed in the import-time profile of main.py
+IMPORT_PROFILE_TOP = 10
+
+
+def _gps_rational(value):
+    """Decimal degrees -> EXIF (degrees, minutes, seconds)."""
+    value = abs(value)
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = round((value - degrees - minutes / 60) * 3600, 4)
+    return (degrees, minutes, seconds)
+
+
+def make_photo(path, size, latitude, longitude, taken, rng):
+    """Write a textured JPEG of `size` with GPS and DateTimeOriginal EXIF tags."""
+    width, height = size
+    base = Image.fromarray(rng.integers(0, 256, (12, 16, 3), dtype=np.uint8)).resize(size, Image.BICUBIC)
+    # A tiled noise patch gives the encoder real detail to work on, cheaply
+    noise = np.tile(rng.integers(0, 32, (256, 256, 3), dtype=np.uint8),
+                    (height // 256 + 1, width // 256 + 1, 1))[:height, :width]
+    pixels = np.asarray(base, dtype=np.uint16) + noise
+    image = Image.fromarray(np.minimum(pixels, 255).astype(np.uint8))
+
+    exif = Image.Exif()
+    exif.get_ifd(0x8769)[0x9003] = taken.strftime("%Y:%m:%d %H:%M:%S")
+    exif.get_ifd(0x8825).update({
+        0: b"\x02\x02\x00\x00",
+        1: "N" if latitude >= 0 else "S",
+        2: _gps_rational(latitude),
+        3: "E" if longitude >= 0 else "W",
+        4: _gps_rational(longitude),
+    })
+    image.save(path, quality=90, exif=exif)
+
+
+def make_corpus(folder, photos=60, seed=0):
+    """
+    Generate (or reuse) the synthetic corpus in `folder` and return its
+    manifest: {"photos": [{"path", "latitude", "longitude", "width",
+    "height"}], "places_path": str}.  A corpus built with the same
+    parameters is reused as-is.
+    """
+    manifest_path = os.path.join(folder, MANIFEST_FILENAME)
+    params = {"version": CORPUS_VERSION, "photos": photos, "seed": seed}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("params") == params and all(os.path.exists(p["path"]) for p in manifest["photos"]):
+            return manifest
+
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    places = np.column_stack([rng.uniform(-60, 70, CORPUS_PLACES), rng.uniform(-180, 180, CORPUS_PLACES)])
+    places_path = os.path.join(folder, PLACES_FILENAME)
+    with open(places_path, "w", encoding="utf-8", newline="") as f:
+        f.write("name,latitude,longitude,country_code\n")
+        for i, (latitude, longitude) in enumerate(places):
+            f.write(f"Place {i},{latitude:.5f},{longitude:.5f},XX\n")
+
+    records = []
+    start = datetime.datetime(2024, 1, 1, 9, 0, 0)
+    for i in range(photos):
+        width, height = CORPUS_SIZES[i % len(CORPUS_SIZES)]
+        # Photos sit within a few km of a known place
+        latitude, longitude = places[rng.integers(CORPUS_PLACES)] + rng.uniform(-0.03, 0.03, 2)
+        path = os.path.join(folder, f"photo_{i:04d}.jpg")
+        make_photo(path, (width, height), latitude, longitude, start + datetime.timedelta(hours=7 * i), rng)
+        records.append({"path": path, "latitude": round(float(latitude), 6), "longitude": round(float(longitude), 6),
+                        "width": width, "height": height})
+
+    manifest = {"params": params, "photos": records, "places_path": places_path}
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def latency_stats(samples):
+    """p50/p95/mean latency in milliseconds and throughput for per-call durations in seconds."""
+    samples = np.asarray(samples, dtype=np.float64)
+    total = float(samples.sum())
+    count = len(samples)
+    return {
+        "count": count,
+        "p50_ms": round(float(np.percentile(samples, 50)) * 1000, 3),
+        "p95_ms": round(float(np.percentile(samples, 95)) * 1000, 3),
+        "mean_ms": round(float(samples.mean()) * 1000, 3),
+        "per_second": round(count / total, 2) if total else None,
+    }
+
+
+def time_calls(fn, items, warmup=1):
+    """Call `fn` on every item, after `warmup` untimed calls, and return `latency_stats`."""
+    for item in items[:warmup]:
+        fn(item)
+    samples = []
+    for item in items:
+        start = time.perf_counter()
+        fn(item)
+        samples.append(time.perf_counter() - start)
+    return latency_stats(samples)
+
+
+def time_concurrent_calls(fn, items, workers):
+    """Throughput of `fn` over `items` from `workers` threads, plus per-call latency."""
+    def timed(item):
+        start = time.perf_counter()
+        fn(item)
+        return time.perf_counter() - start
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        start = time.perf_counter()
+        samples = list(executor.map(timed, items))
+        wall = time.perf_counter() - start
+    stats = latency_stats(samples)
+    stats["per_second"] = round(len(items) / wall, 2) if wall else None
+    return stats
+
+
+def bench_exif(manifest):
+    paths = [photo["path"] for photo in manifest["photos"]]
+    return {"exif.read_photo_metadata": time_calls(read_photo_metadata, paths)}
+
+
+def bench_geocode(manifest, work_dir):
+    coords = [(photo["latitude"], photo["longitude"]) for photo in manifest["photos"]]
+    start = time.perf_counter()
+    geocoder = ReverseGeocoder.from_file(manifest["places_path"])
+    load_seconds = time.perf_counter() - start
+
+    results = {
+        "geocode.load_places": {"count": 1, "seconds": round(load_seconds, 4)},
+        "geocode.nearest": time_calls(lambda c: geocoder.nearest(*c, max_distance_km=50), coords),
+    }
+    # One batch call resolving many photos, as the folder tools do
+    batch = coords * max(1, 10000 // len(coords))
+    stats = time_calls(lambda b: geocoder.nearest_many(b, 50), [batch] * 5)
+    # Coordinates per second rather than calls per second
+    stats.update(batch_size=len(batch), per_second=round(len(batch) * 1000 / stats["mean_ms"], 2))
+    results["geocode.nearest_many"] = stats
+
+    def resolve_many(coordinates):
+        return [match[0].display_name() if match else None for match in geocoder.nearest_many(coordinates, 50)]
+
+    db_path = os.path.join(work_dir, "bench-geocode.sqlite")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    cache = GeocodeCache(resolve_many, db_path)
+    try:
+        results["geocode.cache_cold"] = time_calls(lambda c: cache.lookup(*c), coords, warmup=0)
+        results["geocode.cache_warm"] = time_calls(lambda c: cache.lookup(*c), coords)
+    finally:
+        cache.close()
+    return results
+
+
+def bench_mcp(manifest, work_dir):
+    """Tool-call round trips through JsonRpcClient against a fresh photo_mcp_server.py."""
+    env = os.environ.copy()
+    env.update({
+        "PHOTO_GEONAMES_PATH": manifest["places_path"],
+        "PHOTO_GEOCODER_NETWORK_FALLBACK": "0",
+        "PHOTO_GEOCODE_CACHE_PATH": os.path.join(work_dir, "bench-mcp-geocode.sqlite"),
+        "PHOTO_CATALOG_PATH": os.path.join(work_dir, "bench-mcp-catalog.sqlite"),
+    })
+    start = time.perf_counter()
+    client = start_mcp_client(sys.executable, [PHOTO_MCP_SERVER], env=env, default_timeout=120)
+    startup_seconds = time.perf_counter() - start
+    photos = manifest["photos"]
+    try:
+        results = {"mcp.startup": {"count": 1, "seconds": round(startup_seconds, 4)}}
+        results["mcp.ping"] = time_calls(lambda _: client.ping(), list(range(len(photos))))
+        results["mcp.get_exif"] = time_calls(lambda p: client.call_tool("get_exif", {"file": p["path"]}), photos)
+        results["mcp.get_location_names_from_gps_coords"] = time_calls(
+            lambda p: client.call_tool("get_location_names_from_gps_coords",
+                                       {"coordinates": [[p["latitude"], p["longitude"]]]}),
+            photos)
+        results["mcp.get_image_location_metadata.concurrent"] = time_concurrent_calls(
+            lambda p: client.call_tool("get_image_location_metadata", {"filepath": p["path"]}), photos, MCP_CONCURRENCY)
+    finally:
+        client.close()
+    return results
+
+
+def bench_detection(manifest, model_save_path):
+    if IMAGE_DETECTION_DIR not in sys.path:
+        sys.path.insert(0, IMAGE_DETECTION_DIR)
+    import test_object_detection_using_owlv2 as detection
+
+    start = time.perf_counter()
+    detection.warm_up_model(model_save_path=model_save_path)
+    load_seconds = time.perf_counter() - start
+    paths = [photo["path"] for photo in manifest["photos"]]
+    stats = time_calls(lambda p: detection.detect_and_count(p, detection.OBJECTS_TO_DETECT,
+                                                            model_save_path=model_save_path), paths, warmup=0)
+    return {"detection.load_model": {"count": 1, "seconds": round(load_seconds, 4)},
+            "detection.detect_and_count": stats}
+
+
+def _run_python(code, env=None):
+    """Run `code` in a fresh interpreter from this folder and return (wall seconds, stdout, stderr)."""
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-c", code], cwd=DEPLOY_AI_AGENT_DIR, env=env,
+                          capture_output=True, text=True, check=True)
+    return time.perf_counter() - start, proc.stdout, proc.stderr
+
+
+def import_profile(module, top=IMPORT_PROFILE_TOP):
+    """
+    Cumulative import time in seconds of each package `module` imports
+    directly, from `python -X importtime`, largest first.
+    """
+    _, _, stderr = _run_python(f"import {module}", env=dict(os.environ, PYTHONPROFILEIMPORTTIME="1"))
+    children, packages = [], {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue  # the column header
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        if depth == 1:
+            children.append((name, int(cumulative)))
+        elif depth == 0:
+            # A top-level import is printed after everything it imported
+            if name == module:
+                for child, microseconds in children:
+                    package = child.split(".")[0]
+                    packages[package] = packages.get(package, 0) + microseconds
+                break
+            children = []
+    ranked = sorted(packages.items(), key=lambda item: -item[1])[:top]
+    return [(package, microseconds / 1e6) for package, microseconds in ranked]
+
+
+def bench_startup(manifest, work_dir):
+    """Cold-start cost of the web app: importing main.py, and the first tool call per tool backend."""
+    env = os.environ.copy()
+    env.update({
+        "PHOTO_GEONAMES_PATH": manifest["places_path"],
+        "PHOTO_GEOCODER_NETWORK_FALLBACK": "0",
+        "PHOTO_GEOCODE_CACHE_PATH": os.path.join(work_dir, "bench-startup-geocode.sqlite"),
+        "PHOTO_CATALOG_PATH": os.path.join(work_dir, "bench-startup-catalog.sqlite"),
+    })
+    env.pop("VERCEL", None)
+    samples = [_run_python("import main", env)[0] for _ in range(STARTUP_RUNS)]
+    results = {"startup.import_main": latency_stats(samples)}
+
+    # Timed inside the child: import photo_agent, then one tool call that builds the backend
+    first_call = (
+        "import time; start = time.perf_counter()\n"
+        "import photo_agent\n"
+        f"photo_agent.call_tool('get_exif', {{'file': {manifest['photos'][0]['path']!r}}})\n"
+        "print(time.perf_counter() - start)\n"
+        "photo_agent.get_tool_backend().close()\n"
+    )
+    for backend in ("inprocess", "subprocess"):
+        env["PHOTO_TOOL_BACKEND"] = backend
+        samples = [float(_run_python(first_call, env)[1].split()[0]) for _ in range(STARTUP_RUNS)]
+        results[f"startup.first_tool_call.{backend}"] = latency_stats(samples)
+
+    for package, seconds in import_profile("main"):
+        results[f"startup.import_main.{package}"] = {"count": 1, "seconds": round(seconds, 4)}
+    return results
+
+
+def run_benchmarks(manifest, work_dir, suites=SUITES, model_save_path=None):
+    results = {}
+    for suite in suites:
+        print(f"Running {suite} benchmarks...", file=sys.stderr)
+        if suite == "exif":
+            results.update(bench_exif(manifest))
+        elif suite == "geocode":
+            results.update(bench_geocode(manifest, work_dir))
+        elif suite == "mcp":
+            results.update(bench_mcp(manifest, work_dir))
+        elif suite == "detection":
+            results.update(bench_detection(manifest, model_save_path))
+        elif suite == "startup":
+            results.update(bench_startup(manifest, work_dir))
+    return {
+        "meta": {
+            "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "corpus": manifest["params"],
+            "suites": list(suites),
+        },
+        "results": results,
+    }
+
+
+def compare_to_baseline(report, baseline, tolerance=0.25):
+    """
+    Compare every metric present in both reports.  Returns (rows,
+    regressions): a row per compared metric with the old and new value and
+    their ratio, and the subset that got worse by more than `tolerance`
+    (latency or one-off duration up, or throughput down) and by more than
+    NOISE_FLOOR_MS per call.
+    """
+    rows, regressions = [], []
+    for name, stats in report["results"].items():
+        old_stats = baseline.get("results", {}).get(name)
+        if not old_stats:
+            continue
+        for metric in LATENCY_METRICS + THROUGHPUT_METRICS + DURATION_METRICS:
+            old, new = old_stats.get(metric), stats.get(metric)
+            if not old or new is None:
+                continue
+            ratio = new / old
+            if metric in THROUGHPUT_METRICS:
+                worse = ratio < 1 - tolerance and (1000 / new if new else float("inf")) - 1000 / old > NOISE_FLOOR_MS
+            elif metric in DURATION_METRICS:
+                worse = ratio > 1 + tolerance and (new - old) * 1000 > NOISE_FLOOR_MS
+            else:
+                worse = ratio > 1 + tolerance and new - old > NOISE_FLOOR_MS
+            row = {"name": name, "metric": metric, "baseline": old, "current": new, "ratio": round(ratio, 3),
+                   "regression": worse}
+            rows.append(row)
+            if worse:
+                regressions.append(row)
+    return rows, regressions
+
+
+def print_report(report):
+    print(f"{'benchmark':<48} {'n':>5} {'p50 ms':>9} {'p95 ms':>9} {'per s':>10}")
+    for name, stats in report["results"].items():
+        if "seconds" in stats:
+            print(f"{name:<48} {stats['count']:>5} {stats['seconds'] * 1000:>9.1f}")
+            continue
+        print(f"{name:<48} {stats['count']:>5} {stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['per_second']:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark detection, EXIF, geocoding, MCP round trips and cold start")
+    parser.add_argument("--suites", nargs="+", choices=SUITES, default=list(SUITES))
+    parser.add_argument("--photos", type=int, default=60, help="Photos in the synthetic corpus")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--corpus", default=os.path.join(tempfile.gettempdir(), "photo-agent-benchmark"),
+                        help="Folder for the generated corpus; reused across runs with the same settings")
+    parser.add_argument("--model-save-path", default=os.environ.get("OWLV2_MODEL_SAVE_PATH",
+                                                                    os.path.join(IMAGE_DETECTION_DIR, "owlv2-model")))
+    parser.add_argument("--json", help="Write the report to this file")
+    parser.add_argument("--baseline", help="Earlier --json report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed slowdown before a metric counts as a regression (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    suites = args.suites
+    if "detection" in suites:
+        if IMAGE_DETECTION_DIR not in sys.path:
+            sys.path.insert(0, IMAGE_DETECTION_DIR)
+        from test_object_detection_using_owlv2 import is_model_downloaded
+        if not is_model_downloaded(args.model_save_path):
+            # Never download the weights as a side effect of a benchmark run
+            print(f"Skipping detection: no model at {args.model_save_path}", file=sys.stderr)
+            suites = [s for s in suites if s != "detection"]
+
+    manifest = make_corpus(args.corpus, args.photos, args.seed)
+    report = run_benchmarks(manifest, args.corpus, suites, args.model_save_path)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        rows, regressions = compare_to_baseline(report, baseline, args.tolerance)
+        print(f"\nCompared {len(rows)} metrics with {args.baseline}:")
+        for row in regressions:
+            print(f"  REGRESSION {row['name']} {row['metric']}: {row['baseline']} -> {row['current']} (x{row['ratio']})")
+        if not regressions:
+            print("  no regressions")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,221 @@
+import logging
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import exifread
+
+import tracing
+
+PHOTO_EXTENSIONS = {".jpg", ".jpeg", ".png", ".heic", ".tif", ".tiff"}
+JPEG_EXTENSIONS = {".jpg", ".jpeg"}
+
+# TIFF tags we stop at; everything else in the EXIF block is skipped
+TAG_DATETIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_GPS_IFD = 0x8825
+TAG_DATETIME_ORIGINAL = 0x9003
+GPS_LATITUDE_REF, GPS_LATITUDE = 1, 2
+GPS_LONGITUDE_REF, GPS_LONGITUDE = 3, 4
+GPS_ALTITUDE_REF, GPS_ALTITUDE = 5, 6
+
+# TIFF field type -> size in bytes of one value
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8, 11: 4, 12: 8}
+
+JPEG_SOI = b"\xff\xd8"
+JPEG_SOS, JPEG_EOI, JPEG_APP1 = 0xDA, 0xD9, 0xE1
+EXIF_HEADER = b"Exif\x00\x00"
+
+
+def read_jpeg_exif_block(f):
+    """
+    Walk the JPEG marker segments up to the first EXIF APP1 segment and
+    return its TIFF block, or None.  Image data is never read.
+    """
+    if f.read(2) != JPEG_SOI:
+        return None
+    while True:
+        if f.read(1) != b"\xff":
+            return None
+        marker = f.read(1)
+        while marker == b"\xff":
+            # Fill bytes before a marker
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker == JPEG_SOS or marker == JPEG_EOI:
+            return None
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # Standalone markers carry no length
+            continue
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = struct.unpack(">H", length_bytes)[0] - 2
+        if marker == JPEG_APP1:
+            segment = f.read(length)
+            if segment.startswith(EXIF_HEADER):
+                return segment[len(EXIF_HEADER):]
+        else:
+            f.seek(length, os.SEEK_CUR)
+
+
+class _TiffReader:
+    def __init__(self, data):
+        self.data = data
+        if data[:2] == b"II":
+            self.endian = "<"
+        elif data[:2] == b"MM":
+            self.endian = ">"
+        else:
+            raise ValueError("Not a TIFF block")
+
+    def unpack(self, fmt, offset):
+        return struct.unpack_from(self.endian + fmt, self.data, offset)
+
+    def first_ifd_offset(self):
+        return self.unpack("I", 4)[0]
+
+    def read_ifd(self, offset, wanted):
+        """Return {tag: value} for the `wanted` tags of the IFD at `offset`."""
+        values = {}
+        count = self.unpack("H", offset)[0]
+        for i in range(count):
+            entry = offset + 2 + i * 12
+            tag, field_type, n = self.unpack("HHI", entry)
+            if tag not in wanted or field_type not in TYPE_SIZES:
+                continue
+            size = TYPE_SIZES[field_type] * n
+            value_offset = entry + 8 if size <= 4 else self.unpack("I", entry + 8)[0]
+            if value_offset + size > len(self.data):
+                continue
+            values[tag] = self.decode(field_type, n, value_offset)
+        return values
+
+    def decode(self, field_type, n, offset):
+        if field_type == 2:
+            return self.data[offset:offset + n].split(b"\x00", 1)[0].decode("ascii", "replace").strip()
+        if field_type in (1, 7):
+            return list(self.data[offset:offset + n])
+        if field_type in (5, 10):
+            fmt = "I" if field_type == 5 else "i"
+            pairs = self.unpack(f"{2 * n}{fmt}", offset)
+            return [num / den if den else 0.0 for num, den in zip(pairs[::2], pairs[1::2])]
+        fmt = {3: "H", 4: "I", 9: "i", 11: "f", 12: "d"}[field_type]
+        return list(self.unpack(f"{n}{fmt}", offset))
+
+
+def dms_to_decimal(dms, ref):
+    """Degrees/minutes/seconds plus an N/S/E/W reference to signed decimal degrees."""
+    degrees = dms[0] + (dms[1] if len(dms) > 1 else 0) / 60 + (dms[2] if len(dms) > 2 else 0) / 3600
+    return -degrees if ref in ("S", "W") else degrees
+
+
+def exif_datetime_to_iso(value):
+    """EXIF 'YYYY:MM:DD HH:MM:SS' to ISO 8601, or None if it doesn't parse."""
+    try:
+        return datetime.strptime(value.strip(), "%Y:%m:%d %H:%M:%S").isoformat()
+    except (AttributeError, ValueError):
+        return None
+
+
+def parse_tiff_metadata(data):
+    """Extract GPS position and capture time from a TIFF/EXIF block."""
+    tiff = _TiffReader(data)
+    ifd0 = tiff.read_ifd(tiff.first_ifd_offset(), {TAG_DATETIME, TAG_EXIF_IFD, TAG_GPS_IFD})
+    metadata = {"latitude": None, "longitude": None, "altitude": None, "date_original": None}
+
+    date = None
+    if TAG_EXIF_IFD in ifd0:
+        date = tiff.read_ifd(ifd0[TAG_EXIF_IFD][0], {TAG_DATETIME_ORIGINAL}).get(TAG_DATETIME_ORIGINAL)
+    metadata["date_original"] = exif_datetime_to_iso(date or ifd0.get(TAG_DATETIME))
+
+    if TAG_GPS_IFD in ifd0:
+        gps = tiff.read_ifd(ifd0[TAG_GPS_IFD][0], {GPS_LATITUDE_REF, GPS_LATITUDE, GPS_LONGITUDE_REF,
+                                                   GPS_LONGITUDE, GPS_ALTITUDE_REF, GPS_ALTITUDE})
+        if GPS_LATITUDE in gps and GPS_LONGITUDE in gps:
+            metadata["latitude"] = round(dms_to_decimal(gps[GPS_LATITUDE], gps.get(GPS_LATITUDE_REF, "N")), 7)
+            metadata["longitude"] = round(dms_to_decimal(gps[GPS_LONGITUDE], gps.get(GPS_LONGITUDE_REF, "E")), 7)
+        if GPS_ALTITUDE in gps:
+            below_sea_level = gps.get(GPS_ALTITUDE_REF, [0])[0] == 1
+            metadata["altitude"] = round(-gps[GPS_ALTITUDE][0] if below_sea_level else gps[GPS_ALTITUDE][0], 2)
+    return metadata
+
+
+def _exifread_metadata(f):
+    """Fallback for non-JPEG files: exifread without MakerNotes or thumbnails."""
+    tags = exifread.process_file(f, details=False, extract_thumbnail=False)
+    metadata = {"latitude": None, "longitude": None, "altitude": None, "date_original": None}
+
+    def ratios(tag):
+        return [float(v.num) / v.den if v.den else 0.0 for v in tag.values]
+
+    lat, lon = tags.get("GPS GPSLatitude"), tags.get("GPS GPSLongitude")
+    if lat and lon:
+        metadata["latitude"] = round(dms_to_decimal(ratios(lat), str(tags.get("GPS GPSLatitudeRef", "N"))), 7)
+        metadata["longitude"] = round(dms_to_decimal(ratios(lon), str(tags.get("GPS GPSLongitudeRef", "E"))), 7)
+    alt = tags.get("GPS GPSAltitude")
+    if alt:
+        below_sea_level = str(tags.get("GPS GPSAltitudeRef", "0")) == "1"
+        metadata["altitude"] = round(-ratios(alt)[0] if below_sea_level else ratios(alt)[0], 2)
+    date = tags.get("EXIF DateTimeOriginal") or tags.get("Image DateTime")
+    metadata["date_original"] = exif_datetime_to_iso(str(date)) if date else None
+    return metadata
+
+
+def read_photo_metadata(filepath):
+    """
+    Read GPS position (signed decimal degrees) and capture time of a photo.
+
+    JPEGs are handled by reading only the EXIF APP1 segment and visiting
+    just the IFDs that hold GPS and DateTimeOriginal.  Raises OSError if the
+    file can't be read.
+    """
+    metadata = {"path": filepath, "latitude": None, "longitude": None, "altitude": None, "date_original": None}
+    is_jpeg = os.path.splitext(filepath)[1].lower() in JPEG_EXTENSIONS
+    with tracing.span("exif.read", parser="jpeg" if is_jpeg else "exifread"), open(filepath, "rb") as f:
+        if is_jpeg:
+            block = read_jpeg_exif_block(f)
+            if block is None:
+                return metadata
+            try:
+                metadata.update(parse_tiff_metadata(block))
+            except (ValueError, struct.error, IndexError) as e:
+                logging.warning(f"Malformed EXIF block in {filepath}: {str(e)}")
+        else:
+            metadata.update(_exifread_metadata(f))
+    return metadata
+
+
+def iter_photo_paths(folder, recursive=True, extensions=PHOTO_EXTENSIONS):
+    if recursive:
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in extensions:
+                    yield os.path.join(root, name)
+    else:
+        for entry in sorted(os.scandir(folder), key=lambda e: e.name):
+            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in extensions:
+                yield entry.path
+
+
+def read_folder_metadata(folder, recursive=True, max_workers=16):
+    """
+    Read metadata for every photo under `folder` with a thread pool.
+
+    Returns one dict per photo in path order; unreadable files get an
+    "error" entry instead of failing the whole scan.
+    """
+    def _safe(path):
+        try:
+            return read_photo_metadata(path)
+        except Exception as e:
+            logging.error(f"An error occurred while reading metadata from {path}: {str(e)}")
+            return {"path": path, "error": str(e)}
+
+    paths = list(iter_photo_paths(folder, recursive))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_safe, paths))
@@ -0,0 +1,180 @@
+import collections
+import concurrent.futures
+import sqlite3
+import threading
+import time
+
+DEFAULT_GEOCODE_CACHE_PATH = "./geocode-cache.sqlite"
+# 4 decimal places is a cell of about 11 x 11 meters at the equator
+DEFAULT_PRECISION = 4
+DEFAULT_MAX_ENTRIES = 10000
+
+_LOOKUP_CHUNK_SIZE = 500
+
+
+class GeocodeCache:
+    """
+    Caching layer in front of a batch reverse geocoder.
+
+    Coordinates are rounded to `precision` decimal places, and each cell is
+    geocoded once at its rounded point.  Names live in an in-memory LRU in
+    front of a SQLite store that survives server restarts.  Concurrent
+    lookups of the same cell wait on a single backend call instead of
+    issuing their own.
+
+    `resolve_many(coordinates)` must return one name (or None) per
+    (latitude, longitude) pair.  Cells that resolve to None are not cached,
+    since a failed network lookup looks the same as "nothing here".
+    """
+
+    def __init__(self, resolve_many, db_path=DEFAULT_GEOCODE_CACHE_PATH, precision=DEFAULT_PRECISION,
+                 max_entries=DEFAULT_MAX_ENTRIES, namespace=""):
+        self._resolve_many = resolve_many
+        self.db_path = db_path
+        self.precision = precision
+        self.max_entries = max_entries
+        # Separates names produced by different backends or places files
+        self.namespace = namespace
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._lru = collections.OrderedDict()
+        self._in_flight = {}
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS geocodes (
+                namespace TEXT NOT NULL,
+                cell TEXT NOT NULL,
+                name TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (namespace, cell)
+            )""")
+        self._conn.commit()
+
+    def cell(self, latitude, longitude):
+        return f"{round(float(latitude), self.precision):.{self.precision}f},{round(float(longitude), self.precision):.{self.precision}f}"
+
+    @staticmethod
+    def cell_center(cell):
+        latitude, longitude = cell.split(",")
+        return float(latitude), float(longitude)
+
+    def _remember(self, cell, name):
+        """Insert into the LRU; caller holds self._lock."""
+        self._lru[cell] = name
+        self._lru.move_to_end(cell)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def _load(self, cells):
+        stored = {}
+        with self._db_lock:
+            for start in range(0, len(cells), _LOOKUP_CHUNK_SIZE):
+                chunk = cells[start:start + _LOOKUP_CHUNK_SIZE]
+                rows = self._conn.execute(
+                    "SELECT cell, name FROM geocodes"
+                    f" WHERE namespace = ? AND cell IN ({','.join('?' * len(chunk))})",
+                    (self.namespace, *chunk))
+                stored.update(rows)
+        return stored
+
+    def _store(self, names):
+        now = time.time()
+        with self._db_lock:
+            self._conn.executemany("INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?)",
+                                   [(self.namespace, cell, name, now) for cell, name in names.items()])
+            self._conn.commit()
+
+    def lookup_many(self, coordinates):
+        """Return a name (or None) for each (latitude, longitude) pair, in order."""
+        cells = [self.cell(latitude, longitude) for latitude, longitude in coordinates]
+        names = {}
+        waiting = {}
+
+        with self._lock:
+            unresolved = []
+            for cell in dict.fromkeys(cells):
+                if cell in self._lru:
+                    self._lru.move_to_end(cell)
+                    names[cell] = self._lru[cell]
+                    self.memory_hits += 1
+                else:
+                    unresolved.append(cell)
+
+        if unresolved:
+            stored = self._load(unresolved)
+            with self._lock:
+                owned = []
+                for cell in unresolved:
+                    if cell in stored:
+                        names[cell] = stored[cell]
+                        self._remember(cell, stored[cell])
+                        self.disk_hits += 1
+                    elif cell in self._in_flight:
+                        waiting[cell] = self._in_flight[cell]
+                        self.coalesced += 1
+                    else:
+                        self._in_flight[cell] = concurrent.futures.Future()
+                        owned.append(cell)
+                        self.misses += 1
+
+            if owned:
+                try:
+                    resolved = dict(zip(owned, self._resolve_many([self.cell_center(cell) for cell in owned])))
+                    found = {cell: name for cell, name in resolved.items() if name is not None}
+                    if found:
+                        self._store(found)
+                except BaseException as e:
+                    # Backend or store failure alike: waiters on these cells must not block forever
+                    with self._lock:
+                        futures = [self._in_flight.pop(cell) for cell in owned]
+                    for future in futures:
+                        future.set_exception(e)
+                    raise
+                with self._lock:
+                    for cell, name in found.items():
+                        self._remember(cell, name)
+                    futures = {cell: self._in_flight.pop(cell) for cell in owned}
+                for cell, future in futures.items():
+                    future.set_result(resolved.get(cell))
+                names.update(resolved)
+
+        for cell, future in waiting.items():
+            names[cell] = future.result()
+        return [names.get(cell) for cell in cells]
+
+    def lookup(self, latitude, longitude):
+        return self.lookup_many([(latitude, longitude)])[0]
+
+    def stats(self):
+        with self._db_lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM geocodes WHERE namespace = ?",
+                                         (self.namespace,)).fetchone()[0]
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits + self.coalesced
+            lookups = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "coalesced": self.coalesced,
+                "misses": self.misses,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "memory_entries": len(self._lru),
+                "disk_entries": entries,
+            }
+
+    def clear(self):
+        with self._db_lock:
+            self._conn.execute("DELETE FROM geocodes WHERE namespace = ?", (self.namespace,))
+            self._conn.commit()
+        with self._lock:
+            self._lru.clear()
+            self.memory_hits = self.disk_hits = self.coalesced = self.misses = 0
+
+    def close(self):
+        with self._db_lock:
+            self._conn.close()
@@ -0,0 +1,206 @@
+import collections
+import logging
+import os
+import re
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".heic", ".tif", ".tiff")
+
+INTENT_LOCATION = "location"
+INTENT_DETECT = "detect"
+INTENT_FOLDER_SUMMARY = "folder_summary"
+
+# Quoted paths may contain spaces; bare ones start like an absolute, home or relative path
+PATH_PATTERN = re.compile(r'"([^"]+)"|\'([^\']+)\'|((?:[A-Za-z]:[\\/]|~[\\/]|\.{1,2}[\\/]|[\\/])[^\s"\']*)')
+# Prompts that ask for more than one thing go to the LLM
+COMPOUND_PATTERN = re.compile(r"\b(and|then|also|after|before|explain|why|poem|story|compare)\b", re.IGNORECASE)
+MAX_WORDS = 15
+
+LOCATION_PATTERN = re.compile(
+    r"\bwhere\b.*\b(taken|shot|captured|photographed|from)\b|\b(location|gps|coordinates)\b", re.IGNORECASE)
+DETECT_PATTERN = re.compile(
+    r"\bhow many\s+(?P<many>[\w\s,]+?)\s+(are|is|in|does|do)\b|\bcount\s+(?P<count>[\w\s,]+?)\s+in\b"
+    r"|\b(detect|what objects|which objects|objects)\b", re.IGNORECASE)
+SUMMARY_PATTERN = re.compile(r"\b(summar\w*|overview|describe|what'?s in|what is in)\b", re.IGNORECASE)
+
+IRREGULAR_SINGULARS = {"people": "person", "persons": "person", "children": "child", "men": "man", "women": "woman",
+                       "mice": "mouse", "geese": "goose", "phones": "cell phone", "remotes": "remote control",
+                       "buses": "bus", "lenses": "lens"}
+# Plural endings that drop "es" rather than just "s" (glasses, boxes, watches, dishes)
+ES_PLURAL_ENDINGS = ("sses", "xes", "zzes", "ches", "shes")
+# Filler words that can come before an object name after "how many" / "count"
+FILLER_WORDS = {"the", "a", "an", "of", "any", "all", "some", "my", "these", "those", "there"}
+# Words that name no object when they are all that is left
+NON_OBJECT_WORDS = {"objects", "things"}
+
+TOP_PLACES = 5
+# Photos are grouped into ~1 km cells before naming places for a summary
+SUMMARY_CELL_DECIMALS = 2
+
+
+def extract_path(prompt):
+    match = PATH_PATTERN.search(prompt)
+    if not match:
+        return None
+    path = next(group for group in match.groups() if group)
+    # Trailing sentence punctuation isn't part of an unquoted path
+    return os.path.expanduser(path.rstrip("?.!,;:") if match.group(3) else path)
+
+
+def singular(word):
+    """
+    Singular form of an English plural, for the last word of a phrase.
+
+    >>> [singular(w) for w in ["cats", "puppies", "glasses", "buses", "boxes", "watches", "dishes", "horses"]]
+    ['cat', 'puppy', 'glass', 'bus', 'box', 'watch', 'dish', 'horse']
+    >>> singular("traffic lights")
+    'traffic light'
+    """
+    words = word.strip().lower().split()
+    if not words:
+        return ""
+    last = words[-1]
+    if last in IRREGULAR_SINGULARS:
+        last = IRREGULAR_SINGULARS[last]
+    elif last.endswith("ies") and len(last) > 4:
+        last = last[:-3] + "y"
+    elif last.endswith(ES_PLURAL_ENDINGS):
+        last = last[:-2]
+    elif last.endswith("s") and not last.endswith("ss"):
+        last = last[:-1]
+    return " ".join(words[:-1] + [last])
+
+
+def parse_objects(text):
+    """
+    Object names listed in `text`, singular; None when no object is named.
+    Articles and other filler words in front of a name are dropped.
+
+    >>> parse_objects("cats, dogs and people")
+    ['cat', 'dog', 'person']
+    >>> parse_objects("the dogs")
+    ['dog']
+    >>> parse_objects("of the cats")
+    ['cat']
+    >>> parse_objects("any objects") is None
+    True
+    """
+    if not text:
+        return None
+    objects = []
+    for part in re.split(r",|\band\b|\bor\b", text, flags=re.IGNORECASE):
+        words = part.lower().split()
+        while words and words[0] in FILLER_WORDS:
+            words.pop(0)
+        if words and " ".join(words) not in NON_OBJECT_WORDS:
+            objects.append(singular(" ".join(words)))
+    return objects or None
+
+
+class IntentRouter:
+    """
+    Answers common structured photo questions by running their tool chain
+    directly, so they skip the LLM round trips entirely.
+
+    Recognized intents: where a single photo was taken, how many of some
+    objects are in a photo, and a summary of a folder.  `route` returns None
+    for anything else, including prompts that ask for more than one thing.
+    """
+
+    def __init__(self, call_tool):
+        self.call_tool = call_tool
+
+    def match(self, prompt):
+        """
+        Return (intent, path, objects) or None.
+
+        >>> router = IntentRouter(None)
+        >>> router.match("count the dogs in /x/a.jpg")
+        ('detect', '/x/a.jpg', ['dog'])
+        >>> router.match("how many of the cats are in /x/a.jpg?")
+        ('detect', '/x/a.jpg', ['cat'])
+        >>> router.match("how many glasses and buses are in /x/a.jpg")
+        ('detect', '/x/a.jpg', ['glass', 'bus'])
+        >>> router.match("where was /x/a.jpg taken?")
+        ('location', '/x/a.jpg', None)
+        >>> router.match("where was /x/a.jpg taken and why?") is None
+        True
+        """
+        path = extract_path(prompt)
+        if path is None:
+            return None
+        rest = PATH_PATTERN.sub(" ", prompt, count=1)
+        if len(rest.split()) > MAX_WORDS:
+            return None
+
+        is_image = path.lower().endswith(IMAGE_EXTENSIONS)
+        detect = DETECT_PATTERN.search(rest) if is_image else None
+        if detect:
+            # "and" inside "how many cats and dogs" lists objects, it doesn't join two requests
+            objects_text = detect.group("many") or detect.group("count")
+            if not COMPOUND_PATTERN.search(rest.replace(objects_text, " ") if objects_text else rest):
+                return INTENT_DETECT, path, parse_objects(objects_text)
+        if COMPOUND_PATTERN.search(rest):
+            return None
+        if is_image and LOCATION_PATTERN.search(rest):
+            return INTENT_LOCATION, path, None
+        if not is_image and SUMMARY_PATTERN.search(rest) and os.path.isdir(path):
+            return INTENT_FOLDER_SUMMARY, path, None
+        return None
+
+    def route(self, prompt):
+        """Answer `prompt` directly, or return None to let the LLM handle it."""
+        matched = self.match(prompt)
+        if matched is None:
+            return None
+        intent, path, objects = matched
+        logging.info(f"Routing prompt to {intent} for {path} without the LLM")
+        try:
+            if intent == INTENT_LOCATION:
+                return self.photo_location(path)
+            if intent == INTENT_DETECT:
+                return self.detect_objects(path, objects)
+            return self.folder_summary(path)
+        except Exception as e:
+            logging.error(f"Error running {intent} for {path}: {str(e)}")
+            return f"Error {str(e)}"
+
+    def photo_location(self, path):
+        exif = self.call_tool("get_exif", {"file": path})
+        taken = f" on {exif['date_original'].replace('T', ' ')}" if exif.get("date_original") else ""
+        if exif.get("latitude") is None or exif.get("longitude") is None:
+            return f"{path} has no GPS location in its metadata." + (f" It was taken{taken}." if taken else "")
+        latitude, longitude = exif["latitude"], exif["longitude"]
+        name = self.call_tool("get_location_names_from_gps_coords", {"coordinates": [[latitude, longitude]]})[0]
+        place = name or "an unknown place"
+        return f"{path} was taken at {place} ({latitude}, {longitude}){taken}."
+
+    def detect_objects(self, path, objects):
+        arguments = {"filepath": path}
+        if objects:
+            arguments["objects"] = objects
+        return self.call_tool("detect_objects_in_image", arguments)
+
+    def folder_summary(self, folder):
+        records = self.call_tool("get_photo_catalog_records", {"folder": folder})
+        if not records:
+            return f"No photos found in {folder}."
+        dates = sorted(r["date_original"] for r in records if r.get("date_original"))
+        located = [r for r in records if r.get("latitude") is not None and r.get("longitude") is not None]
+        lines = [f"{folder} contains {len(records)} photos."]
+        if dates:
+            lines.append(f"Taken between {dates[0][:10]} and {dates[-1][:10]}.")
+        lines.append(f"{len(located)} have a GPS location.")
+
+        if located:
+            cells = collections.Counter((round(r["latitude"], SUMMARY_CELL_DECIMALS), round(r["longitude"], SUMMARY_CELL_DECIMALS))
+                                        for r in located)
+            names = self.call_tool("get_location_names_from_gps_coords", {"coordinates": [list(c) for c in cells]})
+            places = collections.Counter()
+            for (cell, count), name in zip(cells.items(), names):
+                places[name or "unknown place"] += count
+            top = ", ".join(f"{name} ({count})" for name, count in places.most_common(TOP_PLACES))
+            lines.append(f"Most photographed places: {top}.")
+        tags = collections.Counter(tag for r in records for tag in r.get("tags", []))
+        if tags:
+            lines.append("Tags: " + ", ".join(f"{tag} ({count})" for tag, count in tags.most_common(TOP_PLACES)) + ".")
+        return "\n".join(lines)
@@ -0,0 +1,237 @@
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import subprocess
+import threading
+import uuid
+
+import tracing
+
+MCP_PROTOCOL_VERSION = "2025-06-18"
+
+
+class JsonRpcError(Exception):
+    """An error response from the JSON-RPC server."""
+
+    def __init__(self, error):
+        super().__init__(error.get("message", "Unknown JSON-RPC error"))
+        self.code = error.get("code")
+        self.data = error.get("data")
+
+
+class RequestNotSentError(ConnectionError):
+    """The request never reached the server, so sending it again can't repeat its effects."""
+
+
+# --- Multiplexed JSON-RPC client over stdio ---
+class JsonRpcClient:
+    """
+    JSON-RPC 2.0 client talking to a subprocess over stdin/stdout.
+
+    Every request gets its own future, keyed by request id, and a single reader
+    thread resolves futures as responses arrive in any order.  Many requests can
+    be in flight on one pipe at once, from threads (`request`) or from asyncio
+    (`arequest`).
+    """
+
+    def __init__(self, command, args=None, env=None, default_timeout=None):
+        if args is None:
+            args = []
+        logging.info(f"Starting JSON-RPC server process: {command} {' '.join(args)}")
+        self.default_timeout = default_timeout
+        self.proc = subprocess.Popen(
+            [command] + args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+            env=env or os.environ.copy()
+        )
+        self.connection_closed = False
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        threading.Thread(target=self._reader, daemon=True).start()
+        # An undrained stderr pipe eventually blocks the server once it fills up
+        threading.Thread(target=self._stderr_reader, daemon=True).start()
+
+    def _reader(self):
+        try:
+            for line in self.proc.stdout:
+                try:
+                    self._dispatch(line)
+                except Exception:
+                    # One bad message must not stop every later response from being delivered
+                    logging.exception(f"Failed to handle JSON-RPC message: {line.rstrip()[:200]}")
+        finally:
+            self.connection_closed = True
+            with self._pending_lock:
+                pending = list(self._pending.values())
+                self._pending.clear()
+            for future in pending:
+                if not future.done():
+                    future.set_exception(ConnectionError("JSON-RPC server process exited"))
+
+    def _dispatch(self, line):
+        line = line.strip()
+        if not line:
+            return
+        try:
+            msg = json.loads(line)
+        except Exception:
+            # ignore non-JSON logs
+            return
+        req_id = msg.get("id")
+        if req_id is None or "method" in msg:
+            # Server notifications and server-to-client requests aren't used
+            logging.debug(f"Ignoring server message: {msg}")
+            return
+        with self._pending_lock:
+            future = self._pending.pop(req_id, None)
+        if future is None:
+            # The caller timed out and gave up on this request
+            logging.warning(f"Discarding response for unknown request id {req_id}")
+            return
+        if future.done():
+            # Cancelled by a caller that stopped waiting before forgetting it
+            return
+        if "error" in msg:
+            future.set_exception(JsonRpcError(msg["error"]))
+        else:
+            future.set_result(msg.get("result"))
+
+    def _stderr_reader(self):
+        for line in self.proc.stderr:
+            logging.debug(f"server stderr: {line.rstrip()}")
+
+    def _write(self, message):
+        data = json.dumps(message) + "\n"
+        # Includes waiting for the pipe behind other writers
+        with tracing.span("jsonrpc.write"), self._write_lock:
+            self.proc.stdin.write(data)
+            self.proc.stdin.flush()
+
+    def is_alive(self):
+        return not self.connection_closed and self.proc.poll() is None
+
+    def send(self, method, params=None):
+        """
+        Send a request and return a concurrent.futures.Future for its result.
+        Raises RequestNotSentError when the request couldn't be written.
+        """
+        req_id = uuid.uuid4().hex
+        future = concurrent.futures.Future()
+        with self._pending_lock:
+            if self.connection_closed:
+                raise RequestNotSentError("JSON-RPC server process exited")
+            self._pending[req_id] = future
+        future.req_id = req_id
+        try:
+            self._write({"jsonrpc": "2.0", "id": req_id, "method": method, "params": params or {}})
+        except (OSError, ValueError) as e:
+            self._forget(req_id)
+            raise RequestNotSentError(f"Failed to write to JSON-RPC server: {str(e)}") from e
+        return future
+
+    def _forget(self, req_id):
+        with self._pending_lock:
+            self._pending.pop(req_id, None)
+
+    def request(self, method, params=None, timeout=None):
+        """Send a request and block until its response arrives or `timeout` seconds pass."""
+        timeout = timeout if timeout is not None else self.default_timeout
+        with tracing.span("jsonrpc.request", method=method):
+            future = self.send(method, params)
+            try:
+                return future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                self._forget(future.req_id)
+                raise TimeoutError(f"JSON-RPC request '{method}' timed out after {timeout} seconds")
+
+    async def arequest(self, method, params=None, timeout=None):
+        """asyncio version of `request`; many can be awaited concurrently."""
+        timeout = timeout if timeout is not None else self.default_timeout
+        with tracing.span("jsonrpc.request", method=method):
+            future = self.send(method, params)
+            try:
+                return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+            except asyncio.TimeoutError:
+                self._forget(future.req_id)
+                raise TimeoutError(f"JSON-RPC request '{method}' timed out after {timeout} seconds")
+            except asyncio.CancelledError:
+                self._forget(future.req_id)
+                raise
+
+    def notify(self, method, params=None):
+        """Send a notification, which has no id and gets no response."""
+        message = {"jsonrpc": "2.0", "method": method}
+        if params is not None:
+            message["params"] = params
+        self._write(message)
+
+    def initialize(self, client_name="photo-agent", timeout=30):
+        """Perform the MCP initialize handshake; servers reject tool calls before it."""
+        result = self.request("initialize", {
+            "protocolVersion": MCP_PROTOCOL_VERSION,
+            "capabilities": {},
+            "clientInfo": {"name": client_name, "version": "0.1.0"},
+        }, timeout=timeout)
+        self.notify("notifications/initialized")
+        return result
+
+    def ping(self, timeout=5):
+        """Round-trip an MCP ping; True if the server answered in time."""
+        try:
+            self.request("ping", timeout=timeout)
+            return True
+        except Exception:
+            return False
+
+    def call_tool(self, name, arguments=None, timeout=None):
+        """Call an MCP tool and return its unwrapped result."""
+        return unwrap_tool_result(self.request("tools/call", {"name": name, "arguments": arguments or {}}, timeout))
+
+    async def acall_tool(self, name, arguments=None, timeout=None):
+        return unwrap_tool_result(await self.arequest("tools/call", {"name": name, "arguments": arguments or {}}, timeout))
+
+    def close(self):
+        logging.info("Closing JSON-RPC server process")
+        try:
+            self.proc.stdin.close()
+            self.proc.terminate()
+        except Exception:
+            pass
+
+
+def unwrap_tool_result(result):
+    """
+    Turn an MCP CallToolResult into a plain value: structured content when the
+    tool returned data, otherwise the concatenated text content.
+    """
+    if not isinstance(result, dict) or "content" not in result:
+        return result
+    text = "\n".join(item.get("text", "") for item in result.get("content", []) if item.get("type") == "text")
+    if result.get("isError"):
+        raise JsonRpcError({"message": text or "Tool call failed"})
+    structured = result.get("structuredContent")
+    if structured is not None:
+        # FastMCP wraps non-object return values as {"result": value}
+        wrapped = result.get("_meta", {}).get("fastmcp", {}).get("wrap_result")
+        if wrapped or (wrapped is None and set(structured) == {"result"}):
+            return structured["result"]
+        return structured
+    return text
+
+
+def start_mcp_client(command, args=None, env=None, default_timeout=None, client_name="photo-agent"):
+    """Start an MCP server subprocess and complete the initialize handshake."""
+    client = JsonRpcClient(command, args, env=env, default_timeout=default_timeout)
+    try:
+        client.initialize(client_name)
+    except Exception:
+        client.close()
+        raise
+    return client
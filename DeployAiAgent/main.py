@@ -1,17 +1,35 @@
+import asyncio
+import json
+import logging
 import os
 import subprocess
-import uvicorn
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel, Field
 from typing import Optional, List
 from enum import Enum
 
-from photo_agent import run_agent
+from photo_agent import metrics_text, run_agent_async, stream_agent
+
+# Agents running at once; further requests wait in a bounded queue
+AGENT_MAX_CONCURRENCY = int(os.environ.get("AGENT_MAX_CONCURRENCY", "8"))
+# Requests allowed to wait for a free slot before new ones are rejected with 429
+AGENT_MAX_QUEUE = int(os.environ.get("AGENT_MAX_QUEUE", "32"))
+# Seconds a queued request waits for a slot before giving up with 503
+AGENT_QUEUE_TIMEOUT = float(os.environ.get("AGENT_QUEUE_TIMEOUT", "30"))
+# Seconds an agent run may take before the request fails with 504
+AGENT_TIMEOUT = float(os.environ.get("AGENT_TIMEOUT", "120"))
 
 app = FastAPI()
 templates = Jinja2Templates(directory="templates")
 
+agent_slots = asyncio.Semaphore(AGENT_MAX_CONCURRENCY)
+# Only touched from the event loop, so no lock is needed
+waiting_requests = 0
+# Timed-out agent runs still finishing in the background; asyncio keeps only weak references to tasks
+finishing_runs = set()
+
 # Request model for agent invocation
 class AgentRequest(BaseModel):
     """
@@ -26,6 +44,61 @@ class AgentResponse(BaseModel):
     """
     response: str
 
+def check_agent_queue():
+    """Reject with 429 when every slot is taken and the queue is already full."""
+    if agent_slots.locked() and waiting_requests >= AGENT_MAX_QUEUE:
+        raise HTTPException(status_code=429,
+                            detail="Too many requests are waiting for the agent, try again later.",
+                            headers={"Retry-After": "5"})
+
+async def acquire_agent_slot():
+    """
+    Wait for a free agent slot, applying backpressure: 429 when the queue is
+    already full, 503 when the slot doesn't free up within AGENT_QUEUE_TIMEOUT.
+    """
+    global waiting_requests
+    if not agent_slots.locked():
+        # A free slot is taken without suspending, so no queue bookkeeping
+        await agent_slots.acquire()
+        return
+    check_agent_queue()
+    waiting_requests += 1
+    try:
+        await asyncio.wait_for(agent_slots.acquire(), AGENT_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503,
+                            detail="The agent is busy, try again later.",
+                            headers={"Retry-After": str(int(AGENT_QUEUE_TIMEOUT))})
+    finally:
+        waiting_requests -= 1
+
+def release_agent_slot_when_done(task):
+    """
+    Free the agent slot once `task` has finished.  A run that timed out is
+    left to finish rather than cancelled: cancelling wouldn't stop the tool
+    and LLM work it started in threads, and freeing its slot early would let
+    more agents run than AGENT_MAX_CONCURRENCY allows.
+    """
+    if task.done():
+        agent_slots.release()
+        return
+
+    def finished(task):
+        finishing_runs.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Agent run failed after its request timed out: {task.exception()}")
+        agent_slots.release()
+
+    finishing_runs.add(task)
+    task.add_done_callback(finished)
+
+async def close_stream_after(step, stream):
+    """Wait for a pending step of `stream` to finish, then close the stream."""
+    await asyncio.wait({step})
+    if not step.cancelled() and not isinstance(step.exception(), (type(None), StopAsyncIteration)):
+        logging.error(f"Agent stream failed after its request timed out: {step.exception()}")
+    await stream.aclose()
+
 @app.get("/")
 async def home(request: Request):
     """
@@ -36,17 +109,91 @@ async def home(request: Request):
 @app.post("/agent", response_model=AgentResponse)
 async def invoke_agent(request: AgentRequest):
     """
-    Endpoint to invoke the AI agent with a user prompt.    
+    Endpoint to invoke the AI agent with a user prompt.
     """
+    if not request.prompt.strip():
+        raise HTTPException(status_code=400, detail="Prompt cannot be empty.")
+
+    await acquire_agent_slot()
+    # Run the agent with the user's prompt without blocking the event loop
+    run = asyncio.ensure_future(run_agent_async(request.prompt))
+    try:
+        await asyncio.wait({run}, timeout=AGENT_TIMEOUT)
+    finally:
+        release_agent_slot_when_done(run)
+    if not run.done():
+        raise HTTPException(status_code=504, detail=f"Agent did not respond within {AGENT_TIMEOUT:g} seconds.")
     try:
-        if not request.prompt.strip():
-            raise HTTPException(status_code=400, detail="Prompt cannot be empty.")
-        
-        # Run the agent with the user's prompt
-        response = run_agent(request.prompt)
-        return AgentResponse(response=response)
-        
+        return AgentResponse(response=run.result())
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error invoking agent: {str(e)}")
-    
-uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Latency histograms and counters of the agent, MCP client and photo tools
+    in the Prometheus text format.
+    """
+    return PlainTextResponse(await asyncio.to_thread(metrics_text), media_type="text/plain; version=0.0.4")
+
+def sse_event(event):
+    """Format an agent event as a Server-Sent Events message."""
+    return f"event: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
+
+@app.post("/agent/stream")
+async def stream_agent_endpoint(request: AgentRequest):
+    """
+    Endpoint to invoke the AI agent and stream its progress as Server-Sent
+    Events: start, tool_start/tool_end and token events as they happen, then
+    a final event with the whole response, or an error event.
+    """
+    if not request.prompt.strip():
+        raise HTTPException(status_code=400, detail="Prompt cannot be empty.")
+
+    # A full queue is still refused with a status code; the slot itself is
+    # taken inside events(), because a client that disconnects before the
+    # body is iterated would otherwise never give it back
+    check_agent_queue()
+
+    async def events():
+        try:
+            await acquire_agent_slot()
+        except HTTPException as e:
+            yield sse_event({"type": "error", "detail": e.detail})
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + AGENT_TIMEOUT
+        stream = stream_agent(request.prompt)
+        step = None
+        try:
+            # Sent before any agent work so the client sees bytes immediately
+            yield sse_event({"type": "start"})
+            while True:
+                # Waited on rather than wait_for: a timed-out step keeps running, see release_agent_slot_when_done
+                step = asyncio.ensure_future(stream.__anext__())
+                await asyncio.wait({step}, timeout=max(0.0, deadline - loop.time()))
+                if not step.done():
+                    yield sse_event({"type": "error", "detail": f"Agent did not respond within {AGENT_TIMEOUT:g} seconds."})
+                    break
+                try:
+                    event = step.result()
+                except StopAsyncIteration:
+                    break
+                yield sse_event(event)
+        finally:
+            if step is not None and not step.done():
+                release_agent_slot_when_done(asyncio.ensure_future(close_stream_after(step, stream)))
+            else:
+                try:
+                    await stream.aclose()
+                finally:
+                    agent_slots.release()
+
+    return StreamingResponse(events(),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+if __name__ == "__main__":
+    # Only needed to serve locally; Vercel imports `app` and never pays for uvicorn
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=8000)
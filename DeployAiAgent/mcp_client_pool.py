@@ -0,0 +1,148 @@
+import atexit
+import concurrent.futures
+import logging
+import threading
+
+from jsonrpc_client import RequestNotSentError
+import tracing
+
+
+class McpClientPool:
+    """
+    A fixed-size pool of long-lived MCP server processes shared across agent requests.
+
+    Clients multiplex many in-flight requests, so they are shared rather than
+    checked out: each call goes to the next client in round-robin order.  Dead
+    servers are replaced when picked, and a supervisor thread pings the servers
+    and restarts crashed ones in the background so that requests find warm
+    processes instead of paying for interpreter and import startup.
+
+    A call is sent again to another server only when it never reached the
+    first one, or when it is a tool listed in `idempotent_tools`: a server
+    that died mid-call may already have moved or tagged a photo.
+    """
+
+    def __init__(self, factory, size=2, health_check_interval=30.0, idempotent_tools=()):
+        if size < 1:
+            raise ValueError("Pool size must be at least 1")
+        self._factory = factory
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self.idempotent_tools = frozenset(idempotent_tools)
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._next = 0
+        self._restarting = {}  # slot -> Future of the replacement being started
+        self._clients = [factory() for _ in range(size)]
+
+        self._supervisor = threading.Thread(target=self._supervise, name="mcp-pool-supervisor", daemon=True)
+        self._supervisor.start()
+        atexit.register(self.close)
+
+    @staticmethod
+    def is_healthy(client):
+        return client.is_alive()
+
+    def _replace(self, slot, client):
+        """
+        Replace `client` in `slot` unless another thread already did, or wait
+        for the replacement another thread is starting.  The new server is
+        started outside the lock, so calls to other slots aren't held up by
+        its startup.
+        """
+        with self._lock:
+            if self._clients[slot] is not client:
+                return self._clients[slot]
+            restart = self._restarting.get(slot)
+            starting = restart is None
+            if starting:
+                restart = self._restarting[slot] = concurrent.futures.Future()
+        if not starting:
+            return restart.result()
+
+        logging.warning("Restarting MCP server process")
+        try:
+            client.close()
+            replacement = self._factory()
+        except BaseException as e:
+            with self._lock:
+                del self._restarting[slot]
+            restart.set_exception(e)
+            raise
+        with self._lock:
+            del self._restarting[slot]
+            closed = self._closed.is_set()
+            if not closed:
+                self._clients[slot] = replacement
+                self.restarts += 1
+        if closed:
+            # close() ran while the replacement was starting and won't see it
+            replacement.close()
+            error = RuntimeError("MCP client pool is closed")
+            restart.set_exception(error)
+            raise error
+        tracing.increment("mcp.server_restart")
+        restart.set_result(replacement)
+        return replacement
+
+    def _supervise(self):
+        while not self._closed.wait(self.health_check_interval):
+            for slot, client in enumerate(list(self._clients)):
+                if self._closed.is_set():
+                    return
+                if self.is_healthy(client) and client.ping():
+                    continue
+                try:
+                    self._replace(slot, client)
+                except Exception as e:
+                    logging.error(f"Failed to restart MCP server process: {str(e)}")
+
+    def client(self):
+        """Return a healthy client, restarting the selected server if it has died."""
+        if self._closed.is_set():
+            raise RuntimeError("MCP client pool is closed")
+        with self._lock:
+            slot = self._next
+            self._next = (self._next + 1) % self.size
+            client = self._clients[slot]
+        if not self.is_healthy(client):
+            client = self._replace(slot, client)
+        return client
+
+    def _with_retry(self, call, idempotent=False):
+        """
+        Run `call(client)`, retrying once on a live process if the server was
+        dead before the request was written, or died mid-call and `idempotent`.
+        """
+        try:
+            return call(self.client())
+        except RequestNotSentError as e:
+            logging.warning(f"MCP request couldn't be sent to a dead server, retrying: {str(e)}")
+        except ConnectionError as e:
+            if not idempotent:
+                raise
+            logging.warning(f"MCP request failed on a dead server, retrying: {str(e)}")
+        return call(self.client())
+
+    def request(self, method, params=None, timeout=None):
+        return self._with_retry(lambda client: client.request(method, params, timeout))
+
+    def call_tool(self, name, arguments=None, timeout=None):
+        return self._with_retry(lambda client: client.call_tool(name, arguments, timeout),
+                                idempotent=name in self.idempotent_tools)
+
+    def call_tool_on_each(self, name, arguments=None, timeout=None):
+        """Call a tool on every live server, e.g. to collect per-process stats; dead servers are skipped."""
+        with self._lock:
+            clients = list(self._clients)
+        return [client.call_tool(name, arguments, timeout) for client in clients if self.is_healthy(client)]
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            client.close()
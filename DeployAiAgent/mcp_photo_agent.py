@@ -1,62 +1,17 @@
 # mcp_photo_agent.py
 # Usage:
-#   python mcp_photo_agent.py --server "python" --args "photo_server.py" --folder "C:\\Users\\Chris\\OneDrive\\Pictures" --action organize
+#   python mcp_photo_agent.py --server "python" --args "photo_mcp_server.py" --folder "C:\\Users\\Chris\\OneDrive\\Pictures" --action organize
+#   add --dry-run to only print the plan; an interrupted organize of the same --folder resumes from --journal
 
 import argparse
-import json
-import subprocess
-import threading
-import queue
-import uuid
 import os
+import sys
+import time
 
-# --- Simple JSON-RPC client over stdio ---
-class JsonRpcClient:
-    def __init__(self, command, args=None, env=None):
-        if args is None:
-            args = []
-        self.proc = subprocess.Popen(
-            [command] + args,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            bufsize=1,
-            env=env or os.environ.copy()
-        )
-        self.responses = queue.Queue()
-        threading.Thread(target=self._reader, daemon=True).start()
-
-    def _reader(self):
-        for line in self.proc.stdout:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                msg = json.loads(line)
-                self.responses.put(msg)
-            except Exception:
-                # ignore non-JSON logs
-                pass
-
-    def request(self, method, params=None):
-        req_id = uuid.uuid4().hex
-        req = {"jsonrpc": "2.0", "id": req_id, "method": method, "params": params or {}}
-        self.proc.stdin.write(json.dumps(req) + "\n")
-        self.proc.stdin.flush()
-        while True:
-            resp = self.responses.get()
-            if resp.get("id") == req_id:
-                if "error" in resp:
-                    raise Exception(resp["error"]["message"])
-                return resp.get("result")
-
-    def close(self):
-        try:
-            self.proc.stdin.close()
-            self.proc.terminate()
-        except Exception:
-            pass
+from jsonrpc_client import JsonRpcClient, start_mcp_client
+from photo_organizer import MoveJournal, apply_moves, pending_moves, plan_moves
+
+DEFAULT_JOURNAL_PATH = "organize-journal.jsonl"
 
 
 # --- Agent wrapper for photo tools ---
@@ -65,49 +20,69 @@ class PhotoOrganizerAgent:
         self.client = client
 
     def list_photos(self, folder):
-        return self.client.request("tools/call", {
-            "name": "list_photos",
-            "arguments": {"folder": folder}
-        })
+        return self.client.call_tool("list_photos", {"folder": folder})
 
     def tag_photo(self, file, tags):
-        return self.client.request("tools/call", {
-            "name": "tag_photo",
-            "arguments": {"file": file, "tags": tags}
-        })
+        return self.client.call_tool("tag_photo", {"file": file, "tags": tags})
 
     def move_photo(self, file, destination):
-        return self.client.request("tools/call", {
-            "name": "move_photo",
-            "arguments": {"file": file, "destination": destination}
-        })
-
-    def organize_by_date(self, folder):
-        files = self.list_photos(folder)
-        for f in files:
-            meta = self.client.request("tools/call", {
-                "name": "get_exif",
-                "arguments": {"file": f}
-            })
-            date_str = meta.get("dateOriginal") or meta.get("date")
-            if not date_str:
-                continue
-            from datetime import datetime
-            d = datetime.fromisoformat(date_str)
-            dest = os.path.join(folder, str(d.year), f"{d.month:02d}")
-            self.move_photo(f, dest)
+        return self.client.call_tool("move_photo", {"file": file, "destination": destination})
+
+    def get_exif(self, file):
+        return self.client.call_tool("get_exif", {"file": file})
+
+    def list_photo_records(self, folder):
+        return self.client.call_tool("get_photo_catalog_records", {"folder": folder})
+
+    def move_photos(self, moves, max_workers=8):
+        return self.client.call_tool("move_photos", {"moves": moves, "max_workers": max_workers})
+
+    def organize_by_date(self, folder, dry_run=False, journal_path=DEFAULT_JOURNAL_PATH, workers=8, batch_size=500):
+        """
+        File photos into folder/year/month in two phases: plan every move from
+        one batched metadata call, then apply the plan in batches of parallel
+        moves, journaling progress so an interrupted run resumes where it stopped.
+        """
+        journal = MoveJournal(journal_path)
+        moves = pending_moves(journal, folder)
+        if moves:
+            print(f"Resuming {len(moves)} pending moves from {journal_path}")
+        else:
+            moves, skipped = plan_moves(self.list_photo_records(folder), folder)
+            print(f"Planned {len(moves)} moves ({skipped['in_place']} already in place, "
+                  f"{skipped['no_date']} without a capture date)")
+            if not dry_run:
+                journal.start(moves, folder)
+
+        if dry_run:
+            for move in moves:
+                print(f" - {move['source']} -> {move['target']}")
+            return 0, 0
+
+        def progress(done, total):
+            print(f"\r{done}/{total} moved", end="", flush=True)
+
+        moved, failed = apply_moves(lambda batch: self.move_photos(batch, workers), moves, journal,
+                                    batch_size=batch_size, progress=progress)
+        if moves:
+            print()
+        return moved, failed
 
 
 # --- CLI glue ---
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--server", default="python", help="Server command")
-    parser.add_argument("--args", default="photo_server.py", help="Server args")
+    parser.add_argument("--args", default="photo_mcp_server.py", help="Server args")
     parser.add_argument("--folder", default=os.path.expanduser("~/Pictures"))
     parser.add_argument("--action", choices=["list", "organize"], default="list")
+    parser.add_argument("--dry-run", action="store_true", help="Print the organize plan without moving anything")
+    parser.add_argument("--journal", default=DEFAULT_JOURNAL_PATH, help="Resumable organize journal")
+    parser.add_argument("--workers", type=int, default=8, help="Parallel moves per batch")
+    parser.add_argument("--batch-size", type=int, default=500, help="Moves per server call")
     args = parser.parse_args()
 
-    client = JsonRpcClient(args.server, args.args.split())
+    client = start_mcp_client(args.server, args.args.split())
     agent = PhotoOrganizerAgent(client)
 
     try:
@@ -117,8 +92,19 @@ def main():
             for f in files:
                 print(" -", f)
         elif args.action == "organize":
-            agent.organize_by_date(args.folder)
-            print("Organized photos by date.")
+            start = time.perf_counter()
+            try:
+                moved, failed = agent.organize_by_date(args.folder,
+                                                       dry_run=args.dry_run,
+                                                       journal_path=args.journal,
+                                                       workers=args.workers,
+                                                       batch_size=args.batch_size)
+            except ValueError as e:
+                sys.exit(str(e))
+            if not args.dry_run:
+                print(f"Organized photos by date: {moved} moved, {failed} failed in {time.perf_counter() - start:.1f}s.")
+                if failed:
+                    print(f"Run again to retry the failed moves recorded in {args.journal}.")
     finally:
         client.close()
 
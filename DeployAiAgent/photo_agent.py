@@ -1,113 +1,278 @@
-from langchain_openai import ChatOpenAI
-from langchain_core.tools import tool
-from langchain.agents import create_agent
 from dotenv import load_dotenv
-import subprocess
-import queue
-import threading
-import uuid
-import json
+from intent_router import IntentRouter
+import tracing
+import asyncio
 import sys
 import os
 import logging
+import threading
 
 
 load_dotenv()  # Load environment variables from .env file
 
 logging.basicConfig(level=logging.INFO, filename='photo_agent.log', filemode='a')
 
-# --- Simple JSON-RPC client over stdio ---
-class JsonRpcClient:
-    def __init__(self, command, args=None):
-        if args is None:
-            args = []
-        logging.info(f"Starting MCP server process: {command} {' '.join(args)}")
-        self.proc = subprocess.Popen(
-            [command] + args,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            bufsize=1,
-            env=os.environ.copy()
-        )
-        self.responses = queue.Queue()
-        threading.Thread(target=self._reader, daemon=True).start()
-
-    def _reader(self):
-        for line in self.proc.stdout:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                msg = json.loads(line)
-                self.responses.put(msg)
-                logging.info(f"Received message: {msg}")
-            except Exception:
-                # ignore non-JSON logs
-                pass
-
-    def request(self, method, params=None):
-        req_id = uuid.uuid4().hex
-        req = {"jsonrpc": "2.0", "id": req_id, "method": method, "params": params or {}}
-        logging.info(f"Sending request: {req}")
-        self.proc.stdin.write(json.dumps(req) + "\n")
-        self.proc.stdin.flush()
-        while True:
-            resp = self.responses.get()
-            if resp.get("id") == req_id:
-                if "error" in resp:
-                    logging.error(f"Error in response: {resp['error']}")
-                    raise Exception(resp["error"]["message"])
-                logging.info(f"Received response: {resp}")
-                return resp.get("result")
+PHOTO_MCP_SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "photo_mcp_server.py")
+MCP_POOL_SIZE = int(os.environ.get("PHOTO_MCP_POOL_SIZE", "2"))
+MCP_HEALTH_CHECK_INTERVAL = float(os.environ.get("PHOTO_MCP_HEALTH_CHECK_INTERVAL", "30"))
+MCP_TOOL_TIMEOUT = float(os.environ.get("PHOTO_MCP_TOOL_TIMEOUT", "120"))
+# Set to 0 to send every prompt to the LLM, even ones the intent router can answer
+INTENT_ROUTER_ENABLED = os.environ.get("AGENT_INTENT_ROUTER", "1") != "0"
+TOOL_BACKEND_SUBPROCESS = "subprocess"
+TOOL_BACKEND_INPROCESS = "inprocess"
+# inprocess calls the photo tools in this process instead of spawning MCP servers,
+# which is what a serverless cold start wants (Vercel sets VERCEL=1)
+TOOL_BACKEND = os.environ.get("PHOTO_TOOL_BACKEND",
+                              TOOL_BACKEND_INPROCESS if os.environ.get("VERCEL") else TOOL_BACKEND_SUBPROCESS)
+if TOOL_BACKEND not in (TOOL_BACKEND_SUBPROCESS, TOOL_BACKEND_INPROCESS):
+    raise ValueError(f"Unknown PHOTO_TOOL_BACKEND: {TOOL_BACKEND!r}")
+# Tools that are safe to run again on another server when one dies mid-call;
+# tag_photo, move_photo and move_photos may already have taken effect
+IDEMPOTENT_TOOLS = ("get_location_name_from_gps_coords", "get_location_names_from_gps_coords", "get_geocode_cache_stats",
+                    "get_image_location_metadata", "get_folder_location_metadata", "list_photos",
+                    "get_photo_catalog_records", "get_exif", "detect_objects_in_image", "find_duplicate_photos",
+                    "search_photos", "get_metrics")
+
+# Built on first use, so importing this module (and main.py) stays cheap:
+# langchain, the OpenAI client and the MCP server processes cost seconds
+_tool_backend = None
+_llm = None
+_agent = None
+_init_lock = threading.Lock()
+
+
+class InProcessToolBackend:
+    """
+    Calls the photo_mcp_server tool functions directly, with the same
+    call_tool interface as McpClientPool.  Tools share this process, so
+    a crash takes the app down with it and `timeout` is not enforced.
+    """
+
+    def __init__(self):
+        from photo_mcp_server import TOOLS
+        self._tools = TOOLS
+
+    def call_tool(self, name, arguments=None, timeout=None):
+        if name not in self._tools:
+            raise ValueError(f"Unknown tool: {name}")
+        return self._tools[name](**(arguments or {}))
 
     def close(self):
-        logging.info("Closing MCP server process")
-        try:
-            self.proc.stdin.close()
-            self.proc.terminate()
-        except Exception:
-            pass
+        pass
 
 
-# Start the MCP server
-client = JsonRpcClient(sys.executable, ["photo_mcp_server.py"])
+def get_tool_backend():
+    global _tool_backend
+    if _tool_backend is None:
+        with _init_lock:
+            if _tool_backend is None:
+                if TOOL_BACKEND == TOOL_BACKEND_INPROCESS:
+                    _tool_backend = InProcessToolBackend()
+                else:
+                    from jsonrpc_client import start_mcp_client
+                    from mcp_client_pool import McpClientPool
+                    # Long-lived MCP servers shared by every agent request
+                    _tool_backend = McpClientPool(
+                        lambda: start_mcp_client(sys.executable, [PHOTO_MCP_SERVER_PATH], default_timeout=MCP_TOOL_TIMEOUT),
+                        size=MCP_POOL_SIZE,
+                        health_check_interval=MCP_HEALTH_CHECK_INTERVAL,
+                        idempotent_tools=IDEMPOTENT_TOOLS,
+                    )
+    return _tool_backend
+
+def call_tool(name, arguments=None):
+    with tracing.span("tool.client", tool=name):
+        return get_tool_backend().call_tool(name, arguments)
+
+def metrics_text():
+    """
+    Prometheus text for /metrics: this process's spans, plus those of every
+    running MCP server when tools run in subprocesses.  Scraping never
+    starts the tool backend.
+    """
+    snapshots = [({"process": "agent"}, tracing.snapshot())]
+    backend = _tool_backend
+    if backend is not None and hasattr(backend, "call_tool_on_each"):
+        try:
+            for server_snapshot in backend.call_tool_on_each("get_metrics", timeout=5):
+                snapshots.append(({"process": "mcp_server"}, server_snapshot))
+        except Exception as e:
+            logging.error(f"Failed to collect MCP server metrics: {str(e)}")
+    return tracing.render_prometheus(snapshots)
 
-@tool
 def get_location_name_from_gps_coords(latitude: float, longitude: float) -> str:
     """Get location name from GPS coordinates using Nominatim API"""
     logging.info(f"Calling get_location_name_from_gps_coords with lat: {latitude}, lon: {longitude}")
-    return client.request("tools/call", {"name": "get_location_name_from_gps_coords", "arguments": {"latitude": latitude, "longitude": longitude}})
+    return call_tool("get_location_name_from_gps_coords", {"latitude": latitude, "longitude": longitude})
     
-@tool
 def get_image_location_metadata(filepath: str) -> str:
     """Get image location metadata from a file using ExifRead"""
     logging.info(f"Calling get_image_location_metadata for file: {filepath}")
-    return client.request("tools/call", {"name": "get_image_location_metadata", "arguments": {"filepath": filepath}})
+    return call_tool("get_image_location_metadata", {"filepath": filepath})
+
+def get_folder_location_metadata(folder: str, recursive: bool = True) -> list:
+    """Get GPS location and capture time for every photo in a folder in one call"""
+    logging.info(f"Calling get_folder_location_metadata for folder: {folder}")
+    return call_tool("get_folder_location_metadata", {"folder": folder, "recursive": recursive})
 
-TOOLS = [get_location_name_from_gps_coords, get_image_location_metadata]
+def search_photos(query: str, folder: str | None = None, limit: int = 20) -> list:
+    """Find photos matching a free-text description like "beach photos with dogs", best match first"""
+    logging.info(f"Calling search_photos for: {query}")
+    return call_tool("search_photos", {"query": query, "folder": folder, "limit": limit})
+
+# Wrapped as LangChain tools when the agent is built
+TOOL_FUNCTIONS = [get_location_name_from_gps_coords, get_image_location_metadata, get_folder_location_metadata,
+                  search_photos]
 SYSTEM_MESSAGE = """
 You are a helpful photo agent.  You have a cute name and you love to tell everyone your name.
 You can read images and find out where they were taken.
 Be concise and helpful.
 """
-llm = ChatOpenAI(temperature=0, model="gpt-4")
-agent = create_agent(llm, TOOLS, system_prompt=SYSTEM_MESSAGE)
+
+def _llm_span_callbacks():
+    """LangChain callbacks that time every chat model call as an llm.call span and count its tokens."""
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class LlmSpanHandler(BaseCallbackHandler):
+        # Called in the caller's context, so spans nest under the current agent.run
+        run_inline = True
+
+        def __init__(self):
+            self.spans = {}
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+            self.spans[run_id] = tracing.span("llm.call")
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            span = self.spans.pop(run_id, None)
+            if span is not None:
+                span.end()
+            usage = (response.llm_output or {}).get("token_usage") or {}
+            for kind in ("prompt", "completion"):
+                if usage.get(f"{kind}_tokens"):
+                    tracing.increment("llm.tokens", usage[f"{kind}_tokens"], kind=kind)
+
+        def on_llm_error(self, error, *, run_id, **kwargs):
+            span = self.spans.pop(run_id, None)
+            if span is not None:
+                span.end(error)
+
+    return [LlmSpanHandler()]
+
+def get_llm():
+    global _llm
+    if _llm is None:
+        with _init_lock:
+            if _llm is None:
+                from langchain_openai import ChatOpenAI
+                _llm = ChatOpenAI(temperature=0, model="gpt-4", callbacks=_llm_span_callbacks())
+    return _llm
+
+def get_agent():
+    global _agent
+    if _agent is None:
+        llm = get_llm()
+        with _init_lock:
+            if _agent is None:
+                from langchain.agents import create_agent
+                from langchain_core.tools import tool
+                _agent = create_agent(llm, [tool(function) for function in TOOL_FUNCTIONS], system_prompt=SYSTEM_MESSAGE)
+    return _agent
+
+# Answers common prompts with direct tool calls, so those never load the LLM stack
+router = IntentRouter(call_tool) if INTENT_ROUTER_ENABLED else None
+# Tool results are cut to this many characters in streamed progress events
+STREAM_TOOL_OUTPUT_CHARS = 500
 
 def run_agent(user_input: str) -> str:
     """Run the agent with a user query and return the response."""
     logging.info(f"Running agent with input: {user_input}")
-    try:
-        result = agent.invoke(
-            {"messages": [{"role": "user", "content": user_input}]},
-            config={"recursion_limit": 50}
-        )
-        response = result["messages"][-1].content
-        logging.info(f"Agent response: {response}")
-        return response
-    except Exception as e:
-        logging.error(f"Error running agent: {str(e)}")
-        return f"Error {str(e)}"
-    finally:
-        client.close()
\ No newline at end of file
+    with tracing.trace("agent.run", mode="sync") as run_span:
+        routed = router.route(user_input) if router else None
+        if routed is not None:
+            tracing.increment("agent.route", route="router")
+            return routed
+        tracing.increment("agent.route", route="llm")
+        try:
+            result = get_agent().invoke(
+                {"messages": [{"role": "user", "content": user_input}]},
+                config={"recursion_limit": 50}
+            )
+            response = result["messages"][-1].content
+            logging.info(f"Agent response: {response}")
+            return response
+        except Exception as e:
+            run_span.record_error(e)
+            logging.error(f"Error running agent: {str(e)}")
+            return f"Error {str(e)}"
+
+async def run_agent_async(user_input: str) -> str:
+    """Async version of run_agent that awaits the LLM instead of blocking the event loop."""
+    logging.info(f"Running agent with input: {user_input}")
+    with tracing.trace("agent.run", mode="async") as run_span:
+        routed = await asyncio.to_thread(router.route, user_input) if router else None
+        if routed is not None:
+            tracing.increment("agent.route", route="router")
+            return routed
+        tracing.increment("agent.route", route="llm")
+        try:
+            result = await get_agent().ainvoke(
+                {"messages": [{"role": "user", "content": user_input}]},
+                config={"recursion_limit": 50}
+            )
+            response = result["messages"][-1].content
+            logging.info(f"Agent response: {response}")
+            return response
+        except Exception as e:
+            run_span.record_error(e)
+            logging.error(f"Error running agent: {str(e)}")
+            return f"Error {str(e)}"
+
+async def stream_agent(user_input: str):
+    """
+    Run the agent and yield progress events as they happen: tool_start and
+    tool_end around each tool call, token for each piece of LLM text, then
+    final with the whole response, or error.
+    """
+    logging.info(f"Streaming agent with input: {user_input}")
+    with tracing.trace("agent.run", mode="stream") as run_span:
+        matched = router.match(user_input) if router else None
+        if matched is not None:
+            tracing.increment("agent.route", route="router")
+            intent, path, _ = matched
+            yield {"type": "tool_start", "name": intent, "input": {"path": path}}
+            # The consumer may resume this generator in another task
+            run_span.activate()
+            response = await asyncio.to_thread(router.route, user_input)
+            yield {"type": "tool_end", "name": intent, "output": (response or "")[:STREAM_TOOL_OUTPUT_CHARS]}
+            yield {"type": "final", "response": response}
+            return
+        tracing.increment("agent.route", route="llm")
+        response = ""
+        try:
+            async for event in get_agent().astream_events(
+                {"messages": [{"role": "user", "content": user_input}]},
+                config={"recursion_limit": 50},
+                version="v2",
+            ):
+                kind = event["event"]
+                if kind == "on_chat_model_stream":
+                    text = event["data"]["chunk"].text
+                    if text:
+                        yield {"type": "token", "text": text}
+                elif kind == "on_chat_model_end":
+                    message = event["data"]["output"]
+                    if not message.tool_calls:
+                        response = message.text
+                elif kind == "on_tool_start":
+                    yield {"type": "tool_start", "name": event["name"], "input": event["data"].get("input")}
+                elif kind == "on_tool_end":
+                    output = event["data"].get("output")
+                    output = str(getattr(output, "content", output))
+                    yield {"type": "tool_end", "name": event["name"], "output": output[:STREAM_TOOL_OUTPUT_CHARS]}
+            logging.info(f"Agent response: {response}")
+            yield {"type": "final", "response": response}
+        except Exception as e:
+            run_span.record_error(e)
+            logging.error(f"Error running agent: {str(e)}")
+            yield {"type": "error", "detail": f"Error {str(e)}"}
@@ -0,0 +1,349 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from exif_reader import PHOTO_EXTENSIONS, read_photo_metadata
+
+DEFAULT_CATALOG_PATH = "./photo-catalog.sqlite"
+
+_HASH_BLOCK_SIZE = 1 << 20
+_METADATA_FIELDS = ("date_original", "latitude", "longitude", "altitude")
+# Re-indexing a changed file keeps its tags
+_UPSERT_PHOTO = """
+    INSERT INTO photos (path, folder, size, mtime_ns, sha256, date_original, latitude, longitude, altitude, indexed_at)
+    VALUES (:path, :folder, :size, :mtime_ns, :sha256, :date_original, :latitude, :longitude, :altitude, :indexed_at)
+    ON CONFLICT (path) DO UPDATE SET
+        size = excluded.size, mtime_ns = excluded.mtime_ns, sha256 = excluded.sha256,
+        date_original = excluded.date_original, latitude = excluded.latitude,
+        longitude = excluded.longitude, altitude = excluded.altitude, indexed_at = excluded.indexed_at
+"""
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _prefix_range(folder):
+    """Bounds such that lo <= path < hi selects everything below `folder`."""
+    prefix = folder.rstrip(os.sep) + os.sep
+    return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+
+class PhotoCatalog:
+    """
+    Persistent SQLite index of photos: path, size, mtime, optional content
+    hash, EXIF capture date, GPS position and user tags.
+
+    `refresh` brings a folder tree up to date incrementally.  A directory
+    whose mtime hasn't changed since the last scan has had no files added,
+    removed or renamed, so its stored listing is trusted and only its
+    subdirectories are visited.  Changed directories are re-listed and only
+    new or modified files (by size and mtime) have their EXIF header read.
+    Edits that rewrite a file in place don't touch the directory mtime;
+    pass verify=True to re-stat every file.
+    """
+
+    def __init__(self, db_path=DEFAULT_CATALOG_PATH, hash_files=False, max_workers=16):
+        self.db_path = db_path
+        self.hash_files = hash_files
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS photos (
+                path TEXT PRIMARY KEY,
+                folder TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT,
+                date_original TEXT,
+                latitude REAL,
+                longitude REAL,
+                altitude REAL,
+                tags TEXT NOT NULL DEFAULT '[]',
+                indexed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS photos_folder ON photos (folder);
+            CREATE TABLE IF NOT EXISTS folders (
+                path TEXT PRIMARY KEY,
+                parent TEXT NOT NULL,
+                mtime_ns INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS folders_parent ON folders (parent);
+        """)
+        self._conn.commit()
+
+    # --- Indexing ---
+
+    def _known_folders(self, root):
+        lo, hi = _prefix_range(root)
+        rows = self._conn.execute("SELECT path, parent, mtime_ns FROM folders"
+                                  " WHERE path = ? OR (path >= ? AND path < ?)", (root, lo, hi))
+        mtimes, children = {}, {}
+        for path, parent, mtime_ns in rows:
+            mtimes[path] = mtime_ns
+            children.setdefault(parent, []).append(path)
+        return mtimes, children
+
+    def _read_file(self, path, stat):
+        row = {"path": path, "folder": os.path.dirname(path), "size": stat.st_size,
+               "mtime_ns": stat.st_mtime_ns, "sha256": None}
+        row.update(dict.fromkeys(_METADATA_FIELDS))
+        try:
+            metadata = read_photo_metadata(path)
+            row.update({field: metadata[field] for field in _METADATA_FIELDS})
+            if self.hash_files:
+                row["sha256"] = file_sha256(path)
+        except Exception as e:
+            # Keep the row so an unreadable file isn't retried until it changes
+            logging.warning(f"Could not read metadata from {path}: {str(e)}")
+        return row
+
+    def refresh(self, root, recursive=True, verify=False):
+        """
+        Bring the catalog up to date for `root`.  Returns counts of folders
+        re-listed, photos (re)indexed and photos removed.
+        """
+        root = os.path.abspath(root)
+        with self._lock:
+            known_mtimes, known_children = self._known_folders(root)
+
+        to_index = []
+        removed_files = []
+        removed_folders = []
+        folder_rows = []
+        stats = {"folders_scanned": 0, "indexed": 0, "removed": 0}
+
+        stack = [root]
+        while stack:
+            folder = stack.pop()
+            try:
+                mtime_ns = os.stat(folder).st_mtime_ns
+            except OSError:
+                removed_folders.append(folder)
+                continue
+
+            if not verify and known_mtimes.get(folder) == mtime_ns:
+                if recursive:
+                    stack.extend(known_children.get(folder, []))
+                continue
+
+            stats["folders_scanned"] += 1
+            with self._lock:
+                stored = {path: (size, mtime) for path, size, mtime in self._conn.execute(
+                    "SELECT path, size, mtime_ns FROM photos WHERE folder = ?", (folder,))}
+            subfolders = []
+            present = set()
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            subfolders.append(entry.path)
+                        elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in PHOTO_EXTENSIONS:
+                            present.add(entry.path)
+                            stat = entry.stat()
+                            if stored.get(entry.path) != (stat.st_size, stat.st_mtime_ns):
+                                to_index.append((entry.path, stat))
+            except OSError as e:
+                logging.warning(f"Could not list {folder}: {str(e)}")
+                continue
+
+            removed_files.extend(path for path in stored if path not in present)
+            removed_folders.extend(path for path in known_children.get(folder, []) if path not in subfolders)
+            folder_rows.append((folder, os.path.dirname(folder), mtime_ns))
+            # Placeholder rows make sure subfolders that aren't scanned now (non-recursive
+            # refresh, listing errors) are still visited once their parent is unchanged
+            folder_rows.extend((path, folder, -1) for path in subfolders if path not in known_mtimes)
+            if recursive:
+                stack.extend(subfolders)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            rows = list(executor.map(lambda item: self._read_file(*item), to_index))
+
+        now = time.time()
+        with self._lock:
+            for folder in removed_folders:
+                lo, hi = _prefix_range(folder)
+                cursor = self._conn.execute("DELETE FROM photos WHERE folder = ? OR (folder >= ? AND folder < ?)",
+                                            (folder, lo, hi))
+                stats["removed"] += cursor.rowcount
+                self._conn.execute("DELETE FROM folders WHERE path = ? OR (path >= ? AND path < ?)", (folder, lo, hi))
+            self._conn.executemany("DELETE FROM photos WHERE path = ?", [(path,) for path in removed_files])
+            stats["removed"] += len(removed_files)
+            self._conn.executemany(_UPSERT_PHOTO, [dict(row, indexed_at=now) for row in rows])
+            stats["indexed"] = len(rows)
+            self._conn.executemany("INSERT OR REPLACE INTO folders VALUES (?, ?, ?)", folder_rows)
+            self._conn.commit()
+        if stats["indexed"] or stats["removed"]:
+            logging.info(f"Refreshed photo catalog for {root}: {stats}")
+        return stats
+
+    def refresh_file(self, path):
+        """Re-index a single file if its size or mtime changed; returns its record."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        record = self.get(path)
+        if record is None or (record["size"], record["mtime_ns"]) != (stat.st_size, stat.st_mtime_ns):
+            row = self._read_file(path, stat)
+            with self._lock:
+                self._conn.execute(_UPSERT_PHOTO, dict(row, indexed_at=time.time()))
+                self._conn.commit()
+            record = self.get(path)
+        return record
+
+    # --- Queries ---
+
+    @staticmethod
+    def _record(row):
+        record = dict(row)
+        record["tags"] = json.loads(record["tags"])
+        return record
+
+    def get(self, path):
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            row = cursor.execute("SELECT * FROM photos WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        return self._record(row) if row else None
+
+    def _select(self, columns, folder, recursive, tag):
+        folder = os.path.abspath(folder)
+        where, params = "folder = ?", [folder]
+        if recursive:
+            lo, hi = _prefix_range(folder)
+            where, params = "(folder = ? OR (folder >= ? AND folder < ?))", [folder, lo, hi]
+        if tag is not None:
+            where += " AND EXISTS (SELECT 1 FROM json_each(photos.tags) WHERE value = ?)"
+            params.append(tag)
+        return f"SELECT {columns} FROM photos WHERE {where} ORDER BY path", params
+
+    def list_paths(self, folder, recursive=True, tag=None):
+        sql, params = self._select("path", folder, recursive, tag)
+        with self._lock:
+            return [path for (path,) in self._conn.execute(sql, params)]
+
+    def list_records(self, folder, recursive=True, tag=None):
+        sql, params = self._select("*", folder, recursive, tag)
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            rows = cursor.execute(sql, params).fetchall()
+        return [self._record(row) for row in rows]
+
+    # --- Changes ---
+
+    def add_tags(self, path, tags):
+        """Merge `tags` into the photo's tags and return the result."""
+        record = self.refresh_file(path)
+        merged = list(dict.fromkeys(record["tags"] + [t.strip() for t in tags if t.strip()]))
+        with self._lock:
+            self._conn.execute("UPDATE photos SET tags = ? WHERE path = ?", (json.dumps(merged), record["path"]))
+            self._conn.commit()
+        return merged
+
+    def move(self, path, destination_folder):
+        """
+        Move a photo into `destination_folder`, creating it if needed and
+        never overwriting an existing file.  The catalog row, tags
+        included, follows the file.  Returns the new path.
+        """
+        source = os.path.abspath(path)
+        if not os.path.isfile(source):
+            raise FileNotFoundError(f"The file {path} was not found.")
+        destination_folder = os.path.abspath(destination_folder)
+        name, ext = os.path.splitext(os.path.basename(source))
+        target = os.path.join(destination_folder, name + ext)
+        counter = 1
+        while os.path.exists(target):
+            if os.path.samefile(source, target):
+                return source
+            target = os.path.join(destination_folder, f"{name}-{counter}{ext}")
+            counter += 1
+        result = self.move_many([(source, target)])[0]
+        if result["error"]:
+            raise OSError(result["error"])
+        return result["target"]
+
+    def _move_file(self, source, target):
+        source, target = os.path.abspath(source), os.path.abspath(target)
+        if not os.path.isfile(source):
+            raise FileNotFoundError(f"The file {source} was not found.")
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # The target is claimed atomically, since concurrent moves may share it and a
+        # rename would silently overwrite: a hard link on the same filesystem, an
+        # exclusive create for the copy otherwise.  The source goes once it is in place.
+        try:
+            os.link(source, target)
+        except FileExistsError:
+            raise FileExistsError(f"The file {target} already exists.") from None
+        except OSError:
+            # Another filesystem, or one without hard links
+            self._copy_exclusive(source, target)
+        os.unlink(source)
+        return source, target
+
+    @staticmethod
+    def _copy_exclusive(source, target):
+        try:
+            dst = open(target, "xb")
+        except FileExistsError:
+            raise FileExistsError(f"The file {target} already exists.") from None
+        try:
+            with dst, open(source, "rb") as src:
+                shutil.copyfileobj(src, dst)
+            shutil.copystat(source, target)
+        except BaseException:
+            os.unlink(target)
+            raise
+
+    def move_many(self, moves, max_workers=None):
+        """
+        Move photos to exact `(source, target)` paths with a thread pool,
+        never overwriting.  Catalog rows follow their files in a single
+        transaction.  Returns one {"source", "target", "error"} per move, in
+        order; "error" is None on success.
+        """
+        def _safe(move):
+            try:
+                return self._move_file(*move), None
+            except Exception as e:
+                logging.error(f"Failed to move {move[0]} to {move[1]}: {str(e)}")
+                return None, str(e)
+
+        moves = list(moves)
+        with ThreadPoolExecutor(max_workers=max_workers or self.max_workers) as executor:
+            outcomes = list(executor.map(_safe, moves))
+
+        moved = [paths for paths, error in outcomes if error is None]
+        relocated = []
+        with self._lock:
+            for source, target in moved:
+                stat = os.stat(target)
+                self._conn.execute("DELETE FROM photos WHERE path = ?", (target,))
+                cursor = self._conn.execute(
+                    "UPDATE photos SET path = ?, folder = ?, size = ?, mtime_ns = ? WHERE path = ?",
+                    (target, os.path.dirname(target), stat.st_size, stat.st_mtime_ns, source))
+                if cursor.rowcount:
+                    relocated.append(target)
+            self._conn.commit()
+        # Files that weren't cataloged yet get indexed at their new home
+        for target in set(target for _, target in moved) - set(relocated):
+            self.refresh_file(target)
+
+        return [{"source": source, "target": target, "error": error}
+                for (source, target), (_, error) in zip(moves, outcomes)]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,37 +1,216 @@
 import asyncio
+import functools
 import logging
-from fastmcp import FastMCP
-import exifread
-from geopy.geocoders import Nominatim
-server = FastMCP("photo-mcp-server")
+import os
+import sys
+import threading
+from exif_reader import read_folder_metadata, read_photo_metadata
+import tracing
 
 logging.basicConfig(level=logging.INFO, filename='photo_mcp_server.log', filemode='a')
 
+IMAGE_DETECTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ImageDetection")
+OWLV2_MODEL_SAVE_PATH = os.environ.get("OWLV2_MODEL_SAVE_PATH", os.path.join(IMAGE_DETECTION_DIR, "owlv2-model"))
+# off, adaptive or always; see detect_and_count in ImageDetection
+DETECTION_TILING = os.environ.get("PHOTO_DETECTION_TILING", "off")
 
-@server.tool()
+GEONAMES_PATH = os.environ.get(
+    "PHOTO_GEONAMES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "cities15000.txt")
+)
+GEOCODER_MAX_DISTANCE_KM = float(os.environ.get("PHOTO_GEOCODER_MAX_DISTANCE_KM", "50"))
+GEOCODER_NETWORK_FALLBACK = os.environ.get("PHOTO_GEOCODER_NETWORK_FALLBACK", "1") != "0"
+GEOCODE_CACHE_PATH = os.environ.get(
+    "PHOTO_GEOCODE_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "geocode-cache.sqlite")
+)
+GEOCODE_CACHE_PRECISION = int(os.environ.get("PHOTO_GEOCODE_CACHE_PRECISION", "4"))
+GEOCODE_CACHE_SIZE = int(os.environ.get("PHOTO_GEOCODE_CACHE_SIZE", "10000"))
+PHOTO_CATALOG_PATH = os.environ.get(
+    "PHOTO_CATALOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "photo-catalog.sqlite")
+)
+PHOTO_CATALOG_HASH = os.environ.get("PHOTO_CATALOG_HASH") == "1"
+# Hashes within this many bits (of 64) count as near duplicates
+DUPLICATE_MAX_DISTANCE = int(os.environ.get("PHOTO_DUPLICATE_MAX_DISTANCE", "4"))
+# Off by default: a near duplicate (say a burst frame) would get its neighbour's counts, not its own
+DETECTION_REUSE_DUPLICATES = os.environ.get("PHOTO_DETECTION_REUSE_DUPLICATES") == "1"
+EMBEDDING_INDEX_PATH = os.environ.get(
+    "PHOTO_EMBEDDING_INDEX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "embedding-index")
+)
+# Searches switch from scoring every photo to clustered (IVF) search at this library size; 0 never does
+EMBEDDING_IVF_MIN_PHOTOS = int(os.environ.get("PHOTO_EMBEDDING_IVF_MIN_PHOTOS", "50000"))
+
+_reverse_geocoder = None
+_reverse_geocoder_loaded = False
+_nominatim_reverse = None
+_geocode_cache = None
+_photo_catalog = None
+_duplicate_index = None
+_embedding_index = None
+_init_lock = threading.Lock()
+# Tool functions by name.  They are registered on a FastMCP server only when
+# this module runs as one, so in-process callers (photo_agent with
+# PHOTO_TOOL_BACKEND=inprocess) don't pay for importing fastmcp.
+TOOLS = {}
+
+
+def tool(function):
+    """Register a tool; every call is traced as tool.server."""
+    @functools.wraps(function)
+    def traced(*args, **kwargs):
+        with tracing.trace("tool.server", tool=function.__name__):
+            return function(*args, **kwargs)
+    TOOLS[function.__name__] = traced
+    return traced
+
+
+def create_server():
+    from fastmcp import FastMCP
+    server = FastMCP("photo-mcp-server")
+    for function in TOOLS.values():
+        server.tool()(function)
+    return server
+
+
+def load_detection_module():
+    """Import the OWLv2 detection module lazily; torch and transformers are heavy."""
+    if IMAGE_DETECTION_DIR not in sys.path:
+        sys.path.insert(0, IMAGE_DETECTION_DIR)
+    import test_object_detection_using_owlv2 as detection
+    return detection
+
+
+def load_perceptual_hash_module():
+    if IMAGE_DETECTION_DIR not in sys.path:
+        sys.path.insert(0, IMAGE_DETECTION_DIR)
+    import perceptual_hash
+    return perceptual_hash
+
+
+def load_embedding_index_module():
+    if IMAGE_DETECTION_DIR not in sys.path:
+        sys.path.insert(0, IMAGE_DETECTION_DIR)
+    import embedding_index
+    return embedding_index
+
+
+def get_reverse_geocoder():
+    """Build the offline places index on first use; None if no places file is installed."""
+    global _reverse_geocoder, _reverse_geocoder_loaded
+    with _init_lock:
+        if not _reverse_geocoder_loaded:
+            _reverse_geocoder_loaded = True
+            if os.path.exists(GEONAMES_PATH):
+                from reverse_geocoder import ReverseGeocoder
+                _reverse_geocoder = ReverseGeocoder.from_file(GEONAMES_PATH)
+            else:
+                logging.warning(f"No places file at {GEONAMES_PATH}, reverse geocoding falls back to Nominatim")
+        return _reverse_geocoder
+
+
+def nominatim_reverse(latitude, longitude):
+    """Reverse geocode through Nominatim, spaced out to its 1 request/second policy."""
+    global _nominatim_reverse
+    with _init_lock:
+        if _nominatim_reverse is None:
+            from geopy.extra.rate_limiter import RateLimiter
+            from geopy.geocoders import Nominatim
+            geolocator = Nominatim(user_agent="note_taking_agent")
+            _nominatim_reverse = RateLimiter(geolocator.reverse, min_delay_seconds=1)
+    # Includes the wait for the rate limit
+    with tracing.span("geocode.nominatim"):
+        location = _nominatim_reverse((latitude, longitude), exactly_one=True)
+    return location.address if location else None
+
+
+def reverse_geocode_many(coordinates):
+    """
+    Resolve (latitude, longitude) pairs to place names, None where nothing is
+    found.  The offline index answers the whole batch in one query; Nominatim
+    is only asked about coordinates the index has nothing near.
+    """
+    names = [None] * len(coordinates)
+    geocoder = get_reverse_geocoder()
+    if geocoder is not None:
+        with tracing.span("geocode.offline"):
+            for i, match in enumerate(geocoder.nearest_many(coordinates, GEOCODER_MAX_DISTANCE_KM)):
+                if match is not None:
+                    names[i] = match[0].display_name()
+    if GEOCODER_NETWORK_FALLBACK:
+        for i, (latitude, longitude) in enumerate(coordinates):
+            if names[i] is None:
+                try:
+                    names[i] = nominatim_reverse(latitude, longitude)
+                except Exception as e:
+                    logging.error(f"Nominatim lookup failed for ({latitude}, {longitude}): {str(e)}")
+    return names
+
+
+def geocode_cache_namespace():
+    """
+    Cache namespace naming the backends that can answer: names from the
+    places file (which depend on it and the distance cutoff) and from
+    Nominatim must not be served once a different set of backends is in use.
+    """
+    backends = []
+    if get_reverse_geocoder() is not None:
+        backends.append(f"{os.path.basename(GEONAMES_PATH)}:{GEOCODER_MAX_DISTANCE_KM:g}")
+    if GEOCODER_NETWORK_FALLBACK:
+        backends.append("nominatim")
+    return "+".join(backends)
+
+
+def get_geocode_cache():
+    global _geocode_cache
+    if _geocode_cache is None:
+        # Outside _init_lock, which loading the places index takes too
+        namespace = geocode_cache_namespace()
+    with _init_lock:
+        if _geocode_cache is None:
+            from geocode_cache import GeocodeCache
+            _geocode_cache = GeocodeCache(
+                reverse_geocode_many,
+                db_path=GEOCODE_CACHE_PATH,
+                precision=GEOCODE_CACHE_PRECISION,
+                max_entries=GEOCODE_CACHE_SIZE,
+                namespace=namespace,
+            )
+        return _geocode_cache
+
+
+def format_location_name(latitude, longitude, name):
+    if name:
+        return f"Location name for coordinates ({latitude}, {longitude}): {name}"
+    return f"Could not find location for coordinates ({latitude}, {longitude})"
+
+
+@tool
 def get_location_name_from_gps_coords(latitude: float, longitude: float) -> str:
-    """Get location name from GPS coordinates using Nominatim API"""
+    """Get location name from GPS coordinates using an offline places index, falling back to Nominatim"""
     logging.info(f"Getting location name for coordinates: {latitude}, {longitude}")
-    geolocator = Nominatim(user_agent="note_taking_agent")
-    location = geolocator.reverse((latitude, longitude), exactly_one=True)
-    if location:
-        return f"Location name for coordinates ({latitude}, {longitude}): {location.address}"
-    else:
-        return f"Could not find location for coordinates ({latitude}, {longitude})"
-
-@server.tool()
+    name = get_geocode_cache().lookup(latitude, longitude)
+    return format_location_name(latitude, longitude, name)
+
+@tool
+def get_location_names_from_gps_coords(coordinates: list[tuple[float, float]]) -> list[str | None]:
+    """Get location names for many (latitude, longitude) pairs in one call, null where nothing is found"""
+    logging.info(f"Getting location names for {len(coordinates)} coordinates")
+    return get_geocode_cache().lookup_many(coordinates)
+
+@tool
+def get_geocode_cache_stats() -> dict:
+    """Get hit/miss counters and sizes of the reverse geocoding cache"""
+    return get_geocode_cache().stats()
+
+@tool
 def get_image_location_metadata(filepath: str) -> str:
-    """Get image location metadata from a file using ExifRead"""
+    """Get the GPS location (signed decimal degrees) and capture time of an image from its EXIF header"""
     logging.info(f"Getting image location metadata for file: {filepath}")
     try:
-        with open(filepath, 'rb') as f:
-            tags = exifread.process_file(f)
-        gps_latitude = tags.get('GPS GPSLatitude')
-        gps_longitude = tags.get('GPS GPSLongitude')
-        if gps_latitude and gps_longitude:
-            return f"Image location metadata for {filepath}:\nLatitude: {gps_latitude}\nLongitude: {gps_longitude}"
+        metadata = read_photo_metadata(filepath)
+        taken = f"\nTaken: {metadata['date_original']}" if metadata["date_original"] else ""
+        if metadata["latitude"] is not None and metadata["longitude"] is not None:
+            return f"Image location metadata for {filepath}:\nLatitude: {metadata['latitude']}\nLongitude: {metadata['longitude']}{taken}"
         else:
-            return f"No GPS metadata found in {filepath}."
+            return f"No GPS metadata found in {filepath}.{taken}"
     except FileNotFoundError:
         logging.error(f"File not found: {filepath}")
         return f"Error: The file {filepath} was not found."
@@ -39,6 +218,162 @@ def get_image_location_metadata(filepath: str) -> str:
         logging.error(f"An error occurred while reading metadata from {filepath}: {str(e)}")
         return f"An error occurred while reading metadata from {filepath}: {str(e)}"
 
+@tool
+def get_folder_location_metadata(folder: str, recursive: bool = True) -> list[dict]:
+    """Get GPS location (signed decimal degrees) and capture time for every photo in a folder in one call"""
+    logging.info(f"Getting image location metadata for folder: {folder}")
+    require_folder(folder)
+    return read_folder_metadata(folder, recursive=recursive)
+
+def get_duplicate_index():
+    """Detections of images processed by this server, so near duplicates skip inference."""
+    global _duplicate_index
+    with _init_lock:
+        if _duplicate_index is None:
+            _duplicate_index = load_perceptual_hash_module().DuplicateResultIndex(max_distance=DUPLICATE_MAX_DISTANCE)
+        return _duplicate_index
+
+def get_embedding_index():
+    """Image embeddings of photos seen by this server, for search_photos."""
+    global _embedding_index
+    with _init_lock:
+        if _embedding_index is None:
+            _embedding_index = load_embedding_index_module().EmbeddingIndex(
+                EMBEDDING_INDEX_PATH, model_key=load_detection_module().DEFAULT_MODEL_NAME
+            )
+        return _embedding_index
+
+def get_photo_catalog():
+    global _photo_catalog
+    with _init_lock:
+        if _photo_catalog is None:
+            from photo_catalog import PhotoCatalog
+            _photo_catalog = PhotoCatalog(PHOTO_CATALOG_PATH, hash_files=PHOTO_CATALOG_HASH)
+        return _photo_catalog
+
+def require_folder(folder):
+    if not os.path.isdir(folder):
+        raise ValueError(f"The folder {folder} was not found.")
+
+@tool
+def list_photos(folder: str, recursive: bool = True, tag: str | None = None) -> list[str]:
+    """List photo files in a folder from the photo catalog, optionally only those with a tag"""
+    logging.info(f"Listing photos in folder: {folder}")
+    require_folder(folder)
+    catalog = get_photo_catalog()
+    catalog.refresh(folder, recursive=recursive)
+    return catalog.list_paths(folder, recursive=recursive, tag=tag)
+
+@tool
+def get_photo_catalog_records(folder: str, recursive: bool = True) -> list[dict]:
+    """Get catalog records (size, capture date, GPS, tags) for every photo in a folder in one call"""
+    logging.info(f"Getting photo catalog records for folder: {folder}")
+    require_folder(folder)
+    catalog = get_photo_catalog()
+    catalog.refresh(folder, recursive=recursive)
+    return catalog.list_records(folder, recursive=recursive)
+
+@tool
+def get_exif(file: str) -> dict:
+    """Get the capture date, GPS position and tags of a photo"""
+    logging.info(f"Getting EXIF for file: {file}")
+    return get_photo_catalog().refresh_file(file)
+
+@tool
+def tag_photo(file: str, tags: list[str]) -> list[str]:
+    """Add tags to a photo in the photo catalog and return all its tags"""
+    logging.info(f"Tagging {file} with {tags}")
+    return get_photo_catalog().add_tags(file, tags)
+
+@tool
+def move_photo(file: str, destination: str) -> str:
+    """Move a photo into a destination folder without overwriting anything and return its new path"""
+    logging.info(f"Moving {file} to {destination}")
+    return get_photo_catalog().move(file, destination)
+
+@tool
+def move_photos(moves: list[dict], max_workers: int = 8) -> list[dict]:
+    """Move many photos to exact target paths ({"source", "target"} each) in parallel, never overwriting"""
+    logging.info(f"Moving {len(moves)} photos")
+    return get_photo_catalog().move_many([(m["source"], m["target"]) for m in moves], max_workers=max_workers)
+
+@tool
+def detect_objects_in_image(filepath: str, objects: list[str] | None = None, threshold: float = 0.2) -> str:
+    """Detect and count objects (cats, dogs, people, ...) in an image using the OWLv2 model"""
+    logging.info(f"Detecting objects in file: {filepath}")
+    try:
+        detection = load_detection_module()
+        object_texts = objects or detection.OBJECTS_TO_DETECT
+        # Only slow on the first call, which loads the weights
+        with tracing.span("detection.load_model"):
+            processor, model = detection.get_model_and_processor(model_save_path=OWLV2_MODEL_SAVE_PATH)
+        with tracing.span("detection.detect_and_count"):
+            counts, detections = detection.detect_and_count(
+                filepath,
+                object_texts,
+                threshold=threshold,
+                processor=processor,
+                model=model,
+                model_save_path=OWLV2_MODEL_SAVE_PATH,
+                duplicate_index=get_duplicate_index() if DETECTION_REUSE_DUPLICATES else None,
+                tiling=DETECTION_TILING,
+                embedding_index=get_embedding_index(),
+            )
+        found = [f"{c['type']}: {c['count']}" for c in counts if c["count"] > 0]
+        if not found:
+            return f"No objects from {object_texts} were detected in {filepath}."
+        return f"Objects detected in {filepath}:\n" + "\n".join(found)
+    except FileNotFoundError:
+        logging.error(f"File not found: {filepath}")
+        return f"Error: The file {filepath} was not found."
+    except Exception as e:
+        logging.error(f"An error occurred while detecting objects in {filepath}: {str(e)}")
+        return f"An error occurred while detecting objects in {filepath}: {str(e)}"
+
+@tool
+def find_duplicate_photos(folder: str, recursive: bool = True, max_distance: int | None = None) -> list[list[str]]:
+    """Find clusters of near-duplicate photos (bursts, re-encodes, resized copies) in a folder, largest first"""
+    logging.info(f"Finding duplicate photos in folder: {folder}")
+    require_folder(folder)
+    catalog = get_photo_catalog()
+    catalog.refresh(folder, recursive=recursive)
+    paths = catalog.list_paths(folder, recursive=recursive)
+    return load_perceptual_hash_module().duplicate_clusters(
+        paths, max_distance=DUPLICATE_MAX_DISTANCE if max_distance is None else max_distance
+    )
+
+@tool
+def search_photos(query: str, folder: str | None = None, limit: int = 20) -> list[dict]:
+    """Find photos matching a free-text description like "beach photos with dogs", best match first.
+    Photos of `folder` not searched before are indexed first, which runs the image model once per new photo."""
+    logging.info(f"Searching photos for: {query}")
+    embeddings = load_embedding_index_module()
+    index = get_embedding_index()
+    with tracing.span("detection.load_model"):
+        processor, model = load_detection_module().get_model_and_processor(model_save_path=OWLV2_MODEL_SAVE_PATH)
+    if folder is not None:
+        require_folder(folder)
+        catalog = get_photo_catalog()
+        catalog.refresh(folder, recursive=True)
+        with tracing.span("embedding.index_images"):
+            added = embeddings.index_images(catalog.list_paths(folder, recursive=True), index, processor, model)
+        if added:
+            logging.info(f"Indexed {added} new photos in {folder}")
+    if EMBEDDING_IVF_MIN_PHOTOS and not index.stats()["ivf_lists"] and len(index) >= EMBEDDING_IVF_MIN_PHOTOS:
+        index.build_ivf()
+    with tracing.span("embedding.search"):
+        matches = embeddings.search_text(index, query, processor, model, k=limit, folder=folder)
+    return [{"path": path, "score": score} for path, score in matches]
+
+@tool
+def get_metrics() -> dict:
+    """Get latency histograms and counters recorded by this server process"""
+    return tracing.snapshot()
+
 if __name__ == "__main__":
     logging.info("Starting photo MCP server")
-    server.run(transport="stdio")
\ No newline at end of file
+    if os.environ.get("PHOTO_MCP_WARM_UP_DETECTION") == "1":
+        # Keep one resident copy of the OWLv2 weights for the life of the server.
+        logging.info("Warming up OWLv2 detection model")
+        load_detection_module().warm_up_model(model_save_path=OWLV2_MODEL_SAVE_PATH)
+    create_server().run(transport="stdio")
\ No newline at end of file
@@ -0,0 +1,179 @@
+import collections
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+JOURNAL_PLAN = "plan"
+JOURNAL_DONE = "done"
+JOURNAL_FAILED = "failed"
+JOURNAL_COMPLETE = "complete"
+# A move that failed this many times is given up on, so it can't keep the journal open forever
+MAX_MOVE_ATTEMPTS = 3
+
+
+def date_folder(root, date_str):
+    """year/month destination folder for an ISO capture date, or None if it doesn't parse."""
+    try:
+        d = datetime.fromisoformat(date_str)
+    except (TypeError, ValueError):
+        return None
+    return os.path.join(root, str(d.year), f"{d.month:02d}")
+
+
+def plan_moves(records, root):
+    """
+    Compute every move needed to file photos under root/year/month.
+
+    `records` are photo catalog records.  Target names never collide with an
+    existing file or with another planned target; clashing names get a
+    numeric suffix.  Returns (moves, skipped), where moves is a list of
+    {"source", "target"} and skipped counts photos left in place by reason.
+    """
+    root = os.path.abspath(root)
+    taken = {os.path.normcase(record["path"]) for record in records}
+    moves = []
+    skipped = {"no_date": 0, "in_place": 0}
+
+    for record in sorted(records, key=lambda r: r["path"]):
+        source = record["path"]
+        destination = date_folder(root, record.get("date_original"))
+        if destination is None:
+            skipped["no_date"] += 1
+            continue
+        if os.path.dirname(source) == destination:
+            skipped["in_place"] += 1
+            continue
+        name, ext = os.path.splitext(os.path.basename(source))
+        target = os.path.join(destination, name + ext)
+        counter = 1
+        while os.path.normcase(target) in taken or os.path.exists(target):
+            target = os.path.join(destination, f"{name}-{counter}{ext}")
+            counter += 1
+        taken.add(os.path.normcase(target))
+        moves.append({"source": source, "target": target})
+    return moves, skipped
+
+
+class MoveJournal:
+    """
+    Append-only JSON-lines record of a move plan and its progress.
+
+    The plan is written in full before anything moves, then every applied
+    batch is appended and fsynced, so an interrupted run can pick up
+    exactly the moves that haven't happened yet.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """
+        Return (planned moves, set of finished sources, failed attempts per
+        source, complete flag, root the plan was made for); empty if there's
+        no journal.
+        """
+        planned, finished, failures, complete, root = [], set(), collections.Counter(), False, None
+        if not os.path.exists(self.path):
+            return planned, finished, failures, complete, root
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A torn last line from a crash mid-write
+                    continue
+                op = entry.get("op")
+                if op == JOURNAL_PLAN:
+                    planned.append({"source": entry["source"], "target": entry["target"]})
+                    root = entry.get("root")
+                elif op == JOURNAL_DONE:
+                    finished.add(entry["source"])
+                elif op == JOURNAL_FAILED:
+                    failures[entry["source"]] += 1
+                elif op == JOURNAL_COMPLETE:
+                    complete = True
+        return planned, finished, failures, complete, root
+
+    def _append(self, entries, mode="a"):
+        with open(self.path, mode, encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def start(self, moves, root):
+        root = os.path.abspath(root)
+        self._append(({"op": JOURNAL_PLAN, "root": root, **move} for move in moves), mode="w")
+
+    def record(self, results):
+        self._append({"op": JOURNAL_FAILED if r["error"] else JOURNAL_DONE, **r} for r in results)
+
+    def finish(self):
+        self._append([{"op": JOURNAL_COMPLETE, "at": time.time()}])
+
+
+def pending_moves(journal, root):
+    """
+    Moves of an unfinished journal for `root` that still need applying.
+    Moves that happened but weren't recorded before a crash (source gone,
+    target present) are recorded now instead of being retried.  Moves whose
+    source has disappeared, or that already failed MAX_MOVE_ATTEMPTS times,
+    are given up on; once nothing is left the journal is marked complete, so
+    the next run plans the library afresh.
+
+    Raises ValueError if the journal holds an unfinished plan for another
+    folder, rather than resuming it or discarding its progress.
+    """
+    planned, finished, failures, complete, planned_root = journal.load()
+    if complete or not planned:
+        return []
+    pending, recovered = [], []
+    for move in planned:
+        source = move["source"]
+        if source in finished:
+            continue
+        if not os.path.exists(source):
+            if os.path.exists(move["target"]):
+                recovered.append(dict(move, error=None))
+            else:
+                logging.warning(f"Giving up on moving {source}: it no longer exists")
+        elif failures[source] >= MAX_MOVE_ATTEMPTS:
+            logging.warning(f"Giving up on moving {source} after {failures[source]} failed attempts")
+        else:
+            pending.append(move)
+    if recovered:
+        journal.record(recovered)
+    if not pending:
+        journal.finish()
+        return []
+    root = os.path.abspath(root)
+    if planned_root is None or os.path.normcase(planned_root) != os.path.normcase(root):
+        raise ValueError(f"{journal.path} holds an unfinished plan for {planned_root or 'another folder'}; "
+                         f"organize that folder again to finish it, or use a different journal for {root}")
+    return pending
+
+
+def apply_moves(move_batch, moves, journal, batch_size=500, progress=None):
+    """
+    Apply `moves` in batches through `move_batch(batch) -> results`,
+    journaling each batch before starting the next.  Returns
+    (moved, failed) counts.
+    """
+    moved = failed = 0
+    for start in range(0, len(moves), batch_size):
+        results = move_batch(moves[start:start + batch_size])
+        journal.record(results)
+        for result in results:
+            if result["error"]:
+                failed += 1
+                logging.error(f"Failed to move {result['source']}: {result['error']}")
+            else:
+                moved += 1
+        if progress:
+            progress(moved + failed, len(moves))
+    if not failed:
+        # Failed moves stay pending so the next run retries them, up to MAX_MOVE_ATTEMPTS
+        journal.finish()
+    return moved, failed
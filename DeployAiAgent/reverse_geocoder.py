@@ -0,0 +1,138 @@
+import csv
+import logging
+import math
+import os
+from typing import NamedTuple
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Column layout of the GeoNames dumps (cities500.txt, cities15000.txt, allCountries.txt, ...)
+GEONAMES_COLUMNS = 19
+GEONAMES_NAME, GEONAMES_LAT, GEONAMES_LON = 1, 4, 5
+GEONAMES_COUNTRY, GEONAMES_ADMIN1, GEONAMES_POPULATION = 8, 10, 14
+ADMIN1_CODES_FILENAME = "admin1CodesASCII.txt"
+
+
+class Place(NamedTuple):
+    name: str
+    admin1: str
+    country_code: str
+    latitude: float
+    longitude: float
+    population: int = 0
+
+    def display_name(self):
+        return ", ".join(part for part in (self.name, self.admin1, self.country_code) if part)
+
+
+def to_unit_vectors(latitudes, longitudes):
+    """Map lat/lon in degrees to points on the unit sphere, so euclidean nearest == great-circle nearest."""
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def chord_to_km(chord):
+    return 2.0 * EARTH_RADIUS_KM * np.arcsin(np.clip(np.asarray(chord) / 2.0, 0.0, 1.0))
+
+
+def load_admin1_names(path):
+    """Read a GeoNames admin1CodesASCII.txt into {"US.CA": "California", ...}."""
+    names = {}
+    with open(path, encoding="utf-8") as f:
+        for row in csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE):
+            if len(row) >= 2:
+                names[row[0]] = row[1]
+    return names
+
+
+def load_places(path):
+    """
+    Load places from a GeoNames tab-separated dump, or from a CSV with a
+    header containing at least name, latitude and longitude (and optionally
+    admin1, country_code, population).
+    """
+    places = []
+    with open(path, encoding="utf-8", newline="") as f:
+        first_line = f.readline()
+        f.seek(0)
+        if first_line.count("\t") >= GEONAMES_COLUMNS - 1:
+            admin1_path = os.path.join(os.path.dirname(path), ADMIN1_CODES_FILENAME)
+            admin1_names = load_admin1_names(admin1_path) if os.path.exists(admin1_path) else {}
+            for row in csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE):
+                if len(row) < GEONAMES_COLUMNS:
+                    continue
+                country, admin1 = row[GEONAMES_COUNTRY], row[GEONAMES_ADMIN1]
+                places.append(Place(
+                    row[GEONAMES_NAME],
+                    admin1_names.get(f"{country}.{admin1}", admin1),
+                    country,
+                    float(row[GEONAMES_LAT]),
+                    float(row[GEONAMES_LON]),
+                    int(row[GEONAMES_POPULATION] or 0),
+                ))
+        else:
+            for row in csv.DictReader(f):
+                places.append(Place(
+                    row["name"],
+                    row.get("admin1", ""),
+                    row.get("country_code", ""),
+                    float(row["latitude"]),
+                    float(row["longitude"]),
+                    int(row.get("population") or 0),
+                ))
+    return places
+
+
+class ReverseGeocoder:
+    """
+    Offline nearest-place lookup over a KD-tree of places on the unit sphere.
+
+    Build it once per process; single lookups take microseconds and batches
+    of coordinates are answered with one vectorized tree query.
+    """
+
+    def __init__(self, places):
+        if not places:
+            raise ValueError("ReverseGeocoder needs at least one place")
+        self.places = places
+        self._tree = cKDTree(to_unit_vectors([p.latitude for p in places], [p.longitude for p in places]))
+
+    @classmethod
+    def from_file(cls, path):
+        places = load_places(path)
+        logging.info(f"Loaded {len(places)} places for reverse geocoding from {path}")
+        return cls(places)
+
+    def __len__(self):
+        return len(self.places)
+
+    def nearest_many(self, coordinates, max_distance_km=None):
+        """
+        Look up the nearest place for each (latitude, longitude) pair.
+
+        Returns a list aligned with `coordinates` of (Place, distance_km), or
+        None where no place lies within `max_distance_km`.
+        """
+        coords = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        if len(coords) == 0:
+            return []
+        upper_bound = np.inf
+        if max_distance_km is not None:
+            # Great-circle distance -> chord length on the unit sphere
+            upper_bound = 2.0 * math.sin(min(max_distance_km / EARTH_RADIUS_KM, math.pi) / 2.0) + 1e-12
+        chords, indices = self._tree.query(to_unit_vectors(coords[:, 0], coords[:, 1]),
+                                           k=1,
+                                           distance_upper_bound=upper_bound)
+        distances = chord_to_km(np.where(np.isfinite(chords), chords, 0.0))
+        return [
+            (self.places[i], float(d)) if np.isfinite(c) else None
+            for c, i, d in zip(chords, indices, distances)
+        ]
+
+    def nearest(self, latitude, longitude, max_distance_km=None):
+        return self.nearest_many([(latitude, longitude)], max_distance_km)[0]
@@ -0,0 +1,274 @@
+"""
+Spans and latency histograms for the agent, the MCP client and the photo tools.
+
+  with trace("agent.run", mode="sync"):
+      with span("tool.client", tool=name):
+          ...
+
+Every span adds its duration to a histogram keyed by its name and labels
+and counts failures; `render_prometheus` turns histograms and counters into
+the Prometheus text format served at /metrics.  Labels become metric labels,
+so keep them low-cardinality (a tool name, not a file path).
+
+`trace` starts a trace when no span is active (a request, a tool call on
+the server) and `span` only ever joins one.  A fraction of traces,
+AGENT_TRACE_SAMPLE_RATE, decided once per trace, is also kept in full and
+logged as one JSON line with each span's parent, start offset, duration
+and attributes.  Unsampled spans cost a clock read and a histogram update;
+AGENT_METRICS=0 turns every span into a no-op.
+"""
+import bisect
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+METRICS_ENABLED = os.environ.get("AGENT_METRICS", "1") != "0"
+TRACE_SAMPLE_RATE = float(os.environ.get("AGENT_TRACE_SAMPLE_RATE", "0"))
+# Histogram bucket upper bounds in seconds, from a cache hit to a slow LLM turn
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Spans kept per sampled trace; later ones are still counted in the histograms
+MAX_TRACE_SPANS = 1000
+
+_current_span = contextvars.ContextVar("tracing_current_span", default=None)
+trace_logger = logging.getLogger("tracing")
+
+
+class Registry:
+    """Thread-safe span histograms and event counters of this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum, errors]
+        self._counters = {}    # (name, labels) -> value
+
+    def observe(self, name, labels, seconds, error=False):
+        key = (name, labels)
+        bucket = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0, 0]
+            histogram[bucket] += 1
+            histogram[-2] += seconds
+            if error:
+                histogram[-1] += 1
+
+    def increment(self, name, labels, amount=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def snapshot(self):
+        """JSON-serializable copy of every histogram and counter, as returned by the get_metrics tool."""
+        with self._lock:
+            spans = [{"span": name, "labels": dict(labels), "counts": histogram[:-2], "sum": histogram[-2],
+                      "errors": histogram[-1]}
+                     for (name, labels), histogram in self._histograms.items()]
+            counters = [{"event": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in self._counters.items()]
+        return {"spans": spans, "counters": counters}
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+registry = Registry()
+
+
+class _Trace:
+    __slots__ = ("trace_id", "start", "spans", "next_id")
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex
+        self.start = time.perf_counter()
+        self.spans = []
+        self.next_id = 0
+
+
+class Span:
+    """
+    A timed operation.  Use it as a context manager to make it the parent of
+    spans started inside it, or call `end` on it directly, for callbacks that
+    begin and end in different contexts.
+    """
+
+    __slots__ = ("name", "labels", "parent", "trace", "span_id", "start", "attributes", "error")
+
+    def __init__(self, name, labels, parent, new_trace):
+        self.name = name
+        self.labels = labels
+        self.parent = parent
+        if parent is not None:
+            self.trace = parent.trace
+        elif new_trace and TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE:
+            self.trace = _Trace()
+        else:
+            self.trace = None
+        self.span_id = None
+        self.attributes = None
+        self.error = None
+        if self.trace is not None:
+            self.span_id = self.trace.next_id
+            self.trace.next_id += 1
+            self.attributes = {}
+        self.start = time.perf_counter()
+
+    @property
+    def sampled(self):
+        return self.trace is not None
+
+    def set(self, **attributes):
+        """Attach attributes; they are only kept when the trace is sampled."""
+        if self.attributes is not None:
+            self.attributes.update(attributes)
+
+    def record_error(self, error):
+        """Count the span as failed even though the exception was handled inside it."""
+        self.error = type(error).__name__
+
+    def activate(self):
+        """Make this span current again, e.g. after an async generator resumes in another task."""
+        _current_span.set(self)
+
+    def end(self, error=None):
+        duration = time.perf_counter() - self.start
+        if error is not None:
+            self.record_error(error)
+        registry.observe(self.name, self.labels, duration, self.error is not None)
+        trace = self.trace
+        if trace is None:
+            return
+        if len(trace.spans) < MAX_TRACE_SPANS:
+            record = {"id": self.span_id, "parent": self.parent.span_id if self.parent is not None else None,
+                      "name": self.name, "start_ms": round((self.start - trace.start) * 1000, 3),
+                      "duration_ms": round(duration * 1000, 3)}
+            if self.labels or self.attributes:
+                record["attributes"] = {**dict(self.labels), **self.attributes}
+            if self.error is not None:
+                record["error"] = self.error
+            trace.spans.append(record)
+        if self.parent is None:
+            trace_logger.info(json.dumps({"trace_id": trace.trace_id, "spans": trace.spans}, default=str))
+
+    def __enter__(self):
+        _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Set rather than reset with a token: an async generator can finish in a different context than it started
+        _current_span.set(self.parent)
+        # Cancellation and generator exit aren't failures of the operation
+        self.end(exc if exc_type is not None and issubclass(exc_type, Exception) else None)
+        return False
+
+
+class _NoopSpan:
+    sampled = False
+
+    def set(self, **attributes):
+        pass
+
+    def record_error(self, error):
+        pass
+
+    def activate(self):
+        pass
+
+    def end(self, error=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def _labels(labels):
+    if not labels:
+        return ()
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def trace(name, **labels):
+    """A span that starts a new, possibly sampled, trace when no span is active."""
+    if not METRICS_ENABLED:
+        return _NOOP_SPAN
+    return Span(name, _labels(labels), _current_span.get(), True)
+
+
+def span(name, **labels):
+    """A span in the current trace, or only counted in the histograms when there is none."""
+    if not METRICS_ENABLED:
+        return _NOOP_SPAN
+    return Span(name, _labels(labels), _current_span.get(), False)
+
+
+def increment(name, amount=1, **labels):
+    """Add `amount` to the counter `name`, e.g. LLM tokens or MCP server restarts."""
+    if METRICS_ENABLED:
+        registry.increment(name, _labels(labels), amount)
+
+
+def snapshot():
+    return registry.snapshot()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    return ",".join(f'{key}="{_escape(value)}"' for key, value in labels)
+
+
+def render_prometheus(snapshots):
+    """
+    Render `snapshots`, a list of (extra labels, snapshot) pairs, in the
+    Prometheus text format.  Series with equal labels after adding the
+    extra ones, such as the same span in several MCP server processes,
+    are summed.
+    """
+    spans, counters = {}, {}
+    for extra, data in snapshots:
+        for entry in data["spans"]:
+            key = _labels({"span": entry["span"], **entry["labels"], **extra})
+            total = spans.get(key)
+            if total is None:
+                spans[key] = {"counts": list(entry["counts"]), "sum": entry["sum"], "errors": entry["errors"]}
+                continue
+            total["counts"] = [a + b for a, b in zip(total["counts"], entry["counts"])]
+            total["sum"] += entry["sum"]
+            total["errors"] += entry["errors"]
+        for entry in data["counters"]:
+            key = _labels({"event": entry["event"], **entry["labels"], **extra})
+            counters[key] = counters.get(key, 0) + entry["value"]
+
+    lines = ["# HELP agent_span_duration_seconds Duration of traced operations.",
+             "# TYPE agent_span_duration_seconds histogram"]
+    bounds = [f"{bound:g}" for bound in BUCKETS] + ["+Inf"]
+    for key in sorted(spans):
+        labels = _format_labels(key)
+        cumulative = 0
+        for bound, count in zip(bounds, spans[key]["counts"]):
+            cumulative += count
+            lines.append(f'agent_span_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f"agent_span_duration_seconds_sum{{{labels}}} {spans[key]['sum']:.6f}")
+        lines.append(f"agent_span_duration_seconds_count{{{labels}}} {cumulative}")
+    lines += ["# HELP agent_span_errors_total Traced operations that failed.",
+              "# TYPE agent_span_errors_total counter"]
+    lines += [f"agent_span_errors_total{{{_format_labels(key)}}} {spans[key]['errors']}" for key in sorted(spans)]
+    lines += ["# HELP agent_events_total Counted events.",
+              "# TYPE agent_events_total counter"]
+    lines += [f"agent_events_total{{{_format_labels(key)}}} {counters[key]}" for key in sorted(counters)]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,121 @@
+"""
+Accuracy-vs-speed report for the CPU inference modes of the OWLv2 detector.
+
+  python compare_inference_modes.py ~/Pictures/sample --modes fp32 bf16 int8 --threads 8 --json report.json
+
+Each mode runs detect_and_count_batch over the same sample and its per-image
+counts are compared against the fp32 results.
+"""
+import argparse
+import json
+from pathlib import Path
+import time
+
+import test_object_detection_using_owlv2 as detection
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+
+
+def expand_image_paths(inputs):
+  """Expand folders into the image files they contain, keeping explicit files as-is."""
+  paths = []
+  for item in inputs:
+    p = Path(item)
+    if p.is_dir():
+      paths.extend(str(f) for f in sorted(p.rglob("*")) if f.suffix.lower() in IMAGE_EXTENSIONS)
+    else:
+      paths.append(str(p))
+  return paths
+
+def _count_map(counts_array):
+  return {c["type"]: c["count"] for c in counts_array}
+
+def compare_inference_modes(image_paths,
+                            object_texts=detection.OBJECTS_TO_DETECT,
+                            modes=detection.INFERENCE_MODES,
+                            threshold=0.2,
+                            batch_size=8,
+                            num_threads=None,
+                            model_name=detection.DEFAULT_MODEL_NAME,
+                            model_save_path=detection.DEFAULT_MODEL_SAVE_PATH):
+  """
+  Time each inference mode over `image_paths` and compare its counts with fp32.
+
+  Returns one dict per mode with load time, throughput, speedup over fp32,
+  the fraction of images whose counts match fp32 exactly, and the mean
+  absolute per-image count difference.
+  """
+  # fp32 is the reference, so always run it first
+  modes = [detection.INFERENCE_MODE_FP32] + [m for m in modes if m != detection.INFERENCE_MODE_FP32]
+  reference = None
+  reference_seconds = None
+  report = []
+
+  for mode in modes:
+    detection.unload_model()
+    start = time.perf_counter()
+    processor, model = detection.warm_up_model(model_name,
+                                               model_save_path,
+                                               object_texts=object_texts,
+                                               inference_mode=mode,
+                                               num_threads=num_threads)
+    load_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = detection.detect_and_count_batch(image_paths,
+                                               object_texts,
+                                               threshold=threshold,
+                                               batch_size=batch_size,
+                                               processor=processor,
+                                               model=model,
+                                               inference_mode=mode)
+    seconds = time.perf_counter() - start
+
+    counts = [_count_map(counts_array) for counts_array, _ in results]
+    if reference is None:
+      reference, reference_seconds = counts, seconds
+    matching = sum(1 for a, b in zip(counts, reference) if a == b)
+    abs_diff = sum(abs(a[t] - b[t]) for a, b in zip(counts, reference) for t in object_texts)
+
+    report.append({
+      "mode": mode,
+      "load_seconds": round(load_seconds, 3),
+      "seconds": round(seconds, 3),
+      "images_per_second": round(len(image_paths) / seconds, 3) if seconds else None,
+      "speedup_vs_fp32": round(reference_seconds / seconds, 3) if seconds else None,
+      "count_agreement": round(matching / len(image_paths), 4) if image_paths else None,
+      "mean_abs_count_diff": round(abs_diff / len(image_paths), 4) if image_paths else None,
+    })
+
+  detection.unload_model()
+  return report
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Compare OWLv2 CPU inference modes against fp32")
+  parser.add_argument("images", nargs="+", help="Image files or folders to sample")
+  parser.add_argument("--modes", nargs="+", choices=detection.INFERENCE_MODES, default=list(detection.INFERENCE_MODES))
+  parser.add_argument("--threshold", type=float, default=0.2)
+  parser.add_argument("--batch-size", type=int, default=8)
+  parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+  parser.add_argument("--model-save-path", default=detection.DEFAULT_MODEL_SAVE_PATH)
+  parser.add_argument("--json", help="Also write the report to this file")
+  args = parser.parse_args()
+
+  image_paths = expand_image_paths(args.images)
+  print(f"Comparing {', '.join(args.modes)} on {len(image_paths)} images...")
+  report = compare_inference_modes(image_paths,
+                                   modes=args.modes,
+                                   threshold=args.threshold,
+                                   batch_size=args.batch_size,
+                                   num_threads=args.threads,
+                                   model_save_path=args.model_save_path)
+
+  print(f"{'mode':<6} {'load s':>8} {'img/s':>8} {'speedup':>8} {'agree':>7} {'|diff|':>7}")
+  for row in report:
+    print(f"{row['mode']:<6} {row['load_seconds']:>8} {row['images_per_second']:>8} "
+          f"{row['speedup_vs_fp32']:>8} {row['count_agreement']:>7} {row['mean_abs_count_diff']:>7}")
+
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump(report, f, indent=2)
@@ -0,0 +1,169 @@
+"""
+Persistent on-disk store of OWLv2 detection results.
+
+Results are keyed by a fingerprint of the image file plus everything that
+changes the answer: model name, query vocabulary, threshold and box
+coordinate system.  Re-running over an unchanged folder only pays for
+inference on new or modified files.
+
+  cache = DetectionResultCache()
+  results = detect_and_count_batch(paths, OBJECTS_TO_DETECT, result_cache=cache)
+  print(cache.stats())
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from test_object_detection_using_owlv2 import vocabulary_key
+
+DEFAULT_RESULT_CACHE_PATH = "./owlv2-results.sqlite"
+
+# "stat" trusts (path, size, mtime); "sha256" hashes file contents, which
+# survives renames and copies but reads every byte of every file.
+FINGERPRINT_STAT = "stat"
+FINGERPRINT_SHA256 = "sha256"
+
+_LOOKUP_CHUNK_SIZE = 500
+_HASH_BLOCK_SIZE = 1 << 20
+_MAX_MEMOIZED_HASHES = 65536
+
+
+def file_fingerprint(image_path, mode=FINGERPRINT_STAT):
+  if mode == FINGERPRINT_STAT:
+    st = os.stat(image_path)
+    return f"stat:{os.path.abspath(image_path)}:{st.st_size}:{st.st_mtime_ns}"
+  if mode == FINGERPRINT_SHA256:
+    digest = hashlib.sha256()
+    with open(image_path, "rb") as f:
+      for block in iter(lambda: f.read(_HASH_BLOCK_SIZE), b""):
+        digest.update(block)
+    return f"sha256:{digest.hexdigest()}"
+  raise ValueError(f"Unknown fingerprint mode: {mode!r}")
+
+
+class DetectionResultCache:
+  """SQLite-backed detection result store, safe to share between threads."""
+
+  def __init__(self, db_path=DEFAULT_RESULT_CACHE_PATH, fingerprint=FINGERPRINT_STAT, hash_workers=8):
+    self.db_path = db_path
+    self.fingerprint_mode = fingerprint
+    self.hash_workers = hash_workers
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+    # stat fingerprint -> content fingerprint, so a lookup followed by a store
+    # doesn't hash the same unchanged file twice
+    self._hash_memo = {}
+    self._conn = sqlite3.connect(db_path, check_same_thread=False)
+    self._conn.execute("PRAGMA journal_mode=WAL")
+    self._conn.execute("""
+      CREATE TABLE IF NOT EXISTS results (
+        fingerprint TEXT NOT NULL,
+        model_name TEXT NOT NULL,
+        vocabulary TEXT NOT NULL,
+        threshold TEXT NOT NULL,
+        box_coords TEXT NOT NULL,
+        counts TEXT NOT NULL,
+        detections TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        PRIMARY KEY (fingerprint, model_name, vocabulary, threshold, box_coords)
+      )""")
+    self._conn.commit()
+
+  def _fingerprints(self, image_paths):
+    """Map each path to its fingerprint, or None if the file can't be read."""
+    def _safe(path):
+      try:
+        if self.fingerprint_mode != FINGERPRINT_SHA256:
+          return file_fingerprint(path, self.fingerprint_mode)
+        stat_fingerprint = file_fingerprint(path, FINGERPRINT_STAT)
+        fingerprint = self._hash_memo.get(stat_fingerprint)
+        if fingerprint is None:
+          fingerprint = file_fingerprint(path, FINGERPRINT_SHA256)
+          if len(self._hash_memo) >= _MAX_MEMOIZED_HASHES:
+            self._hash_memo.clear()
+          self._hash_memo[stat_fingerprint] = fingerprint
+        return fingerprint
+      except OSError:
+        return None
+    if self.fingerprint_mode == FINGERPRINT_SHA256 and len(image_paths) > 1:
+      with ThreadPoolExecutor(max_workers=self.hash_workers) as executor:
+        return dict(zip(image_paths, executor.map(_safe, image_paths)))
+    return {path: _safe(path) for path in image_paths}
+
+  @staticmethod
+  def _settings(object_texts, threshold, model_name, box_coords):
+    return (model_name, vocabulary_key(tuple(object_texts)), repr(float(threshold)), box_coords)
+
+  def get_many(self, image_paths, object_texts, threshold, model_name, box_coords):
+    """
+    Bulk lookup.  Returns {path: (counts_array, detections)} for the paths
+    that have a stored result; every other path counts as a miss.
+    """
+    image_paths = list(image_paths)
+    fingerprints = self._fingerprints(image_paths)
+    settings = self._settings(object_texts, threshold, model_name, box_coords)
+    wanted = [fp for fp in set(fingerprints.values()) if fp is not None]
+
+    stored = {}
+    with self._lock:
+      for start in range(0, len(wanted), _LOOKUP_CHUNK_SIZE):
+        chunk = wanted[start:start + _LOOKUP_CHUNK_SIZE]
+        rows = self._conn.execute(
+          "SELECT fingerprint, counts, detections FROM results"
+          " WHERE model_name = ? AND vocabulary = ? AND threshold = ? AND box_coords = ?"
+          f" AND fingerprint IN ({','.join('?' * len(chunk))})",
+          (*settings, *chunk))
+        for fingerprint, counts, detections in rows:
+          stored[fingerprint] = (json.loads(counts), json.loads(detections))
+
+      found = {path: stored[fp] for path, fp in fingerprints.items() if fp in stored}
+      hits = sum(1 for path in image_paths if path in found)
+      self.hits += hits
+      self.misses += len(image_paths) - hits
+    return found
+
+  def get(self, image_path, object_texts, threshold, model_name, box_coords):
+    return self.get_many([image_path], object_texts, threshold, model_name, box_coords).get(image_path)
+
+  def put_many(self, entries, object_texts, threshold, model_name, box_coords):
+    """Store `entries`, an iterable of (path, counts_array, detections)."""
+    settings = self._settings(object_texts, threshold, model_name, box_coords)
+    entries = list(entries)
+    fingerprints = self._fingerprints([path for path, _, _ in entries])
+    now = time.time()
+    rows = [(fingerprints[path], *settings, json.dumps(counts), json.dumps(detections), now)
+            for path, counts, detections in entries
+            if fingerprints[path] is not None]
+    with self._lock:
+      self._conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+      self._conn.commit()
+
+  def put(self, image_path, object_texts, threshold, model_name, box_coords, counts, detections):
+    self.put_many([(image_path, counts, detections)], object_texts, threshold, model_name, box_coords)
+
+  def stats(self):
+    with self._lock:
+      entries = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+      lookups = self.hits + self.misses
+      return {
+        "hits": self.hits,
+        "misses": self.misses,
+        "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        "entries": entries,
+      }
+
+  def clear(self):
+    with self._lock:
+      self._conn.execute("DELETE FROM results")
+      self._conn.commit()
+      self.hits = 0
+      self.misses = 0
+
+  def close(self):
+    with self._lock:
+      self._conn.close()
@@ -0,0 +1,266 @@
+"""
+Streaming OWLv2 detection pipeline.
+
+JPEG decode and resize run on a pool of workers while a single consumer
+runs batched inference, so decoding the next images overlaps with the
+model forward on the current batch.  With draft preprocessing the
+workers hand back small uint8 images, which the consumer normalizes into
+one reused batch tensor.
+
+  for result in iter_detect_and_count(paths, OBJECTS_TO_DETECT):
+    print(result["path"], result["counts"])
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import queue
+import threading
+
+import numpy as np
+
+from test_object_detection_using_owlv2 import (
+  BOX_COORDS_MODEL_INPUT,
+  DEFAULT_MODEL_NAME,
+  DEFAULT_MODEL_SAVE_PATH,
+  DEFAULT_TILE_OVERLAP,
+  DEFAULT_TILES_PER_SIDE,
+  INFERENCE_MODE_FP32,
+  PREPROCESS_DRAFT,
+  PREPROCESS_MODES,
+  PREPROCESS_PROCESSOR,
+  TILING_MODES,
+  TILING_OFF,
+  allocate_pixel_values,
+  detect_and_count_preprocessed,
+  detect_and_count_tiled,
+  fill_pixel_values,
+  get_model_and_processor,
+  load_image,
+  load_model_input,
+  result_cache_model_key,
+  tiling_key,
+)
+
+DEFAULT_BATCH_SIZE = 8
+DEFAULT_NUM_WORKERS = 4
+DEFAULT_MAX_PENDING = 32
+
+_DONE = object()
+
+# Set in each worker process by _init_process_worker
+_worker_image_processor = None
+_worker_preprocessing = None
+
+
+def _decode_and_preprocess(image_path, image_processor, preprocessing):
+  if preprocessing == PREPROCESS_DRAFT:
+    # Normalization happens in the consumer, straight into the batch tensor
+    return load_model_input(image_path, image_processor)
+  image = load_image(image_path)
+  # numpy keeps the hand-off cheap to pickle when workers are processes
+  return image_processor(images=image, return_tensors="np")["pixel_values"][0], image.size
+
+def _init_process_worker(image_processor, preprocessing):
+  global _worker_image_processor, _worker_preprocessing
+  _worker_image_processor = image_processor
+  _worker_preprocessing = preprocessing
+
+def _decode_in_worker_process(image_path):
+  return _decode_and_preprocess(image_path, _worker_image_processor, _worker_preprocessing)
+
+
+def _produce(image_paths, executor, image_processor, preprocessing, use_processes, ready, slots, stop, cache_lookup):
+  """Submit decode jobs, holding one of `slots` per image until the consumer takes it."""
+  submitted = 0
+  try:
+    for index, path in enumerate(image_paths):
+      while not slots.acquire(timeout=0.1):
+        if stop.is_set():
+          return
+      if stop.is_set():
+        return
+      cached = cache_lookup(path) if cache_lookup is not None else None
+      if cached is not None:
+        ready.put((index, path, None, cached))
+      else:
+        if use_processes:
+          future = executor.submit(_decode_in_worker_process, path)
+        else:
+          future = executor.submit(_decode_and_preprocess, path, image_processor, preprocessing)
+        future.add_done_callback(lambda f, index=index, path=path: ready.put((index, path, f, None)))
+      submitted += 1
+  except Exception as e:
+    ready.put((_DONE, submitted, e))
+    return
+  ready.put((_DONE, submitted, None))
+
+
+def iter_detect_and_count(image_paths,
+                          object_texts,
+                          threshold=0.2,
+                          batch_size=DEFAULT_BATCH_SIZE,
+                          num_workers=DEFAULT_NUM_WORKERS,
+                          max_pending=DEFAULT_MAX_PENDING,
+                          ordered=True,
+                          use_processes=False,
+                          processor=None,
+                          model=None,
+                          model_name=DEFAULT_MODEL_NAME,
+                          model_save_path=DEFAULT_MODEL_SAVE_PATH,
+                          box_coords=BOX_COORDS_MODEL_INPUT,
+                          result_cache=None,
+                          inference_mode=INFERENCE_MODE_FP32,
+                          preprocessing=PREPROCESS_PROCESSOR,
+                          tiling=TILING_OFF,
+                          tiles_per_side=DEFAULT_TILES_PER_SIDE,
+                          tile_overlap=DEFAULT_TILE_OVERLAP,
+                          embedding_index=None):
+  """
+  Detect objects in `image_paths` (any iterable, consumed lazily) and yield
+  one result per image as soon as it is ready:
+
+    {"index": int, "path": str, "counts": [...], "detections": [...], "error": None}
+
+  `counts` and `detections` have the same shape as `detect_and_count`.  An
+  image that fails to decode yields a result with `error` set and
+  `counts`/`detections` set to None instead of stopping the stream.
+
+  - num_workers: decode/preprocess workers (threads, or processes when
+    `use_processes` is True; they are spawned, so a calling script needs an
+    `if __name__ == "__main__":` guard)
+  - max_pending: bound on images decoded or in flight but not yet consumed;
+    the producer blocks when it is reached, which caps memory use
+  - ordered: yield in input order; otherwise yield in completion order
+  - box_coords: coordinate system of returned boxes, as in `detect_and_count`
+  - result_cache: optional DetectionResultCache; hits skip decode and
+    inference entirely and fresh results are written back per batch
+  - preprocessing: PREPROCESS_PROCESSOR (the default) or PREPROCESS_DRAFT
+    (reduced-resolution JPEG decode), as in `detect_and_count`
+  - tiling, tiles_per_side, tile_overlap: tiled detection of small objects,
+    as in `detect_and_count`; tiles run on the consumer after each batch
+  - embedding_index: optional embedding_index.EmbeddingIndex that receives
+    the image embedding of every image run through the model
+  """
+  if batch_size < 1:
+    raise ValueError("batch_size must be at least 1")
+  if preprocessing not in PREPROCESS_MODES:
+    raise ValueError(f"Unknown preprocessing: {preprocessing!r}")
+  if tiling not in TILING_MODES:
+    raise ValueError(f"Unknown tiling: {tiling!r}")
+  if processor is None or model is None:
+    processor, model = get_model_and_processor(model_name, model_save_path, inference_mode=inference_mode)
+  max_pending = max(max_pending, batch_size)
+
+  image_processor = processor.image_processor
+  if use_processes:
+    # Spawned rather than forked: a forked copy of a process that already imported torch can deadlock
+    executor = ProcessPoolExecutor(max_workers=num_workers,
+                                   mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_init_process_worker,
+                                   initargs=(image_processor, preprocessing))
+  else:
+    executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="owlv2-decode")
+
+  model_key = result_cache_model_key(model_name, inference_mode, preprocessing,
+                                     tiling_key(tiling, tiles_per_side, tile_overlap))
+  cache_settings = (object_texts, threshold, model_key, box_coords)
+  cache_lookup = None
+  if result_cache is not None:
+    def cache_lookup(path):
+      return result_cache.get(path, *cache_settings)
+
+  ready = queue.Queue()
+  slots = threading.BoundedSemaphore(max_pending)
+  stop = threading.Event()
+  producer = threading.Thread(target=_produce,
+                              args=(image_paths, executor, image_processor, preprocessing, use_processes, ready, slots, stop,
+                                    cache_lookup),
+                              daemon=True)
+  producer.start()
+
+  batch_buffer = allocate_pixel_values(batch_size, image_processor) if preprocessing == PREPROCESS_DRAFT else None
+  submitted = None
+  received = 0
+  next_index = 0
+  finished = {}
+
+  def _emit(result):
+    nonlocal next_index
+    if not ordered:
+      yield result
+      return
+    finished[result["index"]] = result
+    while next_index in finished:
+      yield finished.pop(next_index)
+      next_index += 1
+
+  try:
+    while submitted is None or received < submitted:
+      # Block for one item, then take whatever else is already decoded
+      items = [ready.get()]
+      while len(items) < batch_size:
+        try:
+          items.append(ready.get_nowait())
+        except queue.Empty:
+          break
+
+      batch = []
+      for item in items:
+        if item[0] is _DONE:
+          _, submitted, error = item
+          if error is not None:
+            raise error
+          continue
+        index, path, future, cached = item
+        received += 1
+        slots.release()
+        if cached is not None:
+          counts, detections = cached
+          yield from _emit({"index": index, "path": path, "counts": counts, "detections": detections, "error": None})
+          continue
+        try:
+          pixel_values, image_size = future.result()
+          batch.append((index, path, pixel_values, image_size))
+        except Exception as e:
+          yield from _emit({"index": index, "path": path, "counts": None, "detections": None, "error": str(e)})
+
+      if batch:
+        if batch_buffer is not None:
+          pixel_values = fill_pixel_values([pixels for _, _, pixels, _ in batch], image_processor, batch_buffer[:len(batch)])
+        else:
+          pixel_values = np.stack([pixel_values for _, _, pixel_values, _ in batch])
+        image_sizes = [image_size for _, _, _, image_size in batch]
+        embeddings = [] if embedding_index is not None else None
+        if tiling == TILING_OFF:
+          results = detect_and_count_preprocessed(pixel_values,
+                                                  object_texts,
+                                                  threshold,
+                                                  processor,
+                                                  model,
+                                                  image_sizes=image_sizes,
+                                                  box_coords=box_coords,
+                                                  inference_mode=inference_mode,
+                                                  embeddings_out=embeddings)
+        else:
+          results = detect_and_count_tiled([path for _, path, _, _ in batch],
+                                           pixel_values,
+                                           image_sizes,
+                                           object_texts,
+                                           threshold,
+                                           processor,
+                                           model,
+                                           box_coords=box_coords,
+                                           inference_mode=inference_mode,
+                                           tiling=tiling,
+                                           tiles_per_side=tiles_per_side,
+                                           tile_overlap=tile_overlap,
+                                           embeddings_out=embeddings)
+        if embedding_index is not None:
+          embedding_index.add_many(zip([path for _, path, _, _ in batch], embeddings))
+        if result_cache is not None:
+          result_cache.put_many([(path, counts, detections) for (_, path, _, _), (counts, detections) in zip(batch, results)],
+                                *cache_settings)
+        for (index, path, _, _), (counts, detections) in zip(batch, results):
+          yield from _emit({"index": index, "path": path, "counts": counts, "detections": detections, "error": None})
+  finally:
+    stop.set()
+    executor.shutdown(wait=False, cancel_futures=True)
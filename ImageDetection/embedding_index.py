@@ -0,0 +1,394 @@
+"""
+Semantic photo search over stored OWLv2 image embeddings.
+
+One L2-normalized image embedding per photo is kept in a memory-mapped
+float16 matrix, with a SQLite table mapping matrix rows to file paths.
+A text query is encoded once by the text tower and scored against every
+row with a single matrix product, so searching the library never runs the
+vision tower again.
+
+  from test_object_detection_using_owlv2 import DEFAULT_MODEL_NAME, get_model_and_processor
+
+  processor, model = get_model_and_processor()
+  index = EmbeddingIndex("./embedding-index", model_key=DEFAULT_MODEL_NAME)
+  index_images(paths, index, processor, model)
+  for path, score in search_text(index, "a dog on the beach", processor, model, k=10):
+    print(path, score)
+
+Embeddings are also added as a side effect of detection by passing the
+index as `embedding_index` to detect_and_count(_batch).  For large
+libraries `build_ivf` clusters the rows so that a query only scores the
+few closest clusters.
+"""
+import os
+import sqlite3
+import threading
+
+import numpy as np
+import torch
+
+DEFAULT_K = 20
+DEFAULT_NPROBE = 16          # IVF clusters scored per query
+MATRIX_FILENAME = "embeddings.f16"
+DB_FILENAME = "embeddings.sqlite"
+_MIN_CAPACITY = 1024         # rows; the matrix file doubles when full
+_SEARCH_CHUNK_ROWS = 65536   # rows scored per matrix product
+_RERANK_FACTOR = 4           # float16 candidates per result re-scored in float32
+_KMEANS_ITERATIONS = 10
+_KMEANS_SAMPLE_PER_LIST = 64  # training points per cluster
+
+
+def normalize(vectors):
+  vectors = np.asarray(vectors, dtype=np.float32)
+  norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+  return vectors / np.maximum(norms, 1e-12)
+
+def _file_signature(path):
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return st.st_size, st.st_mtime_ns
+
+
+class EmbeddingIndex:
+  """
+  Append-only store of image embeddings for photos, searchable by vector.
+
+  Re-adding a photo overwrites its row in place; rows of photos that were
+  removed with `remove` or `prune` are skipped by searches.  `model_key`
+  identifies the model that produced the embeddings, and opening an index
+  built by a different model raises ValueError.  Safe to share between
+  threads.
+  """
+
+  def __init__(self, directory, model_key=None):
+    self.directory = directory
+    os.makedirs(directory, exist_ok=True)
+    self._matrix_path = os.path.join(directory, MATRIX_FILENAME)
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(os.path.join(directory, DB_FILENAME), check_same_thread=False)
+    self._conn.execute("PRAGMA journal_mode=WAL")
+    self._conn.execute("""
+      CREATE TABLE IF NOT EXISTS embeddings (
+        row INTEGER PRIMARY KEY,
+        path TEXT NOT NULL UNIQUE,
+        size INTEGER,
+        mtime_ns INTEGER,
+        live INTEGER NOT NULL DEFAULT 1,
+        list INTEGER
+      )""")
+    self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    self._conn.commit()
+
+    meta = dict(self._conn.execute("SELECT key, value FROM meta"))
+    if model_key is not None and meta.get("model_key", model_key) != model_key:
+      raise ValueError(f"Embedding index at {directory} was built with {meta['model_key']}, not {model_key}")
+    if model_key is not None and "model_key" not in meta:
+      self._set_meta("model_key", model_key)
+    self.model_key = model_key or meta.get("model_key")
+    self.dim = int(meta["dim"]) if "dim" in meta else None
+
+    self._count = self._conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM embeddings").fetchone()[0]
+    self._matrix = None
+    self._capacity = 0
+    if self.dim is not None:
+      self._map(max(self._count, os.path.getsize(self._matrix_path) // (2 * self.dim)))
+    self._live = None      # cached bool array over rows, rebuilt after writes
+    self._ivf = None       # (centroids, list per row) once build_ivf has run
+    self._load_ivf()
+
+  def _set_meta(self, key, value):
+    self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+    self._conn.commit()
+
+  def _map(self, capacity):
+    """(Re)map the matrix file with room for `capacity` rows, growing the file if needed."""
+    capacity = max(capacity, _MIN_CAPACITY)
+    if self._matrix is not None:
+      self._matrix.flush()
+    with open(self._matrix_path, "ab") as f:
+      if f.tell() < capacity * self.dim * 2:
+        f.truncate(capacity * self.dim * 2)
+    self._matrix = np.memmap(self._matrix_path, dtype=np.float16, mode="r+", shape=(capacity, self.dim))
+    self._capacity = capacity
+
+  def _load_ivf(self):
+    path = os.path.join(self.directory, "ivf_centroids.npy")
+    if not os.path.exists(path):
+      return
+    centroids = np.load(path)
+    lists = np.full(self._count, -1, dtype=np.int32)
+    for row, cluster in self._conn.execute("SELECT row, list FROM embeddings WHERE list IS NOT NULL"):
+      lists[row] = cluster
+    self._ivf = (centroids, lists)
+
+  def __len__(self):
+    with self._lock:
+      return self._conn.execute("SELECT COUNT(*) FROM embeddings WHERE live = 1").fetchone()[0]
+
+  def missing(self, image_paths):
+    """Paths with no embedding, or whose file changed since it was embedded."""
+    image_paths = [os.path.abspath(path) for path in image_paths]
+    with self._lock:
+      known = {}
+      for start in range(0, len(image_paths), 500):
+        chunk = image_paths[start:start + 500]
+        known.update((path, (size, mtime_ns)) for path, size, mtime_ns in self._conn.execute(
+          f"SELECT path, size, mtime_ns FROM embeddings WHERE live = 1 AND path IN ({','.join('?' * len(chunk))})",
+          chunk))
+    return [path for path in image_paths if known.get(path) != _file_signature(path)]
+
+  def add_many(self, entries):
+    """Store `entries`, an iterable of (path, embedding); embeddings are normalized here."""
+    entries = [(os.path.abspath(path), vector) for path, vector in entries]
+    if not entries:
+      return
+    vectors = normalize([vector for _, vector in entries])
+    with self._lock:
+      if self.dim is None:
+        self.dim = vectors.shape[1]
+        self._set_meta("dim", self.dim)
+      if vectors.shape[1] != self.dim:
+        raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match the index ({self.dim})")
+
+      existing = {}
+      for start in range(0, len(entries), 500):
+        chunk = [path for path, _ in entries[start:start + 500]]
+        existing.update(self._conn.execute(
+          f"SELECT path, row FROM embeddings WHERE path IN ({','.join('?' * len(chunk))})", chunk))
+      rows = []
+      for path, _ in entries:
+        if path not in existing:
+          existing[path] = self._count
+          self._count += 1
+        rows.append(existing[path])
+      if self._count > self._capacity:
+        self._map(max(self._count, 2 * self._capacity))
+      self._matrix[rows] = vectors.astype(np.float16)
+      self._matrix.flush()
+
+      lists = [None] * len(rows)
+      if self._ivf is not None:
+        centroids, row_lists = self._ivf
+        lists = (vectors @ centroids.T).argmax(axis=1).tolist()
+        if len(row_lists) < self._count:
+          row_lists = np.concatenate([row_lists, np.full(self._count - len(row_lists), -1, dtype=np.int32)])
+        row_lists[rows] = lists
+        self._ivf = (centroids, row_lists)
+      self._conn.executemany(
+        "INSERT OR REPLACE INTO embeddings (row, path, size, mtime_ns, live, list) VALUES (?, ?, ?, ?, 1, ?)",
+        [(row, path, *(_file_signature(path) or (None, None)), cluster)
+         for row, (path, _), cluster in zip(rows, entries, lists)])
+      self._conn.commit()
+      self._live = None
+
+  def remove(self, image_paths):
+    """Drop photos from search results; their rows are reused if they are added again."""
+    image_paths = [os.path.abspath(path) for path in image_paths]
+    with self._lock:
+      self._conn.executemany("UPDATE embeddings SET live = 0 WHERE path = ?", [(path,) for path in image_paths])
+      self._conn.commit()
+      self._live = None
+
+  def prune(self):
+    """Remove photos whose files no longer exist; returns how many were removed."""
+    with self._lock:
+      paths = [path for (path,) in self._conn.execute("SELECT path FROM embeddings WHERE live = 1")]
+    gone = [path for path in paths if not os.path.exists(path)]
+    self.remove(gone)
+    return len(gone)
+
+  def _live_rows(self, folder=None):
+    """Bool mask over rows of photos to search, optionally only those under `folder`."""
+    if folder is None and self._live is not None:
+      return self._live
+    mask = np.zeros(self._count, dtype=bool)
+    if folder is None:
+      rows = self._conn.execute("SELECT row FROM embeddings WHERE live = 1")
+    else:
+      prefix = os.path.join(os.path.abspath(folder), "")
+      rows = self._conn.execute("SELECT row FROM embeddings WHERE live = 1 AND substr(path, 1, ?) = ?",
+                                (len(prefix), prefix))
+    mask[[row for (row,) in rows]] = True
+    if folder is None:
+      self._live = mask
+    return mask
+
+  def search(self, query_vectors, k=DEFAULT_K, folder=None, nprobe=DEFAULT_NPROBE, exact=False):
+    """
+    Top-`k` photos for each query vector by cosine similarity.
+
+    Returns one [(path, score)] list per query, best first.  Scoring is a
+    brute-force matrix product over all rows unless `build_ivf` has run,
+    in which case only rows in the `nprobe` clusters closest to each query
+    are scored; `exact=True` always scores every row.
+    """
+    if k < 1:
+      raise ValueError("k must be at least 1")
+    queries = normalize(np.atleast_2d(query_vectors))
+    with self._lock:
+      if self.dim is None or self._count == 0:
+        return [[] for _ in queries]
+      # Score a snapshot outside the lock; rows added meanwhile are simply not seen
+      count = self._count
+      candidates = self._live_rows(folder)[:count]
+      matrix = self._matrix[:count]
+      ivf = None if exact else self._ivf
+
+    # Candidates are scored in float16, which torch multiplies much faster than
+    # numpy converts to float32; the best few are then re-scored exactly
+    half_queries = torch.from_numpy(queries).half()
+    if ivf is None:
+      # Contiguous slices, every query at once
+      all_scores = torch.empty((count, len(queries)), dtype=torch.float32)
+      for start in range(0, count, _SEARCH_CHUNK_ROWS):
+        chunk = torch.from_numpy(np.asarray(matrix[start:start + _SEARCH_CHUNK_ROWS]))
+        all_scores[start:start + len(chunk)] = (chunk @ half_queries.T).float()
+      rows = np.flatnonzero(candidates)
+      per_query = [(rows, all_scores[torch.from_numpy(rows), i]) for i in range(len(queries))]
+    else:
+      centroids, lists = ivf
+      per_query = []
+      for query, half_query in zip(queries, half_queries):
+        probe = np.argsort(-(centroids @ query))[:nprobe]
+        rows = np.flatnonzero(candidates & np.isin(lists[:count], probe))
+        per_query.append((rows, (torch.from_numpy(matrix[rows]) @ half_query).float()))
+
+    found = []
+    for (rows, scores), query in zip(per_query, queries):
+      if len(rows) > k * _RERANK_FACTOR:
+        rows = rows[scores.topk(k * _RERANK_FACTOR).indices.numpy()]
+      exact_scores = matrix[rows].astype(np.float32) @ query
+      top = np.argsort(-exact_scores)[:k]
+      found.append([(int(rows[i]), float(exact_scores[i])) for i in top])
+
+    row_paths = {}
+    wanted = sorted({row for matches in found for row, _ in matches})
+    with self._lock:
+      for start in range(0, len(wanted), 500):
+        chunk = wanted[start:start + 500]
+        row_paths.update(self._conn.execute(
+          f"SELECT row, path FROM embeddings WHERE row IN ({','.join('?' * len(chunk))})", chunk))
+    return [[(row_paths[row], round(score, 4)) for row, score in matches] for matches in found]
+
+  def build_ivf(self, n_lists=None, iterations=_KMEANS_ITERATIONS, seed=0):
+    """
+    Cluster the stored embeddings with spherical k-means into `n_lists`
+    inverted lists (default about sqrt(rows)).  Later additions are
+    assigned to the nearest existing cluster; rebuild after the library
+    has grown a lot.  Returns the number of lists.
+    """
+    with self._lock:
+      if self.dim is None or self._count == 0:
+        return 0
+      matrix = self._matrix[:self._count]
+      n_lists = n_lists or max(1, int(np.sqrt(self._count)))
+      n_lists = min(n_lists, self._count)
+      rng = np.random.default_rng(seed)
+      sample_size = min(self._count, n_lists * _KMEANS_SAMPLE_PER_LIST)
+      sample_rows = np.sort(rng.choice(self._count, sample_size, replace=False))
+      sample = matrix[sample_rows].astype(np.float32)
+      centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+      for _ in range(iterations):
+        assignment = (sample @ centroids.T).argmax(axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        empty = ~sums.any(axis=1)
+        # An empty cluster restarts at a random sample point
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = normalize(sums)
+
+      lists = np.empty(self._count, dtype=np.int32)
+      for start in range(0, self._count, _SEARCH_CHUNK_ROWS):
+        chunk = matrix[start:start + _SEARCH_CHUNK_ROWS].astype(np.float32)
+        lists[start:start + len(chunk)] = (chunk @ centroids.T).argmax(axis=1)
+      np.save(os.path.join(self.directory, "ivf_centroids.npy"), centroids)
+      self._conn.executemany("UPDATE embeddings SET list = ? WHERE row = ?",
+                             [(int(cluster), row) for row, cluster in enumerate(lists)])
+      self._conn.commit()
+      self._ivf = (centroids, lists)
+      return n_lists
+
+  def stats(self):
+    with self._lock:
+      live, total = self._conn.execute("SELECT COALESCE(SUM(live), 0), COUNT(*) FROM embeddings").fetchone()
+    return {
+      "photos": live,
+      "rows": total,
+      "dim": self.dim,
+      "model_key": self.model_key,
+      "ivf_lists": len(self._ivf[0]) if self._ivf is not None else 0,
+      "matrix_bytes": self._capacity * (self.dim or 0) * 2,
+    }
+
+  def clear(self):
+    with self._lock:
+      self._conn.execute("DELETE FROM embeddings")
+      self._conn.execute("DELETE FROM meta WHERE key = 'dim'")
+      self._conn.commit()
+      self._matrix = None
+      self._capacity = 0
+      self._count = 0
+      self.dim = None
+      self._live = None
+      self._ivf = None
+      for filename in (MATRIX_FILENAME, "ivf_centroids.npy"):
+        path = os.path.join(self.directory, filename)
+        if os.path.exists(path):
+          os.remove(path)
+
+  def close(self):
+    with self._lock:
+      if self._matrix is not None:
+        self._matrix.flush()
+      self._conn.close()
+
+
+def index_images(image_paths, index, processor=None, model=None, batch_size=8, model_name=None, model_save_path=None,
+                 inference_mode=None):
+  """
+  Embed the photos of `image_paths` that `index` doesn't have yet (or that
+  changed) and add them.  Only the vision tower runs, on reduced-resolution
+  decodes.  Unreadable files are skipped.  Returns the number of photos
+  added.
+  """
+  import test_object_detection_using_owlv2 as detection
+
+  pending = index.missing(image_paths)
+  if not pending:
+    return 0
+  inference_mode = inference_mode or detection.INFERENCE_MODE_FP32
+  if processor is None or model is None:
+    processor, model = detection.get_model_and_processor(model_name or detection.DEFAULT_MODEL_NAME,
+                                                         model_save_path or detection.DEFAULT_MODEL_SAVE_PATH,
+                                                         inference_mode=inference_mode)
+  image_processor = processor.image_processor
+  buffer = detection.allocate_pixel_values(min(batch_size, len(pending)), image_processor)
+  added = 0
+  for start in range(0, len(pending), batch_size):
+    paths, pixels = [], []
+    for path in pending[start:start + batch_size]:
+      try:
+        pixels.append(detection.load_model_input(path, image_processor)[0])
+        paths.append(path)
+      except Exception:
+        continue
+    if not paths:
+      continue
+    pixel_values = detection.fill_pixel_values(pixels, image_processor, buffer[:len(paths)])
+    embeddings = detection.compute_image_embeddings(pixel_values, model, inference_mode).cpu().numpy()
+    index.add_many(zip(paths, embeddings))
+    added += len(paths)
+  return added
+
+def encode_text(texts, processor, model):
+  """Normalized (len(texts), dim) text embeddings in the image embedding space."""
+  import test_object_detection_using_owlv2 as detection
+
+  query_embeds, _ = detection.encode_text_queries(list(texts), processor, model)
+  return normalize(query_embeds.float().cpu().numpy())
+
+def search_text(index, query, processor, model, k=DEFAULT_K, folder=None):
+  """[(path, score)] of the `k` photos that best match the text `query`."""
+  return index.search(encode_text([query], processor, model), k=k, folder=folder)[0]
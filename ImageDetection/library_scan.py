@@ -0,0 +1,421 @@
+"""
+Scan a whole photo library with OWLv2 on every core.
+
+  python library_scan.py ~/Pictures --output scan.jsonl --workers 4
+  python library_scan.py ~/Pictures --output scan.jsonl --parquet scan.parquet
+
+The images found under the given folders are cut into chunks of
+neighbouring files that N worker processes pull from a shared queue, so a
+folder of large photos doesn't leave the other workers idle.  Each worker
+holds one copy of the model and streams its chunks through
+iter_detect_and_count with cores / N intra-op threads, so the workers
+together don't oversubscribe the CPU.
+
+Results are appended to a JSONL file, one line per image, as they arrive,
+and that file is the checkpoint: running the same command again skips
+every image already in it, so an interrupted scan resumes where it
+stopped.  The scan settings are kept next to it in <output>.settings.json,
+and resuming with different settings is refused rather than mixing results.
+"""
+import argparse
+import collections
+import datetime
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import time
+
+from compare_inference_modes import expand_image_paths
+from detection_pipeline import DEFAULT_BATCH_SIZE, iter_detect_and_count
+import test_object_detection_using_owlv2 as detection
+
+DEFAULT_CHUNK_SIZE = 32
+# Intra-op threads per worker when --workers isn't given; OWLv2 on the CPU
+# gets more images/s from several such processes than from one wide one
+DEFAULT_THREADS_PER_WORKER = 4
+# Seconds between progress updates, and between fsyncs of the output
+PROGRESS_INTERVAL = 1.0
+# Progress is logged this often instead when stderr isn't a terminal
+PROGRESS_LOG_INTERVAL = 30.0
+# Throughput (and so the ETA) is measured over this many recent seconds
+THROUGHPUT_WINDOW = 60.0
+
+
+def available_cores():
+  try:
+    return len(os.sched_getaffinity(0))
+  except AttributeError:
+    return os.cpu_count() or 1
+
+def plan_workers(workers=None, threads_per_worker=None):
+  """(workers, threads per worker) that together use each available core once."""
+  cores = available_cores()
+  if workers is None:
+    workers = max(1, cores // (threads_per_worker or DEFAULT_THREADS_PER_WORKER))
+  if threads_per_worker is None:
+    threads_per_worker = max(1, cores // workers)
+  return workers, threads_per_worker
+
+def settings_path(output_path):
+  return output_path + ".settings.json"
+
+def load_checkpoint(output_path):
+  """
+  Map each path already in the JSONL `output_path` to its error (None on
+  success); the last line for a path wins.  A last line cut off by an
+  interrupted write is truncated away.
+  """
+  done = {}
+  if not os.path.exists(output_path):
+    return done
+  with open(output_path, "r+b") as f:
+    valid_end = 0
+    for line in f:
+      try:
+        record = json.loads(line) if line.endswith(b"\n") else None
+      except ValueError:
+        record = None
+      if record is None:
+        if f.read(1):
+          raise ValueError(f"Malformed line at byte {valid_end} of {output_path}")
+        break
+      done[record["path"]] = record.get("error")
+      valid_end += len(line)
+    f.truncate(valid_end)
+  return done
+
+def check_settings(output_path, settings):
+  """Record `settings` for a new scan, or refuse to resume one made with different settings."""
+  path = settings_path(output_path)
+  if os.path.exists(path):
+    with open(path, encoding="utf-8") as f:
+      previous = json.load(f)
+    if previous != settings:
+      changed = sorted(key for key in settings.keys() | previous.keys() if settings.get(key) != previous.get(key))
+      raise ValueError(f"{output_path} was scanned with different {', '.join(changed)}; "
+                       f"use a new --output or delete it and {path}")
+    return
+  with open(path, "w", encoding="utf-8") as f:
+    json.dump(settings, f, indent=2)
+
+
+def _queued_paths(task_queue):
+  while True:
+    chunk = task_queue.get()
+    if chunk is None:
+      return
+    yield from chunk
+
+def _scan_worker(worker_id, task_queue, result_queue, settings, model_save_path, num_threads, batch_size):
+  try:
+    processor, model = detection.get_model_and_processor(settings["model_name"],
+                                                         model_save_path,
+                                                         inference_mode=settings["inference_mode"],
+                                                         num_threads=num_threads)
+    result_queue.put(("ready", worker_id, None))
+    # One decode thread and two batches of prefetch: inference dominates, more decode threads
+    # would compete with torch's, and paths held here can't go to an idle worker
+    results = iter_detect_and_count(_queued_paths(task_queue),
+                                    settings["objects"],
+                                    threshold=settings["threshold"],
+                                    batch_size=batch_size,
+                                    num_workers=1,
+                                    max_pending=2 * batch_size,
+                                    ordered=False,
+                                    processor=processor,
+                                    model=model,
+                                    model_name=settings["model_name"],
+                                    box_coords=settings["box_coords"],
+                                    inference_mode=settings["inference_mode"],
+                                    tiling=settings["tiling"])
+    for result in results:
+      record = {"path": result["path"], "counts": result["counts"], "detections": result["detections"],
+                "error": result["error"]}
+      result_queue.put(("result", worker_id, record))
+  except KeyboardInterrupt:
+    return
+  except Exception as e:
+    result_queue.put(("failed", worker_id, f"{type(e).__name__}: {e}"))
+    return
+  result_queue.put(("done", worker_id, None))
+
+
+class ScanProgress:
+  """Live images/s and ETA on stderr: one updating line on a terminal, a periodic log line otherwise."""
+
+  def __init__(self, total, stream=sys.stderr):
+    self.total = total
+    self.completed = 0
+    self.errors = 0
+    self.ready_workers = 0
+    self.stream = stream
+    self.interactive = stream.isatty()
+    self.start = time.monotonic()
+    self._window = collections.deque([(self.start, 0)])
+    self._last_render = 0.0
+
+  def images_per_second(self):
+    (first_time, first_count), (last_time, last_count) = self._window[0], self._window[-1]
+    return (last_count - first_count) / (last_time - first_time) if last_time > first_time else 0.0
+
+  def line(self):
+    rate = self.images_per_second()
+    remaining = self.total - self.completed
+    eta = str(datetime.timedelta(seconds=int(remaining / rate))) if rate else "--:--:--"
+    percent = 100 * self.completed / self.total if self.total else 100.0
+    return (f"{self.completed}/{self.total} ({percent:.1f}%)  {rate:.2f} img/s  ETA {eta}  "
+            f"errors {self.errors}  workers ready {self.ready_workers}")
+
+  def update(self, force=False):
+    now = time.monotonic()
+    self._window.append((now, self.completed))
+    while len(self._window) > 2 and now - self._window[0][0] > THROUGHPUT_WINDOW:
+      self._window.popleft()
+    interval = PROGRESS_INTERVAL if self.interactive else PROGRESS_LOG_INTERVAL
+    if not force and now - self._last_render < interval:
+      return
+    self._last_render = now
+    if self.interactive:
+      self.stream.write("\r\033[K" + self.line())
+    else:
+      self.stream.write(self.line() + "\n")
+    self.stream.flush()
+
+  def close(self):
+    self.update(force=True)
+    if self.interactive:
+      self.stream.write("\n")
+
+
+def run_scan(image_paths,
+             output_path,
+             object_texts=detection.OBJECTS_TO_DETECT,
+             threshold=0.2,
+             workers=None,
+             threads_per_worker=None,
+             chunk_size=DEFAULT_CHUNK_SIZE,
+             batch_size=DEFAULT_BATCH_SIZE,
+             model_name=detection.DEFAULT_MODEL_NAME,
+             model_save_path=detection.DEFAULT_MODEL_SAVE_PATH,
+             inference_mode=detection.INFERENCE_MODE_FP32,
+             tiling=detection.TILING_OFF,
+             box_coords=detection.BOX_COORDS_MODEL_INPUT,
+             retry_errors=False,
+             progress=True):
+  """
+  Detect `object_texts` in every image of `image_paths` that `output_path`
+  doesn't hold yet, appending one JSONL line per image:
+
+    {"path": str, "counts": [...], "detections": [...], "error": None}
+
+  with `counts` and `detections` shaped as in `detect_and_count`.  Images
+  that failed before are skipped too unless `retry_errors` is set.
+
+  Returns a summary dict.  Its "failed_workers" lists workers that died
+  (for instance killed for memory); their unfinished images are picked up
+  by running the scan again.
+  """
+  if chunk_size < 1:
+    raise ValueError("chunk_size must be at least 1")
+  if inference_mode not in detection.INFERENCE_MODES:
+    raise ValueError(f"Unknown inference_mode: {inference_mode!r}")
+  if tiling not in detection.TILING_MODES:
+    raise ValueError(f"Unknown tiling: {tiling!r}")
+  settings = {"objects": list(object_texts), "threshold": threshold, "model_name": model_name,
+              "inference_mode": inference_mode, "tiling": tiling, "box_coords": box_coords}
+  output_path = os.path.abspath(output_path)
+  check_settings(output_path, settings)
+
+  done = load_checkpoint(output_path)
+  image_paths = list(dict.fromkeys(os.path.abspath(path) for path in image_paths))
+  todo = [path for path in image_paths if path not in done or (retry_errors and done[path] is not None)]
+  summary = {"images": len(image_paths), "skipped": len(image_paths) - len(todo), "scanned": 0, "errors": 0,
+             "seconds": 0.0, "images_per_second": None, "failed_workers": []}
+  if not todo:
+    return summary
+
+  if model_save_path is not None and not detection.is_model_downloaded(model_save_path):
+    # Once here, rather than racing N workers to download the same weights
+    print("Downloading and saving model and processor...", file=sys.stderr)
+    detection.download_and_save_model_and_processor(model_name, model_save_path)
+
+  workers, threads_per_worker = plan_workers(workers, threads_per_worker)
+  workers = min(workers, -(-len(todo) // chunk_size))
+  # Spawned rather than forked: a forked copy of a process that already imported torch can deadlock
+  context = multiprocessing.get_context("spawn")
+  task_queue = context.Queue()
+  result_queue = context.Queue()
+  for start in range(0, len(todo), chunk_size):
+    task_queue.put(todo[start:start + chunk_size])
+  for _ in range(workers):
+    task_queue.put(None)
+
+  # Size the OpenMP/MKL pools of each worker before torch starts in it
+  saved_env = {name: os.environ.get(name) for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS")}
+  os.environ.update({name: str(threads_per_worker) for name in saved_env})
+  try:
+    processes = [context.Process(target=_scan_worker,
+                                 args=(worker_id, task_queue, result_queue, settings, model_save_path,
+                                       threads_per_worker, batch_size),
+                                 name=f"owlv2-scan-{worker_id}",
+                                 daemon=True)
+                 for worker_id in range(workers)]
+    for process in processes:
+      process.start()
+  finally:
+    for name, value in saved_env.items():
+      if value is None:
+        os.environ.pop(name, None)
+      else:
+        os.environ[name] = value
+
+  tracker = ScanProgress(len(todo)) if progress else None
+  finished = set()
+  start = time.monotonic()
+  last_sync = start
+  try:
+    with open(output_path, "a", encoding="utf-8") as out:
+      while len(finished) < workers:
+        try:
+          kind, worker_id, payload = result_queue.get(timeout=PROGRESS_INTERVAL)
+        except queue.Empty:
+          for worker_id, process in enumerate(processes):
+            if worker_id not in finished and not process.is_alive():
+              finished.add(worker_id)
+              summary["failed_workers"].append({"worker": worker_id, "error": f"exited with code {process.exitcode}"})
+          kind = None
+        if kind == "result":
+          out.write(json.dumps(payload) + "\n")
+          summary["scanned"] += 1
+          if payload["error"] is not None:
+            summary["errors"] += 1
+        elif kind == "ready" and tracker is not None:
+          tracker.ready_workers += 1
+        elif kind == "failed":
+          finished.add(worker_id)
+          summary["failed_workers"].append({"worker": worker_id, "error": payload})
+        elif kind == "done":
+          finished.add(worker_id)
+
+        now = time.monotonic()
+        if now - last_sync >= PROGRESS_INTERVAL:
+          out.flush()
+          os.fsync(out.fileno())
+          last_sync = now
+        if tracker is not None:
+          tracker.completed, tracker.errors = summary["scanned"], summary["errors"]
+          tracker.update()
+  finally:
+    # Chunks left behind by an interrupted or failed scan must not keep this process from exiting
+    task_queue.cancel_join_thread()
+    for process in processes:
+      if process.is_alive():
+        process.terminate()
+      process.join()
+    task_queue.close()
+    result_queue.close()
+    if tracker is not None:
+      tracker.close()
+    summary["seconds"] = round(time.monotonic() - start, 3)
+    if summary["seconds"]:
+      summary["images_per_second"] = round(summary["scanned"] / summary["seconds"], 3)
+  return summary
+
+
+def write_parquet(output_path, parquet_path, object_texts):
+  """
+  Convert a scan's JSONL output into a Parquet table with one row per image:
+  path, error, one count column per object and the detections as JSON.
+  Needs pyarrow, which is only imported here.
+  """
+  try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+  except ImportError as e:
+    raise RuntimeError("Writing Parquet needs pyarrow (pip install pyarrow)") from e
+
+  records = {}
+  with open(output_path, encoding="utf-8") as f:
+    for line in f:
+      record = json.loads(line)
+      records[record["path"]] = record
+  rows = list(records.values())
+  columns = {
+    "path": pa.array([row["path"] for row in rows], pa.string()),
+    "error": pa.array([row["error"] for row in rows], pa.string()),
+  }
+  for object_text in object_texts:
+    columns[object_text] = pa.array(
+      [None if row["counts"] is None else next((c["count"] for c in row["counts"] if c["type"] == object_text), 0)
+       for row in rows], pa.int32())
+  columns["detections"] = pa.array(
+    [None if row["detections"] is None else json.dumps(row["detections"]) for row in rows], pa.string())
+  pq.write_table(pa.table(columns), parquet_path)
+  return len(rows)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Detect objects in a whole photo library using every core, resumably")
+  parser.add_argument("images", nargs="+", help="Image files or folders to scan (recursively)")
+  parser.add_argument("--output", required=True, help="JSONL file results are appended to; also the checkpoint")
+  parser.add_argument("--objects", nargs="+", default=detection.OBJECTS_TO_DETECT)
+  parser.add_argument("--threshold", type=float, default=0.2)
+  parser.add_argument("--workers", type=int, default=None,
+                      help=f"Worker processes, each with its own model (default: cores / {DEFAULT_THREADS_PER_WORKER})")
+  parser.add_argument("--threads-per-worker", type=int, default=None,
+                      help="torch intra-op threads per worker (default: cores / workers)")
+  parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Images handed to a worker at a time")
+  parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+  parser.add_argument("--inference-mode", choices=detection.INFERENCE_MODES, default=detection.INFERENCE_MODE_FP32)
+  parser.add_argument("--tiling", choices=detection.TILING_MODES, default=detection.TILING_OFF)
+  parser.add_argument("--box-coords", choices=(detection.BOX_COORDS_MODEL_INPUT, detection.BOX_COORDS_ORIGINAL),
+                      default=detection.BOX_COORDS_MODEL_INPUT)
+  parser.add_argument("--model-save-path", default=detection.DEFAULT_MODEL_SAVE_PATH)
+  parser.add_argument("--retry-errors", action="store_true", help="Scan images that failed in an earlier run again")
+  parser.add_argument("--parquet", help="After the scan, also write all results to this Parquet file (needs pyarrow)")
+  parser.add_argument("--quiet", action="store_true", help="No progress display")
+  args = parser.parse_args()
+
+  image_paths = expand_image_paths(args.images)
+  workers, threads_per_worker = plan_workers(args.workers, args.threads_per_worker)
+  print(f"Scanning {len(image_paths)} images with {workers} workers x {threads_per_worker} threads...",
+        file=sys.stderr)
+  try:
+    summary = run_scan(image_paths,
+                       args.output,
+                       object_texts=args.objects,
+                       threshold=args.threshold,
+                       workers=workers,
+                       threads_per_worker=threads_per_worker,
+                       chunk_size=args.chunk_size,
+                       batch_size=args.batch_size,
+                       model_save_path=args.model_save_path,
+                       inference_mode=args.inference_mode,
+                       tiling=args.tiling,
+                       box_coords=args.box_coords,
+                       retry_errors=args.retry_errors,
+                       progress=not args.quiet)
+  except KeyboardInterrupt:
+    print(f"\nInterrupted; run the same command again to resume from {args.output}", file=sys.stderr)
+    sys.exit(130)
+  except ValueError as e:
+    sys.exit(str(e))
+
+  if summary["scanned"] or summary["failed_workers"]:
+    print(f"Scanned {summary['scanned']} images ({summary['errors']} errors) in {summary['seconds']} s, "
+          f"{summary['images_per_second']} img/s; {summary['skipped']} already in {args.output}", file=sys.stderr)
+  else:
+    print(f"All {summary['images']} images are already in {args.output}", file=sys.stderr)
+  for failure in summary["failed_workers"]:
+    print(f"Worker {failure['worker']} failed: {failure['error']}", file=sys.stderr)
+  if args.parquet:
+    try:
+      rows = write_parquet(args.output, args.parquet, args.objects)
+    except RuntimeError as e:
+      sys.exit(str(e))
+    print(f"Wrote {rows} rows to {args.parquet}", file=sys.stderr)
+  if summary["failed_workers"]:
+    print("Some images weren't scanned; run the same command again to resume", file=sys.stderr)
+    sys.exit(1)
@@ -0,0 +1,227 @@
+"""
+Perceptual hashing for near-duplicate photos.
+
+A dHash is computed from a tiny grayscale thumbnail, so burst shots and
+re-encoded copies of the same scene land within a few bits of each other.
+A BK-tree answers "every hash within Hamming distance d" without comparing
+against the whole library.
+
+  clusters = duplicate_clusters(paths, max_distance=4)
+
+DuplicateResultIndex plugs into detect_and_count_batch so that a
+near-identical image reuses the detections of one already processed.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+DEFAULT_HASH_SIZE = 8       # 8x8 gradients -> 64-bit hash
+DEFAULT_MAX_DISTANCE = 4    # bits; bursts and re-encodes typically differ by 0-4
+_MAX_MEMOIZED_FINGERPRINTS = 65536
+
+
+def dhash(image, hash_size=DEFAULT_HASH_SIZE):
+  """Difference hash of a PIL image: one bit per horizontal gradient of a (hash_size+1) x hash_size thumbnail."""
+  # Let the JPEG decoder downscale by up to 8x in the DCT instead of decoding full resolution
+  image.draft("L", ((hash_size + 1) * 8, hash_size * 8))
+  small = image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+  pixels = np.asarray(small, dtype=np.int16)
+  bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+  return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def image_fingerprint(image_path, hash_size=DEFAULT_HASH_SIZE):
+  """(dhash, (width, height)) of an image file; the size is of the full-resolution image."""
+  with Image.open(image_path) as image:
+    size = image.size
+    return dhash(image, hash_size), size
+
+def hamming_distance(a, b):
+  return (a ^ b).bit_count()
+
+
+class BKTree:
+  """Burkhard-Keller tree over integer hashes with Hamming distance."""
+
+  def __init__(self):
+    self._root = None  # [hash, items, {distance: child}]
+    self._size = 0
+
+  def __len__(self):
+    return self._size
+
+  def add(self, hash_value, item):
+    self._size += 1
+    if self._root is None:
+      self._root = [hash_value, [item], {}]
+      return
+    node = self._root
+    while True:
+      distance = hamming_distance(hash_value, node[0])
+      if distance == 0:
+        node[1].append(item)
+        return
+      child = node[2].get(distance)
+      if child is None:
+        node[2][distance] = [hash_value, [item], {}]
+        return
+      node = child
+
+  def search(self, hash_value, max_distance):
+    """Return [(distance, hash, item)] for every item within `max_distance`, nearest first."""
+    found = []
+    stack = [self._root] if self._root is not None else []
+    while stack:
+      node = stack.pop()
+      distance = hamming_distance(hash_value, node[0])
+      if distance <= max_distance:
+        found.extend((distance, node[0], item) for item in node[1])
+      # Triangle inequality: only children at distance d +- max_distance can hold matches
+      for child_distance, child in node[2].items():
+        if distance - max_distance <= child_distance <= distance + max_distance:
+          stack.append(child)
+    found.sort(key=lambda match: match[0])
+    return found
+
+
+def compute_fingerprints(image_paths, hash_size=DEFAULT_HASH_SIZE, max_workers=8):
+  """Map each path to its fingerprint, or None if the file can't be decoded."""
+  def _safe(path):
+    try:
+      return image_fingerprint(path, hash_size)
+    except Exception:
+      return None
+  image_paths = list(image_paths)
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    return dict(zip(image_paths, executor.map(_safe, image_paths)))
+
+def duplicate_clusters(image_paths, max_distance=DEFAULT_MAX_DISTANCE, hash_size=DEFAULT_HASH_SIZE, max_workers=8):
+  """
+  Group near-duplicate images.  Images are linked when their hashes are
+  within `max_distance` bits, and clusters are the connected groups.
+  Returns the clusters with more than one image, largest first, each
+  sorted by path.
+  """
+  fingerprints = compute_fingerprints(image_paths, hash_size, max_workers)
+  paths = [path for path, fingerprint in fingerprints.items() if fingerprint is not None]
+  parent = list(range(len(paths)))
+
+  def find(i):
+    while parent[i] != i:
+      parent[i] = parent[parent[i]]
+      i = parent[i]
+    return i
+
+  tree = BKTree()
+  for i, path in enumerate(paths):
+    hash_value = fingerprints[path][0]
+    for _, _, j in tree.search(hash_value, max_distance):
+      parent[find(i)] = find(j)
+    tree.add(hash_value, i)
+
+  groups = {}
+  for i, path in enumerate(paths):
+    groups.setdefault(find(i), []).append(path)
+  clusters = [sorted(group) for group in groups.values() if len(group) > 1]
+  clusters.sort(key=lambda group: (-len(group), group[0]))
+  return clusters
+
+
+class DuplicateResultIndex:
+  """
+  Detection results of processed images, searchable by perceptual hash.
+
+  Results are kept per `settings` key (model, vocabulary, threshold, box
+  coordinates), and a match must also have the same pixel size, so reused
+  boxes stay valid.  Safe to share between threads.
+  """
+
+  def __init__(self, max_distance=DEFAULT_MAX_DISTANCE, hash_size=DEFAULT_HASH_SIZE, max_workers=8):
+    self.max_distance = max_distance
+    self.hash_size = hash_size
+    self.max_workers = max_workers
+    self.reused = 0
+    self._trees = {}
+    self._lock = threading.Lock()
+    # (path, size, mtime) -> fingerprint, so resolve() and add() hash a file once
+    self._fingerprint_memo = {}
+
+  def _memo_key(self, path):
+    try:
+      st = os.stat(path)
+    except OSError:
+      return None
+    return (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+  def fingerprints(self, image_paths):
+    keys = {path: self._memo_key(path) for path in image_paths}
+    with self._lock:
+      known = {path: self._fingerprint_memo[key] for path, key in keys.items() if key in self._fingerprint_memo}
+    missing = [path for path in image_paths if path not in known and keys[path] is not None]
+    computed = compute_fingerprints(missing, self.hash_size, self.max_workers) if missing else {}
+    with self._lock:
+      if len(self._fingerprint_memo) + len(computed) > _MAX_MEMOIZED_FINGERPRINTS:
+        self._fingerprint_memo.clear()
+      for path, fingerprint in computed.items():
+        if fingerprint is not None:
+          self._fingerprint_memo[keys[path]] = fingerprint
+    return {path: known.get(path, computed.get(path)) for path in image_paths}
+
+  def _find(self, tree, fingerprint):
+    hash_value, size = fingerprint
+    for _, _, (match_size, result) in tree.search(hash_value, self.max_distance):
+      if match_size == size:
+        return result
+    return None
+
+  def resolve(self, image_paths, settings):
+    """
+    Split `image_paths` into work still to do and work that can be skipped.
+
+    Returns (representatives, aliases, reused):
+    - reused: {path: result} for images matching an already processed one
+    - aliases: {path: representative path} for images that are near
+      duplicates of an earlier image in this same call
+    - representatives: the remaining images, which need inference
+    """
+    fingerprints = self.fingerprints(image_paths)
+    representatives, aliases, reused = [], {}, {}
+    local = BKTree()
+    with self._lock:
+      tree = self._trees.get(settings)
+      for path in image_paths:
+        fingerprint = fingerprints[path]
+        if fingerprint is None:
+          representatives.append(path)
+          continue
+        result = self._find(tree, fingerprint) if tree is not None else None
+        if result is not None:
+          reused[path] = result
+          continue
+        representative = self._find(local, fingerprint)
+        if representative is not None:
+          aliases[path] = representative
+          continue
+        local.add(fingerprint[0], (fingerprint[1], path))
+        representatives.append(path)
+      self.reused += len(reused) + len(aliases)
+    return representatives, aliases, reused
+
+  def add_many(self, entries, settings):
+    """Index `entries`, an iterable of (path, result)."""
+    entries = list(entries)
+    fingerprints = self.fingerprints([path for path, _ in entries])
+    with self._lock:
+      tree = self._trees.setdefault(settings, BKTree())
+      for path, result in entries:
+        fingerprint = fingerprints[path]
+        if fingerprint is not None:
+          tree.add(fingerprint[0], (fingerprint[1], result))
+
+  def clear(self):
+    with self._lock:
+      self._trees.clear()
+      self._fingerprint_memo.clear()
+      self.reused = 0
@@ -1,22 +1,63 @@
 from pathlib import Path
-from transformers import Owlv2Processor, Owlv2ForObjectDetection
+import contextlib
+import functools
+import gc
+import hashlib
+import sys
+import threading
+import weakref
+from transformers import Owlv2Config, Owlv2Processor, Owlv2ForObjectDetection
+from transformers.models.owlv2.modeling_owlv2 import Owlv2ObjectDetectionOutput
+import numpy as np
 from PIL import Image
 import torch
-import numpy as np
-from transformers.utils.constants import OPENAI_CLIP_MEAN, OPENAI_CLIP_STD
 
 IMAGE_PATH ='/home/azureuser/20250101_212049.jpg'
 OBJECTS_TO_DETECT = ["cat", "dog", "person", "bottle", "cell phone", "remote control", "animal"]
 DEFAULT_MODEL_NAME ="google/owlv2-base-patch16-ensemble"
 DEFAULT_MODEL_SAVE_PATH ="./owlv2-model"
 
-def get_preprocessed_image(pixel_values):
-  pixel_values = pixel_values.squeeze().numpy()
-  unnormalized_image = (pixel_values * np.array(OPENAI_CLIP_STD)[:, None, None]) + np.array(OPENAI_CLIP_MEAN)[:, None, None]
-  unnormalized_image = (unnormalized_image * 255).astype(np.uint8)
-  unnormalized_image = np.moveaxis(unnormalized_image, 0, -1)
-  unnormalized_image = Image.fromarray(unnormalized_image)
-  return unnormalized_image
+# Coordinate systems for returned boxes
+BOX_COORDS_MODEL_INPUT = "model_input"  # the padded, resized model input (e.g. 960x960)
+BOX_COORDS_ORIGINAL = "original"        # pixels of the original image, usable for cropping
+
+# CPU inference modes
+INFERENCE_MODE_FP32 = "fp32"  # full precision
+INFERENCE_MODE_BF16 = "bf16"  # fp32 weights, bfloat16 autocast during the forward pass
+INFERENCE_MODE_INT8 = "int8"  # dynamic int8 quantization of the nn.Linear layers
+INFERENCE_MODES = (INFERENCE_MODE_FP32, INFERENCE_MODE_BF16, INFERENCE_MODE_INT8)
+QUANTIZED_MODEL_FILENAME = "model_int8.pt"  # state_dict of the quantized model
+
+# Image preprocessing paths
+PREPROCESS_PROCESSOR = "processor"  # full-resolution decode, then Owlv2Processor
+PREPROCESS_DRAFT = "draft"          # reduced-resolution JPEG decode, then one numpy normalize/pad pass
+PREPROCESS_MODES = (PREPROCESS_PROCESSOR, PREPROCESS_DRAFT)
+
+# Tiled detection for small objects in high-resolution photos
+TILING_OFF = "off"            # one pass over the whole image
+TILING_ADAPTIVE = "adaptive"  # tile only images whose first pass has small candidates
+TILING_ALWAYS = "always"      # tile every image large enough to gain detail
+TILING_MODES = (TILING_OFF, TILING_ADAPTIVE, TILING_ALWAYS)
+DEFAULT_TILES_PER_SIDE = 2    # tiles along the longer side; at most this squared per image
+DEFAULT_TILE_OVERLAP = 0.2    # fraction of a tile shared with its neighbour
+TILE_NMS_IOU = 0.5            # boxes of one class overlapping more than this are merged
+TILING_CANDIDATE_RATIO = 0.5  # first-pass candidates count down to this fraction of the threshold
+TILING_SMALL_OBJECT = 0.1     # "small" means no side longer than this fraction of the image
+NMS_MAX_CANDIDATES = 2000     # caps the pairwise IoU matrix
+
+# Process-wide registry of loaded (processor, model) pairs, keyed by
+# (model_name, resolved save path, dtype, device).  Loading the OWLv2 weights
+# takes seconds, so every caller in the process shares one resident copy.
+_MODEL_REGISTRY = {}
+_MODEL_REGISTRY_LOCK = threading.Lock()
+_MODEL_LOAD_LOCKS = {}
+
+# Encoded text queries per model, keyed by a hash of the query vocabulary.
+# The label vocabulary rarely changes within a run, so the text tower only
+# has to run once per (model, vocabulary).  Weak keys let an unloaded model
+# take its cached embeddings with it.
+_TEXT_QUERY_CACHE = weakref.WeakKeyDictionary()
+_TEXT_QUERY_CACHE_LOCK = threading.Lock()
 
 def download_and_save_model_and_processor(model_name=DEFAULT_MODEL_NAME, save_directory=DEFAULT_MODEL_SAVE_PATH):
   processor = Owlv2Processor.from_pretrained(model_name)
@@ -24,65 +65,245 @@ def download_and_save_model_and_processor(model_name=DEFAULT_MODEL_NAME, save_di
   processor.save_pretrained(save_directory)
   model.save_pretrained(save_directory)
 
-def load_model_and_processor(model_name=DEFAULT_MODEL_NAME, load_directory=None):
-  if load_directory is not None:
-    processor = Owlv2Processor.from_pretrained(load_directory)
-    model = Owlv2ForObjectDetection.from_pretrained(load_directory)
+def quantized_model_path(model_save_path=DEFAULT_MODEL_SAVE_PATH):
+  """Where the int8 model for `model_save_path` is persisted, e.g. ./owlv2-model-int8/model_int8.pt"""
+  p = Path(model_save_path)
+  return p.with_name(p.name + "-int8") / QUANTIZED_MODEL_FILENAME
+
+def quantize_model(model):
+  return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def load_model_and_processor(model_name=DEFAULT_MODEL_NAME,
+                             load_directory=None,
+                             inference_mode=INFERENCE_MODE_FP32,
+                             num_threads=None):
+  """
+  Load the processor and model.
+
+  With `inference_mode=INFERENCE_MODE_INT8` the quantized model is loaded
+  from `quantized_model_path(load_directory)` when present; otherwise it is
+  quantized from the fp32 weights and saved there for next time.
+  `num_threads` sets torch's intra-op thread count for this process.
+  """
+  if inference_mode not in INFERENCE_MODES:
+    raise ValueError(f"Unknown inference_mode: {inference_mode!r}")
+  if num_threads is not None:
+    torch.set_num_threads(num_threads)
+
+  source = load_directory if load_directory is not None else model_name
+  processor = Owlv2Processor.from_pretrained(source)
+
+  if inference_mode == INFERENCE_MODE_INT8 and load_directory is not None:
+    quantized_path = quantized_model_path(load_directory)
+    if quantized_path.is_file():
+      # Rebuild the quantized module structure, then restore the saved int8 weights
+      model = quantize_model(Owlv2ForObjectDetection(Owlv2Config.from_pretrained(load_directory)).eval())
+      model.load_state_dict(torch.load(quantized_path))
+    else:
+      model = quantize_model(Owlv2ForObjectDetection.from_pretrained(source).eval())
+      quantized_path.parent.mkdir(parents=True, exist_ok=True)
+      # Write then rename so an interrupted save never leaves a truncated file
+      tmp_path = quantized_path.with_suffix(".tmp")
+      torch.save(model.state_dict(), tmp_path)
+      tmp_path.replace(quantized_path)
   else:
-    processor = Owlv2Processor.from_pretrained(model_name)
-    model = Owlv2ForObjectDetection.from_pretrained(model_name)
+    model = Owlv2ForObjectDetection.from_pretrained(source)
+    if inference_mode == INFERENCE_MODE_INT8:
+      model = quantize_model(model.eval())
   return processor, model
 
+def inference_context(model, inference_mode=INFERENCE_MODE_FP32):
+  """torch.inference_mode, plus bfloat16 autocast for INFERENCE_MODE_BF16."""
+  stack = contextlib.ExitStack()
+  stack.enter_context(torch.inference_mode())
+  if inference_mode == INFERENCE_MODE_BF16:
+    stack.enter_context(torch.autocast(device_type=model.device.type, dtype=torch.bfloat16))
+  return stack
 
-def detect_and_count(image_path, 
-                     object_texts, 
-                     threshold=0.2, 
-                     processor=None, 
-                     model=None, 
-                     model_name=DEFAULT_MODEL_NAME,
-                     model_save_path=DEFAULT_MODEL_SAVE_PATH):
+def is_model_downloaded(model_save_path=DEFAULT_MODEL_SAVE_PATH):
+  p = Path(model_save_path)
+  return p.is_dir() and (p / "model.safetensors").is_file()
+
+def _registry_key(model_name, model_save_path, dtype, device, inference_mode):
+  save_path = str(Path(model_save_path).resolve()) if model_save_path is not None else None
+  return (model_name,
+          save_path,
+          str(dtype) if dtype is not None else None,
+          str(device) if device is not None else None,
+          inference_mode)
+
+def get_model_and_processor(model_name=DEFAULT_MODEL_NAME,
+                            model_save_path=DEFAULT_MODEL_SAVE_PATH,
+                            dtype=None,
+                            device=None,
+                            inference_mode=INFERENCE_MODE_FP32,
+                            num_threads=None):
   """
-  Detect objects specified in `object_texts` in `image_path` and return counts.
+  Return the shared (processor, model) pair for the given configuration,
+  downloading and loading it on first use.
 
-  Returns a tuple: (counts_array, detections)
-  - counts_array: list of {"type": str, "count": int}
-  - detections: list of individual detections with type, score, box
+  Loading is lazy and thread-safe: concurrent callers asking for the same
+  configuration wait on a per-key lock and receive the same objects.
   """
-  model_already_downloaded = False
-  if processor is None or model is None:
-      p = Path(model_save_path)
-      if p.exists() and p.is_dir():
-          f = Path(model_save_path + "/model.safetensors")
-          if f.exists() and f.is_file():
-              model_already_downloaded = True
-  if(not model_already_downloaded):
-      print("Downloading and saving model and processor...")
-      download_and_save_model_and_processor(model_name, model_save_path)
-  
-  processor, model = load_model_and_processor(model_name, model_save_path)
-  
-  image = Image.open(image_path).convert("RGB")
+  if inference_mode == INFERENCE_MODE_INT8 and (dtype is not None or (device is not None and str(device) != "cpu")):
+    raise ValueError("int8 inference is only supported for fp32 weights on the CPU")
+  key = _registry_key(model_name, model_save_path, dtype, device, inference_mode)
+  entry = _MODEL_REGISTRY.get(key)
+  if entry is not None:
+    return entry
 
-  # OWL-ViT expects a list of texts per image; first item can be empty (placeholder)
-  texts = [[''] + list(object_texts)]
-  inputs = processor(text=texts, images=image, return_tensors="pt")
+  with _MODEL_REGISTRY_LOCK:
+    load_lock = _MODEL_LOAD_LOCKS.setdefault(key, threading.Lock())
+
+  with load_lock:
+    entry = _MODEL_REGISTRY.get(key)
+    if entry is None:
+      if model_save_path is not None and not is_model_downloaded(model_save_path):
+        # stderr: stdout may be a protocol channel, e.g. the photo MCP server's stdio JSON-RPC
+        print("Downloading and saving model and processor...", file=sys.stderr)
+        download_and_save_model_and_processor(model_name, model_save_path)
+      processor, model = load_model_and_processor(model_name, model_save_path, inference_mode, num_threads)
+      if dtype is not None or device is not None:
+        model = model.to(device=device, dtype=dtype)
+      model.eval()
+      entry = (processor, model)
+      with _MODEL_REGISTRY_LOCK:
+        _MODEL_REGISTRY[key] = entry
+  return entry
 
-  with torch.no_grad():
-    outputs = model(**inputs)
+def warm_up_model(model_name=DEFAULT_MODEL_NAME,
+                  model_save_path=DEFAULT_MODEL_SAVE_PATH,
+                  dtype=None,
+                  device=None,
+                  object_texts=OBJECTS_TO_DETECT,
+                  inference_mode=INFERENCE_MODE_FP32,
+                  num_threads=None):
+  """
+  Load the model into the registry and run one forward pass on a blank
+  image so that the first real request doesn't pay for lazy initialisation.
+  """
+  processor, model = get_model_and_processor(model_name, model_save_path, dtype, device, inference_mode, num_threads)
+  pixel_values = preprocess_images([Image.new("RGB", (64, 64))], processor)
+  detect_and_count_preprocessed(pixel_values, object_texts, processor=processor, model=model, inference_mode=inference_mode)
+  return processor, model
+
+def unload_model(model_name=None, model_save_path=None, dtype=None, device=None, inference_mode=None):
+  """
+  Drop registry entries so their weights can be freed.
+
+  With no arguments every resident model is unloaded; otherwise only the
+  entries matching every argument given are removed, so
+  `unload_model(inference_mode="int8")` drops all int8 models whatever their
+  save path.  Returns the number of entries dropped.
+  """
+  wanted = _registry_key(model_name, model_save_path, dtype, device, inference_mode)
+  with _MODEL_REGISTRY_LOCK:
+    keys = [key for key in _MODEL_REGISTRY
+            if all(field is None or field == value for field, value in zip(wanted, key))]
+    for key in keys:
+      _, model = _MODEL_REGISTRY.pop(key)
+      _MODEL_LOAD_LOCKS.pop(key, None)
+      clear_text_query_cache(model)
+  gc.collect()
+  return len(keys)
 
-  unnormalized_image = get_preprocessed_image(inputs.pixel_values)
-  target_sizes = torch.Tensor([unnormalized_image.size[::-1]])
-  results = processor.post_process_grounded_object_detection(outputs=outputs, target_sizes=target_sizes, threshold=threshold)
 
-  boxes = results[0]["boxes"]
-  scores = results[0]["scores"]
-  labels = results[0]["labels"]
+@functools.lru_cache(maxsize=128)
+def vocabulary_key(texts):
+  """Stable hash of a tuple of query texts, used as the text-query cache key."""
+  return hashlib.sha1("\x1f".join(texts).encode("utf-8")).hexdigest()
 
+def get_text_query_embeddings(texts, processor, model):
+  """
+  Return (query_embeds, query_mask) for `texts`, running the OWLv2 text tower
+  only the first time a given model sees this vocabulary.
+
+  - query_embeds: tensor of shape (num_queries, hidden_dim)
+  - query_mask: bool tensor of shape (num_queries,), False for padded queries
+  """
+  texts = tuple(texts)
+  key = vocabulary_key(texts)
+  with _TEXT_QUERY_CACHE_LOCK:
+    entry = _TEXT_QUERY_CACHE.setdefault(model, {}).get(key)
+  if entry is not None:
+    return entry
+
+  entry = encode_text_queries(texts, processor, model)
+  with _TEXT_QUERY_CACHE_LOCK:
+    _TEXT_QUERY_CACHE.setdefault(model, {})[key] = entry
+  return entry
+
+def encode_text_queries(texts, processor, model):
+  """Run the text tower on `texts`, uncached; returns (query_embeds, query_mask) like `get_text_query_embeddings`."""
+  text_inputs = processor(text=[list(texts)], return_tensors="pt").to(model.device)
+  with torch.inference_mode():
+    query_embeds = model.owlv2.get_text_features(input_ids=text_inputs["input_ids"],
+                                                 attention_mask=text_inputs["attention_mask"])
+  if not torch.is_tensor(query_embeds):
+    query_embeds = query_embeds.pooler_output
+  # Same rule as Owlv2ForObjectDetection.forward: a first token of 0 marks a padded query
+  query_mask = text_inputs["input_ids"][:, 0] > 0
+  return query_embeds, query_mask
+
+def image_level_embeddings(vision_outputs, model):
+  """
+  L2-normalized image embeddings, shape (batch, projection_dim), from the
+  pooled output of the vision tower.  They live in the same space as the
+  text features, so a dot product with a normalized text embedding scores
+  how well the whole image matches the text.
+  """
+  embeds = model.owlv2.visual_projection(vision_outputs.pooler_output).float()
+  return torch.nn.functional.normalize(embeds, dim=-1)
+
+def compute_image_embeddings(pixel_values, model, inference_mode=INFERENCE_MODE_FP32):
+  """`image_level_embeddings` for preprocessed `pixel_values`, running only the vision tower."""
+  pixel_values = torch.as_tensor(pixel_values).to(device=model.device, dtype=model.dtype)
+  with inference_context(model, inference_mode):
+    return image_level_embeddings(model.owlv2.vision_model(pixel_values=pixel_values), model)
+
+def clear_text_query_cache(model=None):
+  """Forget cached text-query embeddings for `model`, or for every model."""
+  with _TEXT_QUERY_CACHE_LOCK:
+    if model is None:
+      _TEXT_QUERY_CACHE.clear()
+    else:
+      _TEXT_QUERY_CACHE.pop(model, None)
+
+def run_detection_heads(pixel_values, query_embeds, query_mask, model):
+  """
+  Run the vision tower and the class/box heads against precomputed text
+  queries.  Equivalent to `model(input_ids=..., pixel_values=...)` without
+  re-encoding the text queries for every image.
+  """
+  feature_map, vision_outputs = model.image_embedder(pixel_values=pixel_values)
+  batch_size, num_patches_height, num_patches_width, hidden_dim = feature_map.shape
+  image_feats = torch.reshape(feature_map, (batch_size, num_patches_height * num_patches_width, hidden_dim))
+
+  query_embeds = query_embeds.unsqueeze(0).expand(batch_size, -1, -1)
+  query_mask = query_mask.unsqueeze(0).expand(batch_size, -1)
+  pred_logits, class_embeds = model.class_predictor(image_feats, query_embeds, query_mask)
+  pred_boxes = model.box_predictor(image_feats, feature_map)
+
+  return Owlv2ObjectDetectionOutput(image_embeds=feature_map,
+                                    text_embeds=query_embeds,
+                                    pred_boxes=pred_boxes,
+                                    logits=pred_logits,
+                                    class_embeds=class_embeds,
+                                    vision_model_output=vision_outputs)
+
+
+def summarize_detections(result, texts, object_texts, threshold):
+  """
+  Turn one post-processed OWLv2 result into (counts_array, detections).
+
+  `texts` is the full query list passed to the processor, including the
+  leading empty placeholder, so that label indices map back to names.
+  """
   counts = {t: 0 for t in object_texts}
   detections = []
 
-  for box, score, label in zip(boxes, scores, labels):
-    label_text = texts[0][label]
+  for box, score, label in zip(result["boxes"], result["scores"], result["labels"]):
+    label_text = texts[label]
     if label_text in counts and score.item() >= threshold:
       counts[label_text] += 1
       detections.append({
@@ -95,6 +316,505 @@ def detect_and_count(image_path,
   return counts_array, detections
 
 
+def detect_and_count(image_path, 
+                     object_texts, 
+                     threshold=0.2, 
+                     processor=None, 
+                     model=None, 
+                     model_name=DEFAULT_MODEL_NAME,
+                     model_save_path=DEFAULT_MODEL_SAVE_PATH,
+                     box_coords=BOX_COORDS_MODEL_INPUT,
+                     result_cache=None,
+                     inference_mode=INFERENCE_MODE_FP32,
+                     duplicate_index=None,
+                     preprocessing=PREPROCESS_PROCESSOR,
+                     tiling=TILING_OFF,
+                     tiles_per_side=DEFAULT_TILES_PER_SIDE,
+                     tile_overlap=DEFAULT_TILE_OVERLAP,
+                     embedding_index=None):
+  """
+  Detect objects specified in `object_texts` in `image_path` and return counts.
+
+  Returns a tuple: (counts_array, detections)
+  - counts_array: list of {"type": str, "count": int}
+  - detections: list of individual detections with type, score, box
+
+  Boxes are [x0, y0, x1, y1] in the padded model input by default; pass
+  `box_coords=BOX_COORDS_ORIGINAL` to get them in original image pixels.
+
+  If a `result_cache` (see detection_cache.DetectionResultCache) is given,
+  a stored result for an unchanged file is returned without running the
+  model, and fresh results are written back to it.
+
+  When `processor` and `model` are not supplied, the shared copy from the
+  model registry is used (see `get_model_and_processor`).  `inference_mode`
+  selects fp32, bf16 autocast or dynamically quantized int8 execution.
+
+  With a `duplicate_index` (see perceptual_hash.DuplicateResultIndex), an
+  image that is a near duplicate of one already processed with the same
+  settings gets that image's result instead of a forward pass.  Such
+  borrowed results are approximate and never written to `result_cache`.
+
+  By default (`PREPROCESS_PROCESSOR`) the Owlv2Processor runs on the full
+  image.  `preprocessing=PREPROCESS_DRAFT` instead decodes JPEGs at a
+  reduced resolution close to the model input (see `load_model_input`),
+  which is faster but gives slightly different pixels and so detections.
+
+  `tiling` (see `detect_tiles`) additionally runs overlapping tiles of the
+  image through the model, so small objects keep enough pixels to be found:
+  TILING_ALWAYS tiles every large image, TILING_ADAPTIVE only those whose
+  whole-image pass already shows small candidates.
+
+  With an `embedding_index` (see embedding_index.EmbeddingIndex), the image
+  embedding produced by the forward pass is stored for semantic search.
+  """
+  return detect_and_count_batch([image_path],
+                                object_texts,
+                                threshold=threshold,
+                                batch_size=1,
+                                processor=processor,
+                                model=model,
+                                model_name=model_name,
+                                model_save_path=model_save_path,
+                                box_coords=box_coords,
+                                result_cache=result_cache,
+                                inference_mode=inference_mode,
+                                duplicate_index=duplicate_index,
+                                preprocessing=preprocessing,
+                                tiling=tiling,
+                                tiles_per_side=tiles_per_side,
+                                tile_overlap=tile_overlap,
+                                embedding_index=embedding_index)[0]
+
+
+def detect_and_count_batch(image_paths,
+                           object_texts,
+                           threshold=0.2,
+                           batch_size=8,
+                           processor=None,
+                           model=None,
+                           model_name=DEFAULT_MODEL_NAME,
+                           model_save_path=DEFAULT_MODEL_SAVE_PATH,
+                           box_coords=BOX_COORDS_MODEL_INPUT,
+                           result_cache=None,
+                           inference_mode=INFERENCE_MODE_FP32,
+                           duplicate_index=None,
+                           preprocessing=PREPROCESS_PROCESSOR,
+                           tiling=TILING_OFF,
+                           tiles_per_side=DEFAULT_TILES_PER_SIDE,
+                           tile_overlap=DEFAULT_TILE_OVERLAP,
+                           embedding_index=None):
+  """
+  Detect objects in many images, running `batch_size` images per forward pass.
+
+  Returns a list with one (counts_array, detections) tuple per entry of
+  `image_paths`, in the same order and with the same shape as
+  `detect_and_count`.  With a `result_cache`, stored results are fetched in
+  one bulk lookup and only the remaining images go through the model.  With
+  a `duplicate_index`, near duplicates of processed images (or of each
+  other) share one forward pass.  Tiling, when enabled, runs per image
+  after the batched whole-image pass.  Images that go through the model
+  are added to `embedding_index`, if given.
+  """
+  if batch_size < 1:
+    raise ValueError("batch_size must be at least 1")
+  if preprocessing not in PREPROCESS_MODES:
+    raise ValueError(f"Unknown preprocessing: {preprocessing!r}")
+  if tiling not in TILING_MODES:
+    raise ValueError(f"Unknown tiling: {tiling!r}")
+  if tiles_per_side < 1 or not 0 <= tile_overlap < 1:
+    raise ValueError("tiles_per_side must be at least 1 and tile_overlap in [0, 1)")
+
+  image_paths = list(image_paths)
+  model_key = result_cache_model_key(model_name, inference_mode, preprocessing,
+                                     tiling_key(tiling, tiles_per_side, tile_overlap))
+  cache_settings = (object_texts, threshold, model_key, box_coords)
+  results = {}
+  if result_cache is not None:
+    results = result_cache.get_many(image_paths, *cache_settings)
+  pending = list(dict.fromkeys(path for path in image_paths if path not in results))
+
+  aliases, reused = {}, {}
+  if duplicate_index is not None and pending:
+    duplicate_settings = (vocabulary_key(tuple(object_texts)), float(threshold), cache_settings[2], box_coords)
+    pending, aliases, reused = duplicate_index.resolve(pending, duplicate_settings)
+    results.update(reused)
+
+  if pending and (processor is None or model is None):
+    processor, model = get_model_and_processor(model_name, model_save_path, inference_mode=inference_mode)
+
+  batch_buffer = None
+  if pending and preprocessing == PREPROCESS_DRAFT:
+    # Reused by every batch; each forward pass finishes before the next fill
+    batch_buffer = allocate_pixel_values(min(batch_size, len(pending)), processor.image_processor)
+
+  for start in range(0, len(pending), batch_size):
+    batch_paths = pending[start:start + batch_size]
+    if batch_buffer is not None:
+      inputs = [load_model_input(path, processor.image_processor) for path in batch_paths]
+      pixel_values = fill_pixel_values([pixels for pixels, _ in inputs], processor.image_processor,
+                                       batch_buffer[:len(inputs)])
+      image_sizes = [image_size for _, image_size in inputs]
+    else:
+      images = [load_image(path) for path in batch_paths]
+      pixel_values = preprocess_images(images, processor)
+      image_sizes = [image.size for image in images]
+    embeddings = [] if embedding_index is not None else None
+    if tiling == TILING_OFF:
+      batch_results = detect_and_count_preprocessed(pixel_values,
+                                                    object_texts,
+                                                    threshold,
+                                                    processor,
+                                                    model,
+                                                    image_sizes=image_sizes,
+                                                    box_coords=box_coords,
+                                                    inference_mode=inference_mode,
+                                                    embeddings_out=embeddings)
+    else:
+      batch_results = detect_and_count_tiled(batch_paths,
+                                             pixel_values,
+                                             image_sizes,
+                                             object_texts,
+                                             threshold,
+                                             processor,
+                                             model,
+                                             box_coords=box_coords,
+                                             inference_mode=inference_mode,
+                                             tiling=tiling,
+                                             tiles_per_side=tiles_per_side,
+                                             tile_overlap=tile_overlap,
+                                             embeddings_out=embeddings)
+    results.update(zip(batch_paths, batch_results))
+    if embedding_index is not None:
+      embedding_index.add_many(zip(batch_paths, embeddings))
+    if duplicate_index is not None:
+      duplicate_index.add_many(zip(batch_paths, batch_results), duplicate_settings)
+    if result_cache is not None:
+      result_cache.put_many([(path, counts, detections) for path, (counts, detections) in zip(batch_paths, batch_results)],
+                            *cache_settings)
+
+  # Borrowed results are approximate, so they stay out of `result_cache`, whose hits are exact
+  results.update((path, results[representative]) for path, representative in aliases.items())
+
+  return [results[path] for path in image_paths]
+
+
+def result_cache_model_key(model_name, inference_mode=INFERENCE_MODE_FP32, preprocessing=PREPROCESS_PROCESSOR, tiling=None):
+  """
+  Model identity for result caching; reduced-precision modes, preprocessing
+  paths and tiling (a `tiling_key`) can change detections.
+  """
+  key = model_name
+  if inference_mode != INFERENCE_MODE_FP32:
+    key += f":{inference_mode}"
+  if preprocessing != PREPROCESS_PROCESSOR:
+    key += f":{preprocessing}"
+  if tiling is not None:
+    key += f":{tiling}"
+  return key
+
+def tiling_key(tiling, tiles_per_side=DEFAULT_TILES_PER_SIDE, tile_overlap=DEFAULT_TILE_OVERLAP):
+  """Compact description of a tiling configuration, or None when tiling is off."""
+  if tiling == TILING_OFF:
+    return None
+  return f"tiles-{tiling}-{tiles_per_side}-{tile_overlap:g}"
+
+def load_image(image_path):
+  return Image.open(image_path).convert("RGB")
+
+def preprocess_images(images, processor):
+  """Resize, pad and normalize PIL images into a (batch, 3, H, W) pixel_values tensor."""
+  return processor(images=images, return_tensors="pt")["pixel_values"]
+
+def model_input_size(image_processor):
+  """(height, width) of the model input, e.g. (960, 960)."""
+  size = image_processor.size
+  return size["height"], size["width"]
+
+def resize_for_model(image, input_size):
+  """
+  Resize an RGB PIL image to the part of the model input it covers and
+  return it as a (h, w, 3) uint8 array.  The rest of the input is the
+  bottom/right padding that makes the image square.
+  """
+  height, width = input_size
+  side = max(image.size)
+  content_size = (max(1, round(image.width * width / side)), max(1, round(image.height * height / side)))
+  if image.size != content_size:
+    image = image.resize(content_size, Image.BILINEAR)
+  return np.asarray(image)
+
+def load_model_input(image_path, image_processor):
+  """
+  Decode `image_path` for the model and return (pixels, original_size).
+
+  JPEGs are decoded with DCT-domain scaling (`Image.draft`) at the largest
+  1/2, 1/4 or 1/8 reduction that still covers the model input, so a 12 MP
+  photo is never decoded at full resolution.  `pixels` is the output of
+  `resize_for_model`; `original_size` is the (width, height) of the file,
+  which box coordinates refer to.
+  """
+  height, width = model_input_size(image_processor)
+  with Image.open(image_path) as image:
+    original_size = image.size
+    side = max(original_size)
+    image.draft("RGB", (-(-image.width * width // side), -(-image.height * height // side)))
+    image = image.convert("RGB")
+  return resize_for_model(image, (height, width)), original_size
+
+@functools.lru_cache(maxsize=8)
+def _normalization_table(rescale_factor, image_mean, image_std):
+  """(3, 256) float32 lookup of normalized values for each uint8 channel value, plus the padding value per channel."""
+  mean = np.asarray(image_mean, dtype=np.float64)[:, None]
+  std = np.asarray(image_std, dtype=np.float64)[:, None]
+  table = (np.arange(256) * rescale_factor - mean) / std
+  # Owlv2Processor pads with black, i.e. 0 after rescaling
+  padding = (-mean / std)[:, 0]
+  return table.astype(np.float32), padding.astype(np.float32)
+
+def allocate_pixel_values(batch_size, image_processor):
+  """An uninitialized (batch_size, 3, H, W) float32 tensor for `fill_pixel_values`."""
+  return torch.empty((batch_size, 3, *model_input_size(image_processor)), dtype=torch.float32)
+
+def fill_pixel_values(pixels, image_processor, out):
+  """
+  Normalize and pad the uint8 arrays from `resize_for_model` into `out`,
+  a (len(pixels), 3, H, W) float32 tensor, and return `out`.
+
+  Each channel is a single table lookup written straight into the batch
+  tensor, so no intermediate float image is allocated.
+  """
+  table, padding = _normalization_table(image_processor.rescale_factor,
+                                        tuple(image_processor.image_mean),
+                                        tuple(image_processor.image_std))
+  buffer = out.numpy()
+  for i, image_pixels in enumerate(pixels):
+    height, width = image_pixels.shape[:2]
+    for channel in range(3):
+      np.take(table[channel], image_pixels[:, :, channel], out=buffer[i, channel, :height, :width], mode="clip")
+    buffer[i, :, height:, :] = padding[:, None, None]
+    buffer[i, :, :height, width:] = padding[:, None, None]
+  return out
+
+def target_size(image_size, input_size, box_coords=BOX_COORDS_MODEL_INPUT):
+  """
+  (height, width) to pass as `target_sizes` for one image.
+
+  OWLv2 pads the image at the bottom/right to a square and resizes that
+  square to the model input, so scaling normalized boxes to the padded
+  square side gives original-image pixel coordinates directly.
+  """
+  if box_coords == BOX_COORDS_MODEL_INPUT:
+    return tuple(input_size)
+  if box_coords == BOX_COORDS_ORIGINAL:
+    side = max(image_size)
+    return (side, side)
+  raise ValueError(f"Unknown box_coords: {box_coords!r}")
+
+def detect_and_count_preprocessed(pixel_values,
+                                  object_texts,
+                                  threshold=0.2,
+                                  processor=None,
+                                  model=None,
+                                  model_name=DEFAULT_MODEL_NAME,
+                                  model_save_path=DEFAULT_MODEL_SAVE_PATH,
+                                  image_sizes=None,
+                                  box_coords=BOX_COORDS_MODEL_INPUT,
+                                  inference_mode=INFERENCE_MODE_FP32,
+                                  embeddings_out=None):
+  """
+  Run detection on an already preprocessed (batch, 3, H, W) `pixel_values`
+  tensor and return one (counts_array, detections) tuple per image.
+
+  `image_sizes` holds the original (width, height) of each image, as given
+  by PIL's `Image.size`; it is required for `box_coords=BOX_COORDS_ORIGINAL`.
+  `embeddings_out` collects image embeddings as in `run_detection`.
+  """
+  if processor is None or model is None:
+    processor, model = get_model_and_processor(model_name, model_save_path, inference_mode=inference_mode)
+  # OWL-ViT expects a list of texts per image; first item can be empty (placeholder)
+  texts = [''] + list(object_texts)
+  batch_results = run_detection(pixel_values, texts, threshold, processor, model, image_sizes, box_coords, inference_mode,
+                                embeddings_out)
+  return [summarize_detections(result, texts, object_texts, threshold) for result in batch_results]
+
+def run_detection(pixel_values, texts, threshold, processor, model, image_sizes=None,
+                  box_coords=BOX_COORDS_MODEL_INPUT, inference_mode=INFERENCE_MODE_FP32, embeddings_out=None):
+  """
+  Forward pass plus post-processing: one {"scores", "labels", "boxes"}
+  tensor dict per image with every prediction above `threshold`.  `texts`
+  is the full query list, including the leading empty placeholder.
+
+  If `embeddings_out` is a list, each image's `image_level_embeddings`
+  vector is appended to it as a float32 numpy array; the vision tower has
+  already produced them, so this costs one small projection.
+  """
+  if box_coords == BOX_COORDS_ORIGINAL and image_sizes is None:
+    raise ValueError("image_sizes is required for original-image box coordinates")
+  query_embeds, query_mask = get_text_query_embeddings(texts, processor, model)
+  pixel_values = torch.as_tensor(pixel_values).to(device=model.device, dtype=model.dtype)
+
+  with inference_context(model, inference_mode):
+    outputs = run_detection_heads(pixel_values, query_embeds, query_mask, model)
+    if embeddings_out is not None:
+      embeddings_out.extend(image_level_embeddings(outputs.vision_model_output, model).cpu().numpy())
+  # Post-processing expects fp32 regardless of the autocast dtype
+  outputs.pred_boxes = outputs.pred_boxes.float()
+
+  # Every image keeps its own target size
+  input_size = pixel_values.shape[-2:]
+  if image_sizes is None:
+    image_sizes = [None] * pixel_values.shape[0]
+  target_sizes = torch.Tensor([target_size(image_size, input_size, box_coords) for image_size in image_sizes])
+  batch_results = processor.post_process_grounded_object_detection(outputs=outputs, target_sizes=target_sizes, threshold=threshold)
+  if box_coords == BOX_COORDS_ORIGINAL:
+    # Boxes can extend into the padding; keep them inside the real image
+    for result, (width, height) in zip(batch_results, image_sizes):
+      result["boxes"][:, 0::2] = result["boxes"][:, 0::2].clamp(0, width)
+      result["boxes"][:, 1::2] = result["boxes"][:, 1::2].clamp(0, height)
+  return batch_results
+
+
+def tile_grid(image_size, tiles_per_side=DEFAULT_TILES_PER_SIDE, overlap=DEFAULT_TILE_OVERLAP):
+  """
+  Square tiles (x0, y0, x1, y1) covering an image of `image_size`
+  (width, height): `tiles_per_side` along the longer side, as many as
+  needed along the shorter one, neighbours sharing `overlap` of a tile.
+  """
+  width, height = image_size
+  side = min(int(np.ceil(max(width, height) / (tiles_per_side - (tiles_per_side - 1) * overlap))), width, height)
+  stride = side * (1 - overlap)
+
+  def starts(length):
+    count = max(1, int(np.ceil((length - side) / stride - 1e-9)) + 1)
+    return np.linspace(0, length - side, count).round().astype(int).tolist()
+  return [(x, y, x + side, y + side) for y in starts(height) for x in starts(width)]
+
+def box_iou_matrix(boxes):
+  """Pairwise IoU of (N, 4) [x0, y0, x1, y1] boxes."""
+  area = (boxes[:, 2] - boxes[:, 0]).clamp(min=0) * (boxes[:, 3] - boxes[:, 1]).clamp(min=0)
+  top_left = torch.max(boxes[:, None, :2], boxes[None, :, :2])
+  bottom_right = torch.min(boxes[:, None, 2:], boxes[None, :, 2:])
+  intersection = (bottom_right - top_left).clamp(min=0).prod(dim=-1)
+  return intersection / (area[:, None] + area[None, :] - intersection).clamp(min=1e-6)
+
+def class_nms(boxes, scores, labels, iou_threshold=TILE_NMS_IOU):
+  """
+  Class-aware non-maximum suppression over the whole candidate set at
+  once ("Fast NMS"): a box is dropped when any higher-scoring box of the
+  same class overlaps it by more than `iou_threshold`.  Returns indices of
+  the kept boxes, highest score first.
+  """
+  order = scores.argsort(descending=True)[:NMS_MAX_CANDIDATES]
+  if order.numel() == 0:
+    return order
+  # Moving each class to its own region makes IoU across classes zero
+  offsets = labels[order].to(boxes.dtype)[:, None] * (boxes.max() + 1)
+  iou = box_iou_matrix(boxes[order] + offsets)
+  suppressed = iou.triu(diagonal=1).max(dim=0).values > iou_threshold
+  return order[~suppressed]
+
+def has_small_candidates(result, image_size, min_score):
+  """Whether a first-pass result (original-image boxes) holds a small box scoring at least `min_score`."""
+  boxes = result["boxes"][result["scores"] >= min_score]
+  if boxes.numel() == 0:
+    return False
+  limit = TILING_SMALL_OBJECT * max(image_size)
+  sides = torch.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1])
+  return bool((sides <= limit).any())
+
+def detect_tiles(image_path, texts, threshold, processor, model, tiles, inference_mode=INFERENCE_MODE_FP32):
+  """
+  Run the `tiles` of `image_path` through the model as one batch and return
+  a single result dict with boxes in original-image pixels.
+
+  The file is decoded once, at the smallest JPEG draft scale that keeps a
+  tile at least as large as the model input.  Boxes touching a tile edge
+  that lies inside the image are dropped: they are cut-off parts of an
+  object that a neighbouring tile or the whole-image pass sees entirely.
+  """
+  image_processor = processor.image_processor
+  input_size = model_input_size(image_processor)
+  tile_side = tiles[0][2] - tiles[0][0]
+  with Image.open(image_path) as image:
+    width, height = image.size
+    zoom = max(input_size) / tile_side
+    image.draft("RGB", (int(np.ceil(width * zoom)), int(np.ceil(height * zoom))))
+    image = image.convert("RGB")
+  scale = image.width / width
+
+  pixels = [resize_for_model(image.crop(tuple(round(v * scale) for v in tile)), input_size) for tile in tiles]
+  pixel_values = fill_pixel_values(pixels, image_processor, allocate_pixel_values(len(tiles), image_processor))
+  tile_sizes = [(x1 - x0, y1 - y0) for x0, y0, x1, y1 in tiles]
+  tile_results = run_detection(pixel_values, texts, threshold, processor, model, tile_sizes, BOX_COORDS_ORIGINAL, inference_mode)
+
+  # About two model-input pixels, in original-image pixels
+  margin = 2 * tile_side / max(input_size)
+  merged = {"boxes": [], "scores": [], "labels": []}
+  for (x0, y0, x1, y1), result in zip(tiles, tile_results):
+    boxes = result["boxes"] + torch.tensor([x0, y0, x0, y0], dtype=result["boxes"].dtype)
+    cut = torch.zeros(len(boxes), dtype=torch.bool)
+    if x0 > 0:
+      cut |= boxes[:, 0] <= x0 + margin
+    if y0 > 0:
+      cut |= boxes[:, 1] <= y0 + margin
+    if x1 < width:
+      cut |= boxes[:, 2] >= x1 - margin
+    if y1 < height:
+      cut |= boxes[:, 3] >= y1 - margin
+    merged["boxes"].append(boxes[~cut])
+    merged["scores"].append(result["scores"][~cut])
+    merged["labels"].append(result["labels"][~cut])
+  return {key: torch.cat(values) for key, values in merged.items()}
+
+def detect_and_count_tiled(image_paths,
+                           pixel_values,
+                           image_sizes,
+                           object_texts,
+                           threshold,
+                           processor,
+                           model,
+                           box_coords=BOX_COORDS_MODEL_INPUT,
+                           inference_mode=INFERENCE_MODE_FP32,
+                           tiling=TILING_ADAPTIVE,
+                           tiles_per_side=DEFAULT_TILES_PER_SIDE,
+                           tile_overlap=DEFAULT_TILE_OVERLAP,
+                           embeddings_out=None):
+  """
+  `detect_and_count_preprocessed` plus tiling for a batch whose whole-image
+  `pixel_values` are already prepared.
+
+  The whole-image pass runs first, for the batch.  An image is then tiled
+  if its tiles would show it at a higher resolution than the whole-image
+  pass, and, for TILING_ADAPTIVE, if that pass found a small box scoring
+  at least TILING_CANDIDATE_RATIO * threshold.  Whole-image and tile boxes
+  are merged with `class_nms`.
+  """
+  if box_coords not in (BOX_COORDS_MODEL_INPUT, BOX_COORDS_ORIGINAL):
+    raise ValueError(f"Unknown box_coords: {box_coords!r}")
+  texts = [''] + list(object_texts)
+  input_side = max(model_input_size(processor.image_processor))
+  first_threshold = threshold * TILING_CANDIDATE_RATIO if tiling == TILING_ADAPTIVE else threshold
+  first_results = run_detection(pixel_values, texts, first_threshold, processor, model, image_sizes,
+                                BOX_COORDS_ORIGINAL, inference_mode, embeddings_out)
+
+  summaries = []
+  for image_path, image_size, result in zip(image_paths, image_sizes, first_results):
+    tiles = tile_grid(image_size, tiles_per_side, tile_overlap)
+    worth_tiling = len(tiles) > 1 and tiles[0][2] - tiles[0][0] > input_side
+    if worth_tiling and (tiling == TILING_ALWAYS or has_small_candidates(result, image_size, first_threshold)):
+      confident = result["scores"] >= threshold
+      tiled = detect_tiles(image_path, texts, threshold, processor, model, tiles, inference_mode)
+      result = {key: torch.cat([result[key][confident], tiled[key]]) for key in ("boxes", "scores", "labels")}
+      keep = class_nms(result["boxes"], result["scores"], result["labels"])
+      result = {key: value[keep] for key, value in result.items()}
+    if box_coords == BOX_COORDS_MODEL_INPUT:
+      height, width = model_input_size(processor.image_processor)
+      side = max(image_size)
+      result = dict(result, boxes=result["boxes"] * torch.tensor([width / side, height / side] * 2))
+    summaries.append(summarize_detections(result, texts, object_texts, threshold))
+  return summaries
+
 if __name__ == "__main__":
   
   filepath = IMAGE_PATH